@@ -1,4 +1,5 @@
 from rest_framework.serializers import ModelSerializer, SerializerMethodField, PrimaryKeyRelatedField
+from django.db.models import Count, Q, OuterRef, Subquery
 
 from .models import Review, Photo, Vote
 from ..accounts.serializers import CustomUserViewSerializer
@@ -17,16 +18,29 @@ class ReviewSerializer(ModelSerializer):
         fields = ['id', 'user', 'rating', 'description', 'photos', 'tags', 'votes', 'user_vote', 'created_at']
         read_only_fields = ['id', 'user', 'photos', 'tags', 'votes', 'user_vote', 'created_at']
 
+    @staticmethod
+    def setup_eager_loading(queryset, user=None):
+        # the vote score is counted in the query and the vote of the user is read with a subquery
+        queryset = queryset.select_related('user').prefetch_related('photos', 'tags').annotate(
+            vote_score=Count('votes', filter=Q(votes__vote_type=Vote.UPVOTE))
+            - Count('votes', filter=Q(votes__vote_type=Vote.DOWNVOTE))
+        )
+        if user is not None and user.is_authenticated:
+            user_votes = Vote.objects.filter(review=OuterRef('pk'), user=user).values('vote_type')[:1]
+            queryset = queryset.annotate(current_user_vote=Subquery(user_votes))
+        return queryset
+
     def get_photos(self, obj):
-        photo_urls = Photo.objects.filter(review=obj)
         request = self.context.get('request')
-        return [request.build_absolute_uri(photo.photo.url) for photo in photo_urls]
+        return [request.build_absolute_uri(photo.photo.url) for photo in obj.photos.all()]
 
     def get_tags(self, obj):
         tags = obj.tags.all()
         return [tag.name for tag in tags]
 
     def get_votes(self, obj):
+        if hasattr(obj, 'vote_score'):
+            return obj.vote_score
         upvotes = obj.votes.filter(vote_type='upvote').count()
         downvotes = obj.votes.filter(vote_type='downvote').count()
         return upvotes - downvotes
@@ -34,6 +48,8 @@ class ReviewSerializer(ModelSerializer):
     def get_user_vote(self, obj):
         request = self.context.get('request')
         if request and request.user.is_authenticated:
+            if hasattr(obj, 'current_user_vote'):
+                return obj.current_user_vote
             vote = obj.votes.filter(user=request.user).first()
             return vote.vote_type if vote else None
         return None
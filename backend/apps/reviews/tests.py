@@ -1,3 +1,100 @@
-from django.test import TestCase
+from datetime import timedelta
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from .models import Review, Photo, Vote
+from ..routes.models import Route
+from ..routes.serializers import RouteSerializer, RouteReviewsPagination
+from ..tags.models import Tag
+
+
+class RouteReviewsQueriesTest(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='walker', password='walker-password')
+        self.voters = [get_user_model().objects.create_user(username=f'voter{number}', password='voter-password')
+                       for number in range(3)]
+        self.client.force_authenticate(user=self.user)
+        self.tag = Tag.objects.create(name='Shadow')
+        self.route = Route.objects.create(
+            user=self.user,
+            distance=2,
+            estimated_time=timedelta(minutes=30),
+            maximum_elevation_degree=1,
+            route='[]',
+            visibility=Route.PUBLIC
+        )
+        self.url = reverse('route-details', kwargs={'route_id': self.route.id})
+
+    def create_reviews(self, count):
+        reviews = []
+        for _ in range(count):
+            review = Review.objects.create(user=self.user, route=self.route, rating=3)
+            review.tags.add(self.tag)
+            Photo.objects.create(review=review, photo='review_photos/review.jpg')
+            reviews.append(review)
+        return reviews
+
+    def test_votes_are_tallied_and_ordered(self):
+        low, high, middle = self.create_reviews(3)
+        for voter in self.voters:
+            Vote.objects.create(user=voter, review=high, vote_type=Vote.UPVOTE)
+            Vote.objects.create(user=voter, review=low, vote_type=Vote.DOWNVOTE)
+        Vote.objects.create(user=self.voters[0], review=middle, vote_type=Vote.UPVOTE)
+        Vote.objects.create(user=self.voters[1], review=middle, vote_type=Vote.DOWNVOTE)
+        Vote.objects.create(user=self.user, review=middle, vote_type=Vote.UPVOTE)
+
+        reviews = self.client.get(self.url).data['reviews']
+
+        self.assertEqual(reviews['count'], 3)
+        self.assertEqual([review['id'] for review in reviews['results']], [high.id, middle.id, low.id])
+        self.assertEqual([review['votes'] for review in reviews['results']], [3, 1, -3])
+        self.assertEqual([review['user_vote'] for review in reviews['results']], [None, Vote.UPVOTE, None])
+        self.assertEqual(reviews['results'][0]['tags'], ['Shadow'])
+        self.assertEqual(len(reviews['results'][0]['photos']), 1)
+
+    def test_reviews_are_paginated(self):
+        self.create_reviews(5)
+
+        reviews = self.client.get(self.url, {'reviews_page': 2, 'reviews_page_size': 2}).data['reviews']
+
+        self.assertEqual(reviews['count'], 5)
+        self.assertEqual(len(reviews['results']), 2)
+        self.assertIn('reviews_page=3', reviews['next'])
+        self.assertIsNotNone(reviews['previous'])
+
+    def test_page_past_the_last_one_is_empty(self):
+        self.create_reviews(3)
+
+        response = self.client.get(self.url, {'reviews_page': 5, 'reviews_page_size': 2})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['id'], self.route.id)
+        self.assertEqual(response.data['reviews']['count'], 3)
+        self.assertEqual(response.data['reviews']['results'], [])
+
+    def test_first_page_without_a_request(self):
+        # photos need a request to build their urls, these reviews have none
+        for _ in range(RouteReviewsPagination.page_size + 1):
+            Review.objects.create(user=self.user, route=self.route, rating=3)
+
+        reviews = RouteSerializer(self.route).data['reviews']
+
+        self.assertEqual(reviews['count'], RouteReviewsPagination.page_size + 1)
+        self.assertEqual(len(reviews['results']), RouteReviewsPagination.page_size)
+        self.assertIsNone(reviews['next'])
+
+    def test_constant_queries(self):
+        # route, route photos, route tags, review count, reviews, review photos, review tags
+        for review in self.create_reviews(2):
+            Vote.objects.create(user=self.voters[0], review=review, vote_type=Vote.UPVOTE)
+        with self.assertNumQueries(7):
+            self.client.get(self.url)
+
+        for review in self.create_reviews(30):
+            Vote.objects.create(user=self.user, review=review, vote_type=Vote.DOWNVOTE)
+        with self.assertNumQueries(7):
+            response = self.client.get(self.url, {'reviews_page_size': 50})
+
+        self.assertEqual(len(response.data['reviews']['results']), 32)
@@ -1,5 +1,7 @@
 from rest_framework.serializers import ModelSerializer, SerializerMethodField, PrimaryKeyRelatedField, Serializer, \
     FloatField, CharField
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import NotFound
 from django.db.models import Avg
 import json
 
@@ -23,20 +25,35 @@ class RouteListSerializer(ModelSerializer):
         ]
         read_only_fields = ['id', 'distance', 'estimated_time', 'photos', 'tags', 'created_at']
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        # the user, photos and tags are fetched once for the whole list and the rating is averaged in the same query
+        return queryset.select_related('user').prefetch_related('photos', 'tags') \
+            .annotate(average_rating=Avg('reviews__rating'))
+
     def get_photos(self, obj):
-        photo_urls = Photo.objects.filter(route=obj)
         request = self.context.get('request')
-        return [request.build_absolute_uri(photo.photo.url) for photo in photo_urls]
+        return [request.build_absolute_uri(photo.photo.url) for photo in obj.photos.all()]
 
     def get_tags(self, obj):
         tags = obj.tags.all()
         return [tag.name for tag in tags]
 
     def get_average_rating(self, obj):
-        avg_rating = obj.reviews.aggregate(average=Avg('rating'))['average']
+        if hasattr(obj, 'average_rating'):
+            avg_rating = obj.average_rating
+        else:
+            avg_rating = obj.reviews.aggregate(average=Avg('rating'))['average']
         return format(avg_rating, ".2f") if avg_rating is not None else None
 
 
+class RouteReviewsPagination(PageNumberPagination):
+    page_size = 20
+    page_query_param = 'reviews_page'
+    page_size_query_param = 'reviews_page_size'
+    max_page_size = 100
+
+
 class RouteSerializer(RouteListSerializer):
     reviews = SerializerMethodField(read_only=True)
 
@@ -46,9 +63,21 @@ class RouteSerializer(RouteListSerializer):
         read_only_fields = RouteListSerializer.Meta.fields + ['maximum_elevation_degree', 'route']
 
     def get_reviews(self, obj):
-        reviews = ReviewSerializer(obj.reviews.all(), many=True, context=self.context).data
-        reviews.sort(key=lambda review: review["votes"], reverse=True)
-        return reviews
+        request = self.context.get('request')
+        user = request.user if request else None
+        reviews = ReviewSerializer.setup_eager_loading(obj.reviews.all(), user).order_by('-vote_score', 'id')
+        paginator = RouteReviewsPagination()
+        if request is None:
+            # serialized outside a view there are no query parameters, the first page is returned
+            data = ReviewSerializer(reviews[:paginator.page_size], many=True, context=self.context).data
+            return {'count': reviews.count(), 'next': None, 'previous': None, 'results': data}
+        try:
+            page = paginator.paginate_queryset(reviews, request)
+        except NotFound:
+            # a page past the last one is empty, the route itself is still returned
+            return {'count': reviews.count(), 'next': None, 'previous': None, 'results': []}
+        data = ReviewSerializer(page, many=True, context=self.context).data
+        return paginator.get_paginated_response(data).data
 
     def to_representation(self, instance):
         representation = super().to_representation(instance)
@@ -1,3 +1,54 @@
-from django.test import TestCase
+from datetime import timedelta
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from .models import Route, Photo
+from ..reviews.models import Review
+from ..tags.models import Tag
+
+
+class RoutesListQueriesTest(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='walker', password='walker-password')
+        self.client.force_authenticate(user=self.user)
+        self.tag = Tag.objects.create(name='Nature')
+
+    def create_routes(self, count, visibility=Route.PUBLIC):
+        for _ in range(count):
+            route = Route.objects.create(
+                user=self.user,
+                distance=1.5,
+                estimated_time=timedelta(minutes=20),
+                maximum_elevation_degree=2,
+                route='[]',
+                visibility=visibility
+            )
+            route.tags.add(self.tag)
+            Photo.objects.create(route=route, photo='route_photos/route.jpg')
+            Review.objects.create(user=self.user, route=route, rating=4)
+            Review.objects.create(user=self.user, route=route, rating=5)
+
+    def assert_constant_queries(self, url, visibility):
+        # routes, photos and tags, whatever the number of routes
+        self.create_routes(2, visibility)
+        with self.assertNumQueries(3):
+            self.client.get(url)
+
+        self.create_routes(10, visibility)
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+
+        self.assertEqual(len(response.data), 12)
+        route = response.data[0]
+        self.assertEqual(route['average_rating'], '4.50')
+        self.assertEqual(route['tags'], ['Nature'])
+        self.assertEqual(len(route['photos']), 1)
+        self.assertEqual(route['user']['username'], 'walker')
+
+    def test_public_routes_list(self):
+        self.assert_constant_queries(reverse('public-routes-list'), Route.PUBLIC)
+
+    def test_current_user_routes_list(self):
+        self.assert_constant_queries(reverse('current-user-routes-list'), Route.PRIVATE)
@@ -84,16 +84,18 @@ class RoutesListView(ListAPIView):
 
 class PublicRoutesListView(RoutesListView):
     def get_queryset(self):
-        return Route.objects.filter(visibility='public').order_by('-created_at')
+        routes = Route.objects.filter(visibility='public').order_by('-created_at')
+        return RouteListSerializer.setup_eager_loading(routes)
 
 
 class CurrentUserRoutesListView(RoutesListView):
     def get_queryset(self):
-        return Route.objects.filter(user=self.request.user).order_by('-created_at')
+        routes = Route.objects.filter(user=self.request.user).order_by('-created_at')
+        return RouteListSerializer.setup_eager_loading(routes)
 
 
 class RouteDetailsView(RetrieveAPIView):
-    queryset = Route.objects.all()
+    queryset = RouteSerializer.setup_eager_loading(Route.objects.all())
     serializer_class = RouteSerializer
     permission_classes = [IsAuthenticated]
     lookup_field = 'id'
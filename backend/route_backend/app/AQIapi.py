@@ -1,24 +1,59 @@
 import requests
 import numpy as np
 import pandas as pd
+import heapq
 import json
 import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+AQI_URL = os.environ.get("WALKSAFE_AQI_URL", "https://airquality.googleapis.com/v1/currentConditions:lookup")
+AQI_KEY = os.environ.get("WALKSAFE_AQI_KEY", "")
+AQI_DATA = "../resources/aqi_data"
+AQI_COORDINATES = "../resources/coordinates_for_aqi.csv"
+# One json file per answered point, so an interrupted collection starts where it stopped
+CHECKPOINT_DIRECTORY = "../resources/aqi_checkpoint/"
+# The saved readings are kept this long before the api is asked again
+AQI_MAX_AGE = 60 * 60
+# Answers older than this are asked again, no older than the saved readings may be
+CHECKPOINT_MAX_AGE = AQI_MAX_AGE
+# Requests in flight at once and requests started per second
+AQI_WORKERS = int(os.environ.get("WALKSAFE_AQI_WORKERS", "4"))
+AQI_RATE = float(os.environ.get("WALKSAFE_AQI_RATE", "5"))
+# Seconds to connect and to wait for an answer, retries of failed requests with a growing pause
+REQUEST_TIMEOUT = float(os.environ.get("WALKSAFE_AQI_TIMEOUT", "10"))
+REQUEST_RETRIES = 3
+# grid: the fixed 100 point mesh, adaptive: the quadtree of adaptive_point_space
+AQI_SAMPLER = os.environ.get("WALKSAFE_AQI_SAMPLER", "adaptive")
+# Most points the adaptive sampler asks for
+AQI_BUDGET = int(os.environ.get("WALKSAFE_AQI_BUDGET", "100"))
+# Cells whose corner readings differ by more than this many universal aqi points are split
+AQI_SPLIT_THRESHOLD = 5
+# The adaptive sampler starts from this many cells per side and splits a cell at most this many times
+AQI_INITIAL_CELLS = 4
+AQI_MAX_DEPTH = 4
+# Bounding box for Cluj-Napoca, Romania (approximate coordinates)
+BOUNDING_BOX = {
+    "min_lat": 46.7300,  # Southernmost latitude
+    "max_lat": 46.8000,  # Northernmost latitude
+    "min_lon": 23.5000,  # Westernmost longitude
+    # TODO:adjust this
+    "max_lon": 23.7100,  # Easternmost longitude
+}
+_local = threading.local()
 
 """
 Creates a 100 point meshgrid of coordinates based on max and min coordinate of the city
-Output: coordinates, which are inspected in qgis for correctness
+Output: coordinates, which are inspected in qgis for correctness, saved with the readings by save_aqi_data
 """
 
 
 def create_point_space():
-    # Define the bounding box for Cluj-Napoca, Romania (approximate coordinates)
-    bounding_box = {
-        "min_lat": 46.7300,  # Southernmost latitude
-        "max_lat": 46.8000,  # Northernmost latitude
-        "min_lon": 23.5000,  # Westernmost longitude
-        # TODO:adjust this
-        "max_lon": 23.7100,  # Easternmost longitude
-    }
+    bounding_box = BOUNDING_BOX
 
     # Calculate the number of points along each axis
     # Approximately
@@ -36,23 +71,55 @@ def create_point_space():
 
     print(len(coordinates))
     data = pd.DataFrame(coordinates)
-    file_name = "../resources/coordinates_for_aqi.csv"
-    data.to_csv(file_name)
 
     return data
 
 
+"""
+Spaces the requests so no more than rate start in a second, shared by the worker threads
+Input: rate - requests per second
+"""
+
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+"""
+Session of the worker thread, keeps the connection open and retries the failed requests with a growing pause
+"""
+
+
+def session():
+    if not hasattr(_local, "session"):
+        retry = Retry(total=REQUEST_RETRIES, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=("POST",))
+        _local.session = requests.Session()
+        _local.session.mount("https://", HTTPAdapter(max_retries=retry))
+        _local.session.mount("http://", HTTPAdapter(max_retries=retry))
+    return _local.session
+
+
 """
 Sending requests to the AQI api
 INPUT: latitude and longitude
 OUTPUT: -response json data,
-        -error code
+        -None when the request failed after the retries
 """
 
 
 def create_requests_for_each_points(lat, lon):
-    url = "https://airquality.googleapis.com/v1/currentConditions:lookup?key="
-
     payload = {
         "universalAqi": True,
         "location": {
@@ -68,56 +135,224 @@ def create_requests_for_each_points(lat, lon):
         ]
     }
 
-    # Set headers for POST request
+    # Set headers for POST request, the key goes in a header so it stays out of the url and the logs
     headers = {
-        "Content-Type": "application/json"
+        "Content-Type": "application/json",
+        "X-Goog-Api-Key": AQI_KEY
     }
     try:
-        response = requests.post(url, json=payload, headers=headers)
+        response = session().post(AQI_URL, json=payload, headers=headers, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
         data = response.json()
         return data
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, ValueError) as e:
         print(f"Error fetching data; {e} ")
         return None
 
 
-def output_into_file(data):
-    json_data = json.dumps(data, indent=4)
+def _checkpoint_path(lat, lon):
+    return os.path.join(CHECKPOINT_DIRECTORY, f"{lat:.6f}_{lon:.6f}.json")
 
-    # print(json_data)
 
-    with open("../resources/aqi_data", "w") as json_file:
-        json_file.write(json_data)
+def _read_checkpoint(lat, lon):
+    path = _checkpoint_path(lat, lon)
+    if not os.path.exists(path) or time.time() - os.path.getmtime(path) > CHECKPOINT_MAX_AGE:
+        return None
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def _write_checkpoint(lat, lon, data):
+    path = _checkpoint_path(lat, lon)
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(data, file)
+    os.replace(temporary_path, path)
+
+
+"""
+Readings of the points, asked concurrently under the rate limit
+Every answer is saved as soon as it comes, the points answered before are read from the checkpoint.
+INPUT: points - list of (latitude, longitude)
+OUTPUT: list of response json data in the order of the points, None where the request failed
+"""
+
+
+def fetch_points(points, workers=AQI_WORKERS, rate=AQI_RATE):
+    os.makedirs(CHECKPOINT_DIRECTORY, exist_ok=True)
+    limiter = RateLimiter(rate)
+
+    def fetch(point):
+        lat, lon = point
+        data = _read_checkpoint(lat, lon)
+        if data is not None:
+            return data, True
+        limiter.wait()
+        data = create_requests_for_each_points(lat, lon)
+        if data is not None:
+            _write_checkpoint(lat, lon, data)
+        return data, False
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(fetch, points))
+    resumed = sum(1 for _, from_checkpoint in results if from_checkpoint)
+    failed = sum(1 for data, _ in results if data is None)
+    print(f"AQI: {len(points)} points, {resumed} from the checkpoint, {len(points) - resumed - failed} asked, "
+          f"{failed} failed in {time.perf_counter() - start_time:.1f}s")
+    return [data for data, _ in results]
+
+
+"""
+Saves the readings next to their coordinates, the two files are what extract_aqi_data_from_tables reads
+INPUT: data - latitude, longitude of every point
+       responses - response json data of every point
+"""
+
+
+def save_aqi_data(data, responses):
+    for path, write in ((AQI_DATA, lambda file: json.dump(responses, file, indent=4)),
+                        (AQI_COORDINATES, lambda file: data.to_csv(file))):
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w", newline="") as file:
+            write(file)
+        os.replace(temporary_path, path)
 
 
 """
 Getting all the responses and creating a json array.
+The files are only replaced when every point answered, the checkpoint is cleared after.
 INPUT: data - key, latitude, longitude
-
+OUTPUT: True if the readings were saved
 """
 
 
 def running_on_data(data):
-    # create_requests_for_each_points(46.795890,23.628894)
-    # print(data)
-    final_data = []
-    for key, value in data.iterrows():
-        response = create_requests_for_each_points(value[0], value[1])
-        # print(key,response)
-        final_data.append(response)
-    output_into_file(final_data)
+    points = [(value[0], value[1]) for _, value in data.iterrows()]
+    responses = fetch_points(points)
+    if any(response is None for response in responses):
+        print("AQI readings incomplete, run again to resume.")
+        return False
+    save_aqi_data(data, responses)
+    shutil.rmtree(CHECKPOINT_DIRECTORY, ignore_errors=True)
+    return True
+
+
+"""
+Universal aqi of a response
+"""
+
+
+def universal_aqi(response):
+    for index in response["indexes"]:
+        if index["code"] == "uaqi":
+            return index["aqi"]
+    return response["indexes"][0]["aqi"]
+
+
+def _cell_points(cell):
+    min_lat, min_lon, max_lat, max_lon, _ = cell
+    return [(min_lat, min_lon), (min_lat, max_lon), (max_lat, min_lon), (max_lat, max_lon)]
+
+
+def _split_cell(cell):
+    min_lat, min_lon, max_lat, max_lon, depth = cell
+    mid_lat = (min_lat + max_lat) / 2
+    mid_lon = (min_lon + max_lon) / 2
+    return [(min_lat, min_lon, mid_lat, mid_lon, depth + 1), (min_lat, mid_lon, mid_lat, max_lon, depth + 1),
+            (mid_lat, min_lon, max_lat, mid_lon, depth + 1), (mid_lat, mid_lon, max_lat, max_lon, depth + 1)]
+
+
+def _point_key(point):
+    return round(point[0], 7), round(point[1], 7)
+
+
+"""
+Adaptive sampling of the city on a quadtree
+Starts from a coarse grid of cells and asks for their corners, then splits the cells whose corner readings differ
+by more than the threshold, the largest differences first, until no cell differs that much or the budget is spent.
+The corners of the new cells are asked together every round, a corner shared by cells is asked once.
+Uniform areas stay coarse and the quota goes to the cells along the pollution gradients.
+INPUT: budget - most points asked
+       threshold - universal aqi difference which splits a cell
+OUTPUT: data - latitude, longitude of every point like create_point_space, None if a request failed
+        responses - response json data of every point
+"""
+
+
+def adaptive_point_space(budget=AQI_BUDGET, threshold=AQI_SPLIT_THRESHOLD):
+    latitudes = np.linspace(BOUNDING_BOX["min_lat"], BOUNDING_BOX["max_lat"], AQI_INITIAL_CELLS + 1)
+    longitudes = np.linspace(BOUNDING_BOX["min_lon"], BOUNDING_BOX["max_lon"], AQI_INITIAL_CELLS + 1)
+    cells = [(latitudes[i], longitudes[j], latitudes[i + 1], longitudes[j + 1], 0)
+             for i in range(AQI_INITIAL_CELLS) for j in range(AQI_INITIAL_CELLS)]
+
+    points = []
+    readings = dict()
+    responses = []
+    # largest corner difference first
+    candidates = []
+    while cells:
+        new_points = []
+        for cell in cells:
+            for point in _cell_points(cell):
+                key = _point_key(point)
+                if key not in readings:
+                    readings[key] = None
+                    new_points.append(point)
+        new_responses = fetch_points(new_points)
+        if any(response is None for response in new_responses):
+            return None, None
+        for point, response in zip(new_points, new_responses):
+            readings[_point_key(point)] = universal_aqi(response)
+            points.append(point)
+            responses.append(response)
+
+        for cell in cells:
+            corner_readings = [readings[_point_key(point)] for point in _cell_points(cell)]
+            spread = max(corner_readings) - min(corner_readings)
+            if spread > threshold and cell[4] < AQI_MAX_DEPTH:
+                heapq.heappush(candidates, (-spread, cell))
+
+        # the cells split this round, as long as their new corners fit in the budget
+        cells = []
+        planned = set()
+        while candidates:
+            children = _split_cell(candidates[0][1])
+            needed = {_point_key(point) for child in children for point in _cell_points(child)}
+            needed = needed - readings.keys() - planned
+            if len(points) + len(planned) + len(needed) > budget:
+                break
+            heapq.heappop(candidates)
+            planned.update(needed)
+            cells.extend(children)
+
+    print(f"AQI adaptive sampling: {len(points)} points of the {budget} budget")
+    return pd.DataFrame(points), responses
+
+
+"""
+Collects new readings when the saved ones are older than AQI_MAX_AGE.
+This is for not overusing the API, saving cost is key.
+OUTPUT: True if new readings were saved
+"""
 
 
 def main():
-    data = create_point_space()
-    filepath = "../resources/aqi_data.json"
-    """
-    This if is for not overusing the API, in future we can calculate per day how many time do we ask for AQI data.
-    Saving cost is key.
-    """
-    if not os.path.exists(filepath):
-        running_on_data(data)
+    if os.path.exists(AQI_DATA) and time.time() - os.path.getmtime(AQI_DATA) < AQI_MAX_AGE:
+        print("AQI readings are recent, nothing asked.")
+        return False
+    if AQI_SAMPLER == "grid":
+        data = create_point_space()
+        return running_on_data(data)
+
+    data, responses = adaptive_point_space()
+    if data is None:
+        print("AQI readings incomplete, run again to resume.")
+        return False
+    save_aqi_data(data, responses)
+    shutil.rmtree(CHECKPOINT_DIRECTORY, ignore_errors=True)
+    return True
 
 
-main()
+if __name__ == "__main__":
+    main()
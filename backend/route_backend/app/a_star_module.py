@@ -1,19 +1,23 @@
 import osmnx as ox
 from shapely.geometry import Point, LineString
-from shapely.strtree import STRtree
 from math import sqrt, radians, cos, sin, atan2
 from sklearn.preprocessing import MinMaxScaler
 from os.path import exists
+import os
 from random import uniform
 from traffic_module import refresh_traffic
 from resource_generator import refresh_resource_generator
+from graph_compaction_module import contract_degree_two, compaction_report, chain_between, chain_positions
+from graph_compiler_module import compile_graph, VALUE_COLUMNS, TRAFFIC
+from traffic_history_module import attach_history
+import weights_store_module as ws
 import heapq
 import polyline
 import pandas as pd
 import geopandas as gpd
-from shapely.wkt import loads
 import csv
 import threading as th
+import time
 
 full_graph = None
 nodes_full = None
@@ -24,38 +28,89 @@ gdf_reset = None
 _dict_yx_id = None
 _dict_id_yx = None
 _dict_neighbours = None
+_dict_chain_nodes = None
+_compiled_graph = None
 _lock = th.Lock()
+_snapshot = None
+snapshot_version = 0
+snapshot_loaded_at = None
+last_refresh_duration = None
+refresh_in_progress = False
+# Merge chains of degree-2 nodes when the snapshot is built
+CONTRACT_DEGREE_TWO = True
+# Node order of the compiled graph: hilbert, bfs or load
+GRAPH_ORDER = "hilbert"
+# Stand ins for a start or goal removed by the contraction in the search
+START = -1
+GOAL = -2
+# Price traffic with the history of the current weekday and hour, the live jams on top
+TRAFFIC_HISTORY = os.environ.get("WALKSAFE_TRAFFIC_HISTORY", "1") == "1"
+# Share of the cost given to traffic, taken from the share of the length, 0 ranks the routes as before the history
+TRAFFIC_WEIGHT = float(os.environ.get("WALKSAFE_TRAFFIC_WEIGHT", "0"))
 
 """
 Calls for other modules to refresh the dynamic data
+Output: - False if nothing changed and the snapshot in use can keep serving
 """
 
 
 def call_others_module_refresh():
     # aqi_module.refresh()
-    refresh_traffic()
-    refresh_resource_generator()
+    traffic_changed = refresh_traffic()
+    # the layers run every time, so the ttl of the aqi and traffic layers is kept, the cache skips the others
+    layers_changed = refresh_resource_generator()
+    return traffic_changed or layers_changed
 
 
 """
 Refreshing dynamic data like traffic and aqi.
+The old snapshot keeps serving until the new one is built, then they are swapped.
 """
 
 
 def refresh_data():
-    global epsg_c, full_graph, nodes_full, edges_full, df_weights_projected, gdf_reset, _dict_yx_id, _dict_id_yx, _dict_neighbours
-    print("Data cleared")
-    full_graph = None
-    nodes_full = None
-    edges_full = None
-    epsg_c = None
-    df_weights_projected = None
-    gdf_reset = None
-    _dict_yx_id = None
-    _dict_id_yx = None
-    _dict_neighbours = None
+    global last_refresh_duration, refresh_in_progress
+    refresh_start = time.perf_counter()
+    refresh_in_progress = True
+    try:
+        if call_others_module_refresh() or _snapshot is None:
+            load_snapshot()
+        else:
+            print("Nothing changed, the snapshot in use is kept")
+    finally:
+        refresh_in_progress = False
+    last_refresh_duration = time.perf_counter() - refresh_start
+    print(f"Data refreshed in {last_refresh_duration:.1f}s")
+
 
-    call_others_module_refresh()
+"""
+Is there a persisted snapshot the router can start from
+Output: True, False
+"""
+
+
+def snapshot_available():
+    return exists("../resources/graph/full_graph.graphml") and ws.weights_saved()
+
+
+"""
+Builds a snapshot from the persisted data and swaps it with the one in use.
+"""
+
+
+def load_snapshot():
+    snapshot = initialization()
+    with _lock:
+        _install_snapshot(snapshot)
+    return snapshot
+
+
+def _install_snapshot(snapshot):
+    global epsg_c, full_graph, nodes_full, edges_full, df_weights_projected, gdf_reset, _dict_yx_id, _dict_id_yx, _dict_neighbours, _dict_chain_nodes, _compiled_graph, _snapshot, snapshot_version, snapshot_loaded_at
+    epsg_c, full_graph, nodes_full, edges_full, df_weights_projected, gdf_reset, _dict_yx_id, _dict_id_yx, _dict_neighbours, _dict_chain_nodes, _compiled_graph = snapshot
+    _snapshot = snapshot
+    snapshot_version = snapshot_version + 1
+    snapshot_loaded_at = time.time()
 
 
 """
@@ -66,18 +121,35 @@ Returns: - epsg_c
          - edges_full
          - df_weights_projected
          - gdf_reset
-
+         - dict_yx_id, dict_id_yx, dict_neighbours
+         - dict_chain_nodes: nodes merged into the compacted edges
+         - compiled graph the search runs on
 """
 
 
 def get_resources():
-    global epsg_c, full_graph, nodes_full, edges_full, df_weights_projected, gdf_reset, _dict_yx_id, _dict_id_yx, _dict_neighbours
-    if full_graph is None and nodes_full is None and edges_full is None and epsg_c is None and df_weights_projected is None and gdf_reset is None and _dict_id_yx is None and _dict_yx_id is None and _dict_neighbours is None:
+    snapshot = _snapshot
+    if snapshot is None:
         with _lock:
-            if full_graph is None and nodes_full is None and edges_full is None and epsg_c is None and df_weights_projected is None and gdf_reset is None and _dict_id_yx is None and _dict_yx_id is None and _dict_neighbours is None:
-                epsg_c, full_graph, nodes_full, edges_full, df_weights_projected, gdf_reset, _dict_yx_id, _dict_id_yx, _dict_neighbours = initialization()
-                return epsg_c, full_graph, nodes_full, edges_full, df_weights_projected, gdf_reset, _dict_yx_id, _dict_id_yx, _dict_neighbours
-    return epsg_c, full_graph, nodes_full, edges_full, df_weights_projected, gdf_reset, _dict_yx_id, _dict_id_yx, _dict_neighbours
+            if _snapshot is None:
+                _install_snapshot(initialization())
+            snapshot = _snapshot
+    return snapshot
+
+
+"""
+Describes the data the router is currently using
+Returns: - dictionary with snapshot version, load time and weights modification time
+"""
+
+
+def snapshot_info():
+    weights_path = ws.weights_path()
+    return {
+        "snapshot_version": snapshot_version,
+        "loaded_at": snapshot_loaded_at,
+        "weights_modified": os.path.getmtime(weights_path) if weights_path is not None else None,
+    }
 
 
 """
@@ -100,8 +172,22 @@ def initialization():
     dict_id_yx = create_dictionary_id_yx(nodes_full)
     dict_neighbours = create_id_neighbours(full_graph)
 
+    live_levels = gdf_reset["traffic"].to_numpy(dtype=float, copy=True)
     gdf_reset_normalized = normalize(gdf_reset)
-    return epsg_c, full_graph_no_parallels, nodes_full, edges_full, df_weights_projected, gdf_reset_normalized, dict_yx_id, dict_id_yx, dict_neighbours
+    gdf_before_contraction = gdf_reset_normalized
+    dict_chain_nodes = dict()
+    if CONTRACT_DEGREE_TWO:
+        gdf_compacted, neighbours_compacted, dict_chain_nodes = contract_degree_two(gdf_reset_normalized,
+                                                                                    dict_neighbours, dict_id_yx)
+        compaction_report(gdf_reset_normalized, dict_neighbours, gdf_compacted, neighbours_compacted)
+        gdf_reset_normalized, dict_neighbours = gdf_compacted, neighbours_compacted
+    compiled = compile_graph(gdf_reset_normalized, dict_neighbours, dict_id_yx, GRAPH_ORDER)
+    compiled.chain_of = chain_positions(compiled, gdf_before_contraction, dict_chain_nodes, VALUE_COLUMNS)
+    if TRAFFIC_HISTORY:
+        attach_history(compiled, gdf_before_contraction, live_levels, gdf_reset_normalized, dict_chain_nodes)
+    # the queries snap onto the edges before the contraction, like on the full graph, the index is built here once
+    gdf_before_contraction.sindex
+    return epsg_c, full_graph_no_parallels, nodes_full, edges_full, df_weights_projected, gdf_before_contraction, dict_yx_id, dict_id_yx, dict_neighbours, dict_chain_nodes, compiled
 
 
 """
@@ -123,9 +209,10 @@ def set_tags(tags, gdf_reset):
                 'No Pollution': 6,
             }
             w = [0 for i in range(column_count)]
-            w[0] = 0.65
+            w[0] = 0.65 - TRAFFIC_WEIGHT
+            w[1] = TRAFFIC_WEIGHT
             w[2] = 0.1
-            base_value = 1 - w[0] - w[2]
+            base_value = 1 - w[0] - w[1] - w[2]
             value_tags = round(base_value / len(tags), 4)
             sum_value = 0
             for i in range(len(tags) - 1):
@@ -136,7 +223,8 @@ def set_tags(tags, gdf_reset):
         else:
             column_count = gdf_reset.shape[1]
             w = [0 for i in range(column_count)]
-            w[0] = 0.85
+            w[0] = 0.85 - TRAFFIC_WEIGHT
+            w[1] = TRAFFIC_WEIGHT
             w[2] = 0.15
     return w
 
@@ -147,8 +235,7 @@ Saving dataframe weight for future use
 
 
 def save_df_weights():
-    filename = "../resources/weights_data.csv"
-    df_weights_projected.to_csv(filename)
+    ws.write_weights(df_weights_projected)
 
 
 """
@@ -157,17 +244,14 @@ Initializing weight dataframe
 
 
 def initialize_df_weights(edges_full, epsg_c):
-    if not saved_data("weights_data"):
+    if not ws.weights_saved():
 
         df_weights = pd.DataFrame()
         df_weights = edges_full[["length", "geometry"]]
         df_weights_projected = gpd.GeoDataFrame(df_weights, geometry="geometry")
     else:
-        df_weights = pd.read_csv("../resources/weights_data.csv")
-        df_weights["geometry"] = df_weights["geometry"].apply(loads)
-        df_weights_projected = gpd.GeoDataFrame(df_weights, geometry="geometry")
-        df_weights_projected.set_crs(epsg=epsg_c, inplace=True)
-        df_weights_projected.set_index(["u", "v", "key"], inplace=True)
+        # only what the router uses, other columns in the store are not read
+        df_weights_projected = ws.read_weights(["length", "geometry"] + ws.SCORE_COLUMNS)
 
     return df_weights_projected
 
@@ -201,13 +285,10 @@ Finding the nearest edge in the dataframe
 
 
 def nearest_edge_rep(point, gdf_reset):
-    geometries = gdf_reset.geometry.tolist()
-
     point_to_find = Point(point[1], point[0])
-    str_tree = STRtree(geometries)
-
-    nearest_geom_id = str_tree.nearest(point_to_find)
-    nearest_geom = geometries[nearest_geom_id]
+    # the spatial index is built once per snapshot and kept on the dataframe
+    nearest_geom_id = gdf_reset.sindex.nearest(point_to_find, return_all=False)[1][0]
+    nearest_geom = gdf_reset.geometry.iloc[nearest_geom_id]
     p1 = nearest_geom.coords[0]
     p1_rounded = tuple(round(x, 7) for x in p1)
     p2 = nearest_geom.coords[-1]
@@ -527,37 +608,131 @@ def gdf_reset_for_a_start(df_weights_projected):
     return gdf_reset
 
 
+"""
+Ways from a node removed by the contraction to both ends of its merged edge
+The cost of the merged edge is split at the node in the share the segments before it have in the cost,
+with the traffic the query uses when it has one from the history.
+Input: - node_id: OSM id of the removed node
+       - compiled, edge_cost, w: graph and costs of the query
+       - traffic_column, traffic_prefix: traffic of the query from select_traffic, None for the static traffic
+Output: - list of (index of the end, cost, removed nodes passed from the end to the node)
+"""
+
+
+def chain_entries(node_id, compiled, edge_cost, w, traffic_column=None, traffic_prefix=None):
+    edge, u_index, v_index, removed, position, prefix = compiled.chain_of[node_id]
+    total = compiled.edge_values[edge].tolist()
+    if traffic_column is not None:
+        prefix = list(prefix)
+        prefix[TRAFFIC] = float(traffic_prefix[compiled.traffic_history.prefix_row_of[node_id]])
+        total[TRAFFIC] = float(traffic_column[edge])
+    prefix_cost = sum(prefix[i] * w[i] for i in range(len(prefix)))
+    total_cost = sum(total[i] * w[i] for i in range(len(total)))
+    if total_cost > 0:
+        share = prefix_cost / total_cost
+    else:
+        share = prefix[0] / total[0] if total[0] > 0 else 0.5
+    to_u = edge_cost[edge] * share
+    return [(u_index, to_u, removed[:position]), (v_index, edge_cost[edge] - to_u, removed[position + 1:][::-1])]
+
+
 """
 A_start algorithm
 Input: Full_graph - contains all the nodes and edges 
        start_point - coordinates on the map or here the user is 
        end_point   - coordinates on the map or where user wants to go
+       stats - optional dictionary, filled with the timings and counters of the query
 Output: path - with the optimal road
 """
 
 
-def a_star(start_point, end_point, type_of_return, tags):
-    _, full_graph, _, _, _, gdf_reset, dict_yx_id, dict_id_yx, dict_neighbours = get_resources()
-    graph = full_graph
+def a_star(start_point, end_point, type_of_return, tags, stats=None):
+    if stats is None:
+        stats = dict()
+    query_start = time.perf_counter()
+    stats["cache_hit"] = _snapshot is not None
+    _, _, _, _, _, gdf_reset, dict_yx_id, dict_id_yx, _, dict_chain_nodes, compiled = get_resources()
+    stats["snapshot_version"] = snapshot_version
 
+    snap_start = time.perf_counter()
     point_start1, point_start2, point_dest1, point_dest2, projected_s, projected_d = find_starting_coordinate(
         start_point, end_point, gdf_reset)
     start, goal = selection_of_closest_starting_point(point_start1, point_start2, point_dest1, point_dest2)
+    stats["snap_time"] = time.perf_counter() - snap_start
 
+    # the search runs on the compiled graph, nodes are internal indexes, node_ids gives back the OSM ids
+    traffic_column, traffic_prefix, stats["traffic_bucket"] = compiled.select_traffic(time.time())
+    w = set_tags(tags, gdf_reset)
+    edge_cost = compiled.edge_costs(w, traffic_column)
+    adjacency = compiled.adjacency
+    node_ids = compiled.node_ids_list
+    lat_of = compiled.lat_list
+    lon_of = compiled.lon_list
+    start_id = dict_yx_id[start]
+    goal_id = dict_yx_id[goal]
+    lat3, lon3 = goal
+
+    # ties are broken by the OSM id, as before the renumbering
     open_set = []
-    heapq.heappush(open_set, (0, dict_yx_id[start]))
-    # came_from IDs
+    in_open_set = set()
+    # came_from index: (previous index, edge row)
     came_from = {}
-    g_score = {node: float('inf') for node in graph}
-    g_score[dict_yx_id[start]] = 0
-    f_score = {node: float('inf') for node in graph}
-    f_score[dict_yx_id[start]] = haversine(start[0], start[1], goal[0], goal[1])
+    g_score = [float('inf')] * len(node_ids)
+    # a start removed by the contraction enters its merged edge from both ends
+    start_entries = dict()
+    if start_id in compiled.index_of:
+        start_index = compiled.index_of[start_id]
+        g_score[start_index] = 0
+        heapq.heappush(open_set, (0, node_ids[start_index], start_index))
+        in_open_set.add(start_index)
+    else:
+        for anchor, cost, passed in chain_entries(start_id, compiled, edge_cost, w, traffic_column, traffic_prefix):
+            if cost < g_score[anchor]:
+                g_score[anchor] = cost
+                start_entries[anchor] = (cost, passed)
+        for anchor, (cost, _) in start_entries.items():
+            heapq.heappush(open_set, (cost + haversine(lat_of[anchor], lon_of[anchor], lat3, lon3),
+                                      node_ids[anchor], anchor))
+            in_open_set.add(anchor)
+    # a goal removed by the contraction is reached from the ends of its merged edge, GOAL stands for it in the heap
+    goal_entries = dict()
+    goal_from = None
+    goal_score = float('inf')
+    if goal_id in compiled.index_of:
+        goal_index = compiled.index_of[goal_id]
+    else:
+        goal_index = GOAL
+        for anchor, cost, passed in chain_entries(goal_id, compiled, edge_cost, w, traffic_column, traffic_prefix):
+            goal_entries[anchor] = (cost, passed)
+        if start_id not in compiled.index_of and compiled.chain_of[start_id][0] == compiled.chain_of[goal_id][0]:
+            # start and goal on the same merged edge, straight along it
+            _, _, _, removed, start_position, _ = compiled.chain_of[start_id]
+            goal_position = compiled.chain_of[goal_id][4]
+            to_u_start = chain_entries(start_id, compiled, edge_cost, w, traffic_column, traffic_prefix)[0][1]
+            to_u_goal = chain_entries(goal_id, compiled, edge_cost, w, traffic_column, traffic_prefix)[0][1]
+            if start_position < goal_position:
+                passed = removed[start_position + 1:goal_position]
+            else:
+                passed = removed[goal_position + 1:start_position][::-1]
+            goal_entries[START] = (abs(to_u_goal - to_u_start), passed)
+            goal_score = abs(to_u_goal - to_u_start)
+            goal_from = START
+            heapq.heappush(open_set, (goal_score, goal_id, GOAL))
+    nodes_expanded = 0
+    heap_pushes = len(open_set)
+    search_start = time.perf_counter()
 
     while open_set:
-        # current - id node
-        current = heapq.heappop(open_set)[1]
-
-        if dict_id_yx[current] == goal:
+        # current - index of the node
+        current = heapq.heappop(open_set)[2]
+        in_open_set.discard(current)
+        nodes_expanded = nodes_expanded + 1
+
+        if current == goal_index:
+            stats["search_time"] = time.perf_counter() - search_start
+            stats["nodes_expanded"] = nodes_expanded
+            stats["heap_pushes"] = heap_pushes
+            reconstruction_start = time.perf_counter()
             path = []
             length = 0
             # The end point given
@@ -571,13 +746,35 @@ def a_star(start_point, end_point, type_of_return, tags):
              """
             length = length + haversine(projected_d.y, projected_d.x, goal[0], goal[1])
 
+            if current == GOAL:
+                # the start coordinates are added at the end
+                if goal_id != start_id:
+                    path.append((goal[1], goal[0]))
+                cost, passed = goal_entries[goal_from]
+                for merged_node in passed[::-1]:
+                    (y, x) = dict_id_yx[merged_node]
+                    path.append((x, y))
+                length = length + cost
+                current = goal_from
+
             # add geometry
             while current in came_from:
-                (y, x) = dict_id_yx[current]
-                path.append((x, y))
-                # length = length + get_value_from_dict(dict_edges_length,(current,came_from[current]))
-                length = length + heuristic(current, came_from[current], gdf_reset, tags)
-                current = came_from[current]
+                previous, edge = came_from[current]
+                path.append((lon_of[current], lat_of[current]))
+                # nodes merged into the edge by the compaction
+                for merged_node in chain_between(node_ids[current], node_ids[previous], dict_chain_nodes):
+                    (y, x) = dict_id_yx[merged_node]
+                    path.append((x, y))
+                length = length + edge_cost[edge]
+                current = previous
+
+            if current in start_entries:
+                path.append((lon_of[current], lat_of[current]))
+                cost, passed = start_entries[current]
+                for merged_node in passed:
+                    (y, x) = dict_id_yx[merged_node]
+                    path.append((x, y))
+                length = length + cost
 
             length = length + haversine(start[0], start[1], projected_s.y, projected_s.x)
 
@@ -588,28 +785,40 @@ def a_star(start_point, end_point, type_of_return, tags):
             path.append((projected_s.x, projected_s.y))
             # The start point given
             path.append((start_point[1], start_point[0]))
+            stats["reconstruction_time"] = time.perf_counter() - reconstruction_start
+            stats["path_length"] = len(path)
 
             if type_of_return:
                 path_to_send = path[::-1]
+                serialization_start = time.perf_counter()
                 json = transforming_into_json(path_to_send, 0)
-                # res_end_star = time.time()
-                # print(f"A star stuff {res_end_star-res_start_star}")
+                stats["serialization_time"] = time.perf_counter() - serialization_start
+                stats["total_time"] = time.perf_counter() - query_start
                 return json
+            stats["total_time"] = time.perf_counter() - query_start
             return path[::-1], length
 
-        for neighbor in dict_neighbours[current]:
-            lat1, lon1 = dict_id_yx[current]
-            lat2, lon2 = dict_id_yx[neighbor]
-            # tentative_g_score = g_score[current] + get_value_from_dict(dict_edges_length,(current,neighbor))
-            tentative_g_score = g_score[current] + heuristic(current, neighbor, gdf_reset, tags)
+        current_g_score = g_score[current]
+        if goal_entries and current in goal_entries and current_g_score + goal_entries[current][0] < goal_score:
+            goal_score = current_g_score + goal_entries[current][0]
+            goal_from = current
+            heapq.heappush(open_set, (goal_score, goal_id, GOAL))
+            heap_pushes = heap_pushes + 1
+        for neighbor, edge in adjacency[current]:
+            tentative_g_score = current_g_score + edge_cost[edge]
             if tentative_g_score < g_score[neighbor]:
-                lat3, lon3 = goal
-                came_from[neighbor] = current
+                came_from[neighbor] = (current, edge)
                 g_score[neighbor] = tentative_g_score
-                f_score[neighbor] = g_score[neighbor] + haversine(lat2, lon2, lat3, lon3)
-                if neighbor not in [i[1] for i in open_set]:
-                    heapq.heappush(open_set, (f_score[neighbor], neighbor))
-
+                if neighbor not in in_open_set:
+                    f_score = tentative_g_score + haversine(lat_of[neighbor], lon_of[neighbor], lat3, lon3)
+                    heapq.heappush(open_set, (f_score, node_ids[neighbor], neighbor))
+                    in_open_set.add(neighbor)
+                    heap_pushes = heap_pushes + 1
+
+    stats["search_time"] = time.perf_counter() - search_start
+    stats["nodes_expanded"] = nodes_expanded
+    stats["heap_pushes"] = heap_pushes
+    stats["total_time"] = time.perf_counter() - query_start
     return None
 
 
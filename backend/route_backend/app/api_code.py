@@ -1,15 +1,28 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
 from contextlib import asynccontextmanager
 import a_star_module as a
+import metrics_module as m
+import slow_query_module as s
 import asyncio
+import time
 
-refresh_done_event = asyncio.Event()
+snapshot_ready_event = asyncio.Event()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    asyncio.create_task(refresh_data())
+    # Serve from the last persisted snapshot, the refresh catches up in the background
+    if a.snapshot_available():
+        try:
+            await asyncio.to_thread(a.load_snapshot)
+            snapshot_ready_event.set()
+            print("Serving from the persisted snapshot")
+        except Exception as e:
+            print(f"Persisted snapshot could not be loaded, waiting for the refresh: {e}")
+    refresh_task = asyncio.create_task(refresh_data())
     yield
+    refresh_task.cancel()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -17,16 +30,18 @@ app = FastAPI(lifespan=lifespan)
 
 async def refresh_data():
     while True:
-        print("Refreshed data")
-        a.refresh_data()
-        refresh_done_event.set()
+        try:
+            await asyncio.to_thread(a.refresh_data)
+            snapshot_ready_event.set()
+        except Exception as e:
+            print(f"Refresh failed, the previous snapshot is still used: {e}")
         await asyncio.sleep(1800)
 
 
 # output json data
 @app.post("/routes/")
 async def run_a_star(data: dict):
-    await refresh_done_event.wait()
+    await snapshot_ready_event.wait()
     try:
         start = data.get("start")
         finish = data.get("finish")
@@ -36,7 +51,23 @@ async def run_a_star(data: dict):
         if not start or not finish:
             raise HTTPException(status_code=400, detail="Invalid input: 'graph', 'start', 'tags'.")
 
-        path = a.a_star((start["latitude"], start["longitude"]), (finish["latitude"], finish["longitude"]), 1, tags)
+        stats = dict()
+        profiler = None
+        query_start = time.perf_counter()
+        try:
+            with s.QueryProfiler() as profiler:
+                path = a.a_star((start["latitude"], start["longitude"]), (finish["latitude"], finish["longitude"]), 1,
+                                tags, stats)
+            stats["status"] = "ok" if path else "no_path"
+        except Exception as e:
+            stats["status"] = "error"
+            stats["error"] = type(e).__name__
+            raise
+        finally:
+            # the queries which raised are timed and captured too, a_star did not get to set their total time
+            stats.setdefault("total_time", time.perf_counter() - query_start)
+            m.observe_query(stats)
+            s.capture_if_slow(data, stats, a.snapshot_info(), profiler)
 
         if not path:
             print("There has been an error")
@@ -49,6 +80,30 @@ async def run_a_star(data: dict):
         raise HTTPException(status_code=500, detail="Internal issues")
 
 
+# readiness probe, 503 until a snapshot is loaded
+@app.get("/ready")
+async def ready():
+    if not snapshot_ready_event.is_set():
+        raise HTTPException(status_code=503, detail="No snapshot loaded yet")
+
+    info = a.snapshot_info()
+    now = time.time()
+    return {
+        "ready": True,
+        "snapshot_version": info["snapshot_version"],
+        "snapshot_age_seconds": now - info["weights_modified"] if info["weights_modified"] else None,
+        "loaded_seconds_ago": now - info["loaded_at"],
+        "refresh_in_progress": a.refresh_in_progress,
+    }
+
+
+# prometheus metrics of the routing
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    m.update_snapshot_gauges(a.snapshot_version, a.snapshot_loaded_at, a.last_refresh_duration)
+    return PlainTextResponse(m.render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -0,0 +1,94 @@
+import numpy as np
+import shapely
+from raster_coverage_module import grid_around
+
+"""
+Interpolated AQI surface
+The AQI samples are spread over a metric grid by inverse distance weighting, so every cell gets a value,
+the samples close to it count the most. The grid is computed once per AQI refresh (the layer cache keeps the scores),
+an edge is scored by sampling the grid every few metres along it and averaging, bilinear between the cell centres.
+"""
+
+"""
+Inverse distance weighted value at the centre of every cell
+Input: - grid: RasterGrid
+       - x, y: sample positions in metres
+       - values: sample values
+       - power: weight of a sample is 1 / distance ** power
+Output: - float64 array rows x cols
+"""
+
+
+def idw_surface(grid, x, y, values, power=2):
+    centres_x = grid.x0 + (np.arange(grid.cols) + 0.5) * grid.resolution
+    surface = np.empty((grid.rows, grid.cols))
+    # one row of cells at a time, rows x samples distances would not fit in memory on a fine grid
+    for row in range(grid.rows):
+        centre_y = grid.y0 + (row + 0.5) * grid.resolution
+        distances = np.hypot(centres_x[:, None] - x[None, :], centre_y - y[None, :])
+        # a sample inside the cell decides it, there is no distance to divide by
+        weights = 1 / np.maximum(distances, grid.resolution / 100) ** power
+        surface[row] = weights @ values / weights.sum(axis=1)
+    return surface
+
+
+"""
+Bilinear value of the surface at points, between the cell centres
+Input: - grid: RasterGrid, surface: from idw_surface
+       - x, y: points in metres, the ones outside the grid take the value of the border
+Output: - array of values
+"""
+
+
+def sample_surface(grid, surface, x, y):
+    gx = np.clip((x - grid.x0) / grid.resolution - 0.5, 0, grid.cols - 1)
+    gy = np.clip((y - grid.y0) / grid.resolution - 0.5, 0, grid.rows - 1)
+    c0 = np.minimum(np.floor(gx).astype(np.int64), grid.cols - 2) if grid.cols > 1 else np.zeros(len(x), np.int64)
+    r0 = np.minimum(np.floor(gy).astype(np.int64), grid.rows - 2) if grid.rows > 1 else np.zeros(len(y), np.int64)
+    c1 = np.minimum(c0 + 1, grid.cols - 1)
+    r1 = np.minimum(r0 + 1, grid.rows - 1)
+    fx = gx - c0
+    fy = gy - r0
+    bottom = surface[r0, c0] * (1 - fx) + surface[r0, c1] * fx
+    top = surface[r1, c0] * (1 - fx) + surface[r1, c1] * fx
+    return bottom * (1 - fy) + top * fy
+
+
+"""
+Mean of the surface along every edge
+Input: - edges: array of edge geometries in metres
+       - grid, surface
+       - spacing: metres between the sampled points, every edge gets at least one in its middle
+Output: - array with the mean value of every edge
+"""
+
+
+def edge_means(edges, grid, surface, spacing):
+    lengths = shapely.length(edges)
+    counts = np.maximum(np.ceil(lengths / spacing), 1).astype(np.int64)
+    edge_of_sample = np.repeat(np.arange(len(edges)), counts)
+    offsets = np.cumsum(counts) - counts
+    # the middle of equal pieces of the edge
+    fractions = (np.arange(counts.sum()) - offsets[edge_of_sample] + 0.5) / counts[edge_of_sample]
+    points = shapely.line_interpolate_point(edges[edge_of_sample], fractions, normalized=True)
+    values = sample_surface(grid, surface, shapely.get_x(points), shapely.get_y(points))
+    return np.bincount(edge_of_sample, weights=values, minlength=len(edges)) / counts
+
+
+"""
+AQI score of every edge from the interpolated surface
+Input: - edges: array of edge geometries in metres
+       - x, y: AQI sample positions in metres
+       - values: aqi of every sample
+       - resolution: side of a grid cell in metres
+       - power: idw power
+       - spacing: metres between the points sampled along an edge
+Output: - array with the score of every edge
+"""
+
+
+def idw_edge_scores(edges, x, y, values, resolution, power, spacing):
+    grid = grid_around(edges, 0, resolution)
+    surface = idw_surface(grid, np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64),
+                          np.asarray(values, dtype=np.float64), power)
+    return edge_means(edges, grid, surface, spacing)
@@ -0,0 +1,100 @@
+import json
+from array import array
+import numpy as np
+import traffic_store_module as ts
+
+try:
+    import ijson
+    IJSON_AVAILABLE = True
+except ImportError:
+    IJSON_AVAILABLE = False
+
+"""
+Streaming reader of the waze feed
+The jams and alerts arrays are read event by event straight into typed buffers (array.array),
+the document is never held in memory as python dictionaries. Without ijson the feed is loaded whole.
+The columns are the ones of traffic_store_module: jam_columns and alert_columns.
+"""
+
+"""
+Reads the feed event by event
+Input: - file: feed opened in binary mode
+Output: - jam columns, alert columns
+"""
+
+
+def _stream_columns(file):
+    jam_x, jam_y, jam_of_point = array("d"), array("d"), array("q")
+    level, length, roadtype = array("q"), array("d"), array("q")
+    alert_x, alert_y, alert_type = array("d"), array("d"), []
+    reliability, confidence = array("q"), array("q")
+
+    for prefix, event, value in ijson.parse(file, use_float=True):
+        if prefix == "jams.item.line.item.x":
+            jam_x.append(value)
+            jam_of_point.append(len(level) - 1)
+        elif prefix == "jams.item.line.item.y":
+            jam_y.append(value)
+        elif prefix == "jams.item" and event == "start_map":
+            level.append(0)
+            length.append(0)
+            roadtype.append(-1)
+        elif prefix == "jams.item.level":
+            level[-1] = value
+        elif prefix == "jams.item.length":
+            length[-1] = value
+        elif prefix == "jams.item.roadType":
+            roadtype[-1] = value
+        elif prefix == "alerts.item" and event == "start_map":
+            alert_x.append(np.nan)
+            alert_y.append(np.nan)
+            alert_type.append("")
+            reliability.append(0)
+            confidence.append(0)
+        elif prefix == "alerts.item.location.x":
+            alert_x[-1] = value
+        elif prefix == "alerts.item.location.y":
+            alert_y[-1] = value
+        elif prefix == "alerts.item.type":
+            alert_type[-1] = value
+        elif prefix == "alerts.item.reliability":
+            reliability[-1] = value
+        elif prefix == "alerts.item.confidence":
+            confidence[-1] = value
+
+    jams = {
+        "x": np.frombuffer(jam_x, dtype=np.float64),
+        "y": np.frombuffer(jam_y, dtype=np.float64),
+        "jam_of_point": np.frombuffer(jam_of_point, dtype=np.int64),
+        "level": np.frombuffer(level, dtype=np.int64),
+        "length": np.frombuffer(length, dtype=np.float64),
+        "roadtype": np.frombuffer(roadtype, dtype=np.int64),
+    }
+    alerts = {
+        "x": np.frombuffer(alert_x, dtype=np.float64),
+        "y": np.frombuffer(alert_y, dtype=np.float64),
+        "type": np.array(alert_type, dtype=str),
+        "reliability": np.frombuffer(reliability, dtype=np.int64),
+        "confidence": np.frombuffer(confidence, dtype=np.int64),
+    }
+    return jams, alerts
+
+
+"""
+Reads a saved feed into columns
+Input: - path of the feed
+Output: - jam columns, alert columns, ValueError when the file is not valid json
+"""
+
+
+def read_feed(path):
+    if IJSON_AVAILABLE:
+        with open(path, "rb") as file:
+            try:
+                return _stream_columns(file)
+            except ijson.JSONError as e:
+                raise ValueError(f"Invalid feed {path}: {e}") from e
+
+    with open(path, "r") as file:
+        data = json.load(file)
+    return ts.jam_columns(data.get("jams", [])), ts.alert_columns(data.get("alerts", []))
@@ -0,0 +1,296 @@
+from shapely.geometry import LineString
+from random import uniform
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+# Columns which are summed when edges are merged, A* adds them up edge by edge
+SCORE_COLUMNS = ['traffic', 'tree_vs_urban_score', 'tree_cover_score', 'water_score', 'AQI_score']
+
+"""
+Undirected adjacency of the (u,v) indexed edge dataframe, self loops are left out
+Input: - gdf_reset indexed by u,v
+Output: - dictionary node id: set of neighbour ids
+"""
+
+
+def undirected_adjacency(gdf_reset):
+    adjacency = dict()
+    for u, v in gdf_reset.index:
+        adjacency.setdefault(u, set())
+        adjacency.setdefault(v, set())
+        if u != v:
+            adjacency[u].add(v)
+            adjacency[v].add(u)
+    return adjacency
+
+
+"""
+Coordinates of an edge geometry oriented from node u to node v
+Input: - geometry of the edge
+       - (y,x) of u
+"""
+
+
+def oriented_coords(geometry, yx_u):
+    coords = list(geometry.coords)
+    first = coords[0]
+    last = coords[-1]
+    distance_first = (first[0] - yx_u[1]) ** 2 + (first[1] - yx_u[0]) ** 2
+    distance_last = (last[0] - yx_u[1]) ** 2 + (last[1] - yx_u[0]) ** 2
+    if distance_last < distance_first:
+        coords.reverse()
+    return coords
+
+
+def _edge_row(gdf_reset, u, v):
+    if (u, v) in gdf_reset.index:
+        row = gdf_reset.loc[(u, v)]
+    else:
+        row = gdf_reset.loc[(v, u)]
+    # parallels are cleared before, but stay safe if a pair is still doubled
+    if isinstance(row, pd.DataFrame):
+        row = row.iloc[0]
+    return row
+
+
+"""
+Walks from an anchor node through degree-2 nodes until the next anchor
+Input: - anchor, first step
+       - adjacency, removable (nodes of degree 2)
+Output: - list of node ids from anchor to the end of the chain
+"""
+
+
+def walk_chain(anchor, first, adjacency, removable):
+    chain = [anchor]
+    previous = anchor
+    current = first
+    while current in removable and current != anchor:
+        chain.append(current)
+        following = [node for node in adjacency[current] if node != previous][0]
+        previous = current
+        current = following
+    chain.append(current)
+    return chain
+
+
+"""
+Merges the edges of a chain into a single row
+Input: - chain of node ids
+       - gdf_reset, dict_id_yx
+Output: - dictionary with the values of the merged edge
+"""
+
+
+def merge_chain(chain, gdf_reset, dict_id_yx):
+    rows = [_edge_row(gdf_reset, chain[i], chain[i + 1]) for i in range(len(chain) - 1)]
+    lengths = [row["length"] for row in rows]
+    total_length = sum(lengths)
+
+    merged = rows[0].to_dict()
+    merged["length"] = total_length
+    # the scores are costs of a whole edge, the merged edge costs what its segments cost together
+    for column in SCORE_COLUMNS:
+        if column in merged:
+            merged[column] = sum(row[column] for row in rows)
+
+    coords = []
+    for i, row in enumerate(rows):
+        segment = oriented_coords(row["geometry"], dict_id_yx[chain[i]])
+        coords.extend(segment if not coords else segment[1:])
+    merged["geometry"] = LineString(coords)
+    return merged
+
+
+"""
+Degree-2 contraction
+Chains of nodes which only connect two other nodes are merged into a single edge,
+so A* expands one edge instead of every node on a long footpath.
+Length and scores are summed, so a merged edge costs the same as the chain it replaces,
+and the geometry is concatenated, so snapping onto the merged edge still works.
+A chain is left as it is if merging would create a loop or a parallel edge.
+Input: - gdf_reset indexed by u,v
+       - dict_neighbours, dict_id_yx
+Output: - gdf_reset with the merged edges
+        - dict_neighbours of the compacted graph
+        - dict_chain_nodes: (u,v) of a merged edge: the removed node ids from u to v
+"""
+
+
+def contract_degree_two(gdf_reset, dict_neighbours, dict_id_yx):
+    adjacency = undirected_adjacency(gdf_reset)
+    removable = {node for node, neighbours in adjacency.items() if len(neighbours) == 2}
+
+    existing_pairs = {frozenset(pair) for pair in gdf_reset.index}
+    visited_pairs = set()
+    merged_rows = []
+    merged_index = []
+    dict_chain_nodes = dict()
+    removed_nodes = set()
+    endpoint_through = dict()
+
+    for anchor, neighbours in adjacency.items():
+        if anchor in removable:
+            continue
+        for first in neighbours:
+            if frozenset((anchor, first)) in visited_pairs:
+                continue
+            chain = walk_chain(anchor, first, adjacency, removable)
+            for i in range(len(chain) - 1):
+                visited_pairs.add(frozenset((chain[i], chain[i + 1])))
+
+            end = chain[-1]
+            if len(chain) == 2 or end == anchor or frozenset((anchor, end)) in existing_pairs:
+                continue
+            existing_pairs.add(frozenset((anchor, end)))
+
+            merged_rows.append(merge_chain(chain, gdf_reset, dict_id_yx))
+            merged_index.append((anchor, end))
+            dict_chain_nodes[(anchor, end)] = chain[1:-1]
+            removed_nodes.update(chain[1:-1])
+            endpoint_through[(anchor, chain[1])] = end
+            endpoint_through[(end, chain[-2])] = anchor
+
+    kept = gdf_reset[[u not in removed_nodes and v not in removed_nodes for u, v in gdf_reset.index]]
+    merged = gpd.GeoDataFrame(merged_rows, index=pd.MultiIndex.from_tuples(merged_index, names=['u', 'v']),
+                              columns=gdf_reset.columns, geometry="geometry", crs=gdf_reset.crs)
+    compacted = pd.concat([kept, merged]).sort_index()
+
+    compacted_neighbours = dict()
+    for node, neighbours in dict_neighbours.items():
+        if node in removed_nodes:
+            continue
+        compacted_neighbours[node] = [endpoint_through.get((node, neighbour), neighbour) for neighbour in neighbours
+                                      if neighbour not in removed_nodes or (node, neighbour) in endpoint_through]
+
+    return compacted, compacted_neighbours, dict_chain_nodes
+
+
+"""
+Node ids removed between u and v, in the order from u to v
+"""
+
+
+def chain_between(u, v, dict_chain_nodes):
+    if (u, v) in dict_chain_nodes:
+        return dict_chain_nodes[(u, v)]
+    if (v, u) in dict_chain_nodes:
+        return dict_chain_nodes[(v, u)][::-1]
+    return []
+
+
+"""
+Where the removed nodes sit on their merged edges
+A query can start or end on a removed node, the search then enters the merged edge part way along.
+Input: - compiled: CompiledGraph of the contracted edges
+       - gdf_before: edges before the contraction, indexed by u,v
+       - dict_chain_nodes
+       - columns: value columns of the compiled edges
+Output: - dictionary removed node id: (edge, index of u, index of v, removed nodes from u to v,
+          position of the node in them, values of the chain from u to the node)
+"""
+
+
+def chain_positions(compiled, gdf_before, dict_chain_nodes, columns):
+    row_of_pair = {pair: row for row, pair in enumerate(gdf_before.index)}
+    values = gdf_before[columns].to_numpy(dtype=np.float64)
+    positions = dict()
+    for (u, v), removed in dict_chain_nodes.items():
+        u_index = compiled.index_of[u]
+        v_index = compiled.index_of[v]
+        edge = next((edge for neighbour, edge in compiled.adjacency[u_index] if neighbour == v_index), None)
+        if edge is None:
+            continue
+        nodes = [u] + removed + [v]
+        prefix = np.zeros(len(columns))
+        for position, node in enumerate(removed):
+            a, b = nodes[position], nodes[position + 1]
+            prefix = prefix + values[row_of_pair.get((a, b), row_of_pair.get((b, a)))]
+            positions[node] = (edge, u_index, v_index, removed, position, prefix.tolist())
+    return positions
+
+
+"""
+Node and edge counts before and after the compaction
+"""
+
+
+def compaction_report(gdf_before, neighbours_before, gdf_after, neighbours_after):
+    nodes_before = len(neighbours_before)
+    nodes_after = len(neighbours_after)
+    edges_before = len(gdf_before)
+    edges_after = len(gdf_after)
+    report = {
+        "nodes_before": nodes_before,
+        "nodes_after": nodes_after,
+        "node_reduction": 1 - nodes_after / nodes_before if nodes_before else 0,
+        "edges_before": edges_before,
+        "edges_after": edges_after,
+        "edge_reduction": 1 - edges_after / edges_before if edges_before else 0,
+    }
+    print(f"Nodes: {nodes_before} -> {nodes_after} ({report['node_reduction']:.1%} less)")
+    print(f"Edges: {edges_before} -> {edges_after} ({report['edge_reduction']:.1%} less)")
+    return report
+
+
+"""
+Latency, paths and costs of the same random queries on the full and on the compacted graph
+The compaction must not change the routes, only the time to find them.
+Input: number_of_queries
+"""
+
+
+def benchmark_compaction(number_of_queries):
+    import a_star_module as a
+
+    bounding_box = {
+        "min_lat": 46.7300,
+        "max_lat": 46.8000,
+        "min_lon": 23.5000,
+        "max_lon": 23.7100,
+    }
+    queries = []
+    for _ in range(number_of_queries):
+        start = (uniform(bounding_box["min_lat"], bounding_box["max_lat"]),
+                 uniform(bounding_box["min_lon"], bounding_box["max_lon"]))
+        end = (uniform(bounding_box["min_lat"], bounding_box["max_lat"]),
+               uniform(bounding_box["min_lon"], bounding_box["max_lon"]))
+        queries.append((start, end))
+
+    results = dict()
+    routes = dict()
+    for contract in (False, True):
+        a.CONTRACT_DEGREE_TWO = contract
+        a.load_snapshot()
+        timings = []
+        expanded = []
+        routes[contract] = []
+        for start, end in queries:
+            stats = dict()
+            routes[contract].append(a.a_star(start, end, 0, [], stats))
+            timings.append(stats["total_time"])
+            expanded.append(stats.get("nodes_expanded", 0))
+        timings.sort()
+        results[contract] = (timings[len(timings) // 2], sum(timings) / len(timings), sum(expanded) / len(expanded))
+
+    for contract, (median, mean, mean_expanded) in results.items():
+        name = "compacted" if contract else "full"
+        print(f"{name:>10}: median {median * 1000:.1f} ms, mean {mean * 1000:.1f} ms, "
+              f"{mean_expanded:.0f} nodes expanded on average")
+
+    same_paths = 0
+    cost_differences = []
+    for full, compacted in zip(routes[False], routes[True]):
+        if full is None or compacted is None:
+            same_paths = same_paths + (full is None and compacted is None)
+            continue
+        same_paths = same_paths + (full[0] == compacted[0])
+        cost_differences.append(abs(full[1] - compacted[1]) / max(abs(full[1]), 1e-9))
+    print(f"Same path on {same_paths} of {len(queries)} queries, "
+          f"largest cost difference {max(cost_differences, default=0):.2e} (relative)")
+    return results
+
+
+if __name__ == "__main__":
+    benchmark_compaction(50)
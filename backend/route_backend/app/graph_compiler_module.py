@@ -0,0 +1,260 @@
+from collections import deque
+from random import uniform
+import numpy as np
+import time
+
+# Values of an edge in the order the tag weights use them
+VALUE_COLUMNS = ['length', 'traffic', 'tree_vs_urban_score', 'tree_cover_score', 'water_score', 'AQI_score']
+TRAFFIC = VALUE_COLUMNS.index('traffic')
+# Bits per axis of the hilbert curve
+HILBERT_ORDER = 16
+
+"""
+Graph compiled into arrays, the nodes are renumbered 0..n-1 so the search keeps its scores in lists
+instead of dictionaries keyed by OSM id, and so nodes close on the map get close numbers.
+node_ids is the side table back to the OSM ids.
+The adjacency is in CSR form: the neighbours of node i are neighbours[indptr[i]:indptr[i+1]]
+and edge_of gives the row of that edge in edge_values, edge_rows the row of the edge in the compiled dataframe.
+The search walks adjacency, the same rows as python lists of (neighbour, edge). Those lists and the coordinate
+and score lists are built in node order, so with a hilbert or bfs order the objects of the nodes a search
+touches one after the other were also allocated next to each other, benchmark_orders measures what it gives.
+With the traffic history attached, a query prices traffic with the column of the current weekday and hour.
+"""
+
+
+class CompiledGraph:
+    def __init__(self, node_ids, lat, lon, indptr, neighbours, edge_of, edge_values, order, edge_rows=None):
+        self.node_ids = node_ids
+        self.lat = lat
+        self.lon = lon
+        self.indptr = indptr
+        self.neighbours = neighbours
+        self.edge_of = edge_of
+        self.edge_values = edge_values
+        self.order = order
+        self.edge_rows = edge_rows
+        self.traffic_history = None
+        # removed node id: where it sits on its merged edge, see chain_positions
+        self.chain_of = dict()
+        self.index_of = {node_id: index for index, node_id in enumerate(node_ids.tolist())}
+
+        # plain python lists are faster than numpy scalars inside the search loop
+        self.node_ids_list = node_ids.tolist()
+        self.lat_list = lat.tolist()
+        self.lon_list = lon.tolist()
+        self.adjacency = [list(zip(neighbours[indptr[i]:indptr[i + 1]].tolist(),
+                                   edge_of[indptr[i]:indptr[i + 1]].tolist()))
+                          for i in range(len(node_ids))]
+
+    """
+    Cost of every edge for the weights of a query
+    Input: w - weights from set_tags
+           traffic_column - traffic of the query from select_traffic, None for the static traffic
+    Output: list with a cost per edge row
+    """
+
+    def edge_costs(self, w, traffic_column=None):
+        # column by column, so the sum is done in the same order as heuristic()
+        costs = np.zeros(len(self.edge_values), dtype=np.float64)
+        for i in range(len(VALUE_COLUMNS)):
+            if i == TRAFFIC and traffic_column is not None:
+                costs = costs + traffic_column * w[i]
+            else:
+                costs = costs + self.edge_values[:, i] * w[i]
+        return costs.tolist()
+
+    """
+    Traffic by weekday and hour
+    Input: traffic_history - TrafficHistory of the compiled edges
+    """
+
+    def set_traffic_history(self, traffic_history):
+        self.traffic_history = traffic_history
+
+    """
+    Traffic of a moment, picked for the query, the graph is shared by every query and is not changed
+    Input: now - unix time
+    Output: - traffic column, traffic of the prefixes of the merged edges and bucket, None for all three without history
+    """
+
+    def select_traffic(self, now):
+        if self.traffic_history is None:
+            return None, None, None
+        return self.traffic_history.select(now)
+
+
+"""
+Position of each point on a hilbert curve over the bounding box of the points
+Input: - x, y arrays
+Output: - int64 array, close positions mean close points
+"""
+
+
+def hilbert_index(x, y, order=HILBERT_ORDER):
+    side = 1 << order
+    span_x = max(x.max() - x.min(), 1e-12)
+    span_y = max(y.max() - y.min(), 1e-12)
+    xi = ((x - x.min()) / span_x * (side - 1)).astype(np.int64)
+    yi = ((y - y.min()) / span_y * (side - 1)).astype(np.int64)
+
+    d = np.zeros(len(x), dtype=np.int64)
+    s = side >> 1
+    while s > 0:
+        rx = (xi & s) > 0
+        ry = (yi & s) > 0
+        d += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+        # rotate the quadrant
+        flip = ~ry & rx
+        xi = np.where(flip, side - 1 - xi, xi)
+        yi = np.where(flip, side - 1 - yi, yi)
+        swap = ~ry
+        xi, yi = np.where(swap, yi, xi), np.where(swap, xi, yi)
+        s >>= 1
+    return d
+
+
+"""
+Breadth first order of the nodes, every component starts from its first node in load order
+Input: - node ids in load order, dict_neighbours
+Output: - node ids in bfs order
+"""
+
+
+def bfs_order(node_ids, dict_neighbours):
+    seen = set()
+    order = []
+    for root in node_ids:
+        if root in seen:
+            continue
+        seen.add(root)
+        queue = deque([root])
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for neighbour in dict_neighbours.get(node, []):
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    queue.append(neighbour)
+    return order
+
+
+"""
+Compiles the snapshot into a CompiledGraph
+Input: - gdf_reset indexed by u,v with the normalized scores
+       - dict_neighbours, dict_id_yx
+       - order: hilbert, bfs or load (the order the nodes came from the graphml)
+Output: - CompiledGraph
+"""
+
+
+def compile_graph(gdf_reset, dict_neighbours, dict_id_yx, order="hilbert"):
+    load_order = list(dict_neighbours.keys())
+    known = set(load_order)
+    for neighbours in dict_neighbours.values():
+        for neighbour in neighbours:
+            if neighbour not in known:
+                known.add(neighbour)
+                load_order.append(neighbour)
+
+    if order == "hilbert":
+        lat = np.array([dict_id_yx[node][0] for node in load_order])
+        lon = np.array([dict_id_yx[node][1] for node in load_order])
+        permutation = np.argsort(hilbert_index(lon, lat), kind="stable")
+        ordered = [load_order[i] for i in permutation]
+    elif order == "bfs":
+        ordered = bfs_order(load_order, dict_neighbours)
+    else:
+        ordered = load_order
+
+    index_of = {node: index for index, node in enumerate(ordered)}
+    row_of_pair = {pair: row for row, pair in enumerate(gdf_reset.index)}
+    values = gdf_reset[VALUE_COLUMNS].to_numpy(dtype=np.float64)
+
+    # edges are renumbered in the order they are first reached from the renumbered nodes
+    edge_rows = []
+    new_edge_of_row = dict()
+    indptr = [0]
+    neighbours_array = []
+    edge_of = []
+    for node in ordered:
+        for neighbour in dict_neighbours.get(node, []):
+            row = row_of_pair.get((node, neighbour), row_of_pair.get((neighbour, node)))
+            # the search can not price an edge without a row, so it is left out
+            if row is None:
+                continue
+            if row not in new_edge_of_row:
+                new_edge_of_row[row] = len(edge_rows)
+                edge_rows.append(row)
+            neighbours_array.append(index_of[neighbour])
+            edge_of.append(new_edge_of_row[row])
+        indptr.append(len(neighbours_array))
+
+    node_ids = np.array(ordered, dtype=np.int64)
+    return CompiledGraph(
+        node_ids=node_ids,
+        lat=np.array([dict_id_yx[node][0] for node in ordered], dtype=np.float64),
+        lon=np.array([dict_id_yx[node][1] for node in ordered], dtype=np.float64),
+        indptr=np.array(indptr, dtype=np.int64),
+        neighbours=np.array(neighbours_array, dtype=np.int32),
+        edge_of=np.array(edge_of, dtype=np.int32),
+        edge_values=np.ascontiguousarray(values[edge_rows]),
+        order=order,
+        edge_rows=np.array(edge_rows, dtype=np.int64),
+    )
+
+
+"""
+How far apart in memory the two ends of an edge are, lower is more cache friendly.
+Output: - mean and 90th percentile of |i - j| over the adjacency
+"""
+
+
+def neighbour_gap(compiled):
+    sources = np.repeat(np.arange(len(compiled.node_ids)), np.diff(compiled.indptr))
+    gaps = np.abs(sources - compiled.neighbours)
+    if len(gaps) == 0:
+        return 0, 0
+    return float(gaps.mean()), float(np.percentile(gaps, 90))
+
+
+"""
+Compares the node orders on the same random queries.
+The index gap between neighbours is reported as a stand in for cache misses,
+run it under `perf stat -e cache-misses` for the hardware counters.
+The heap breaks ties by OSM id, so every order has to give the same paths and costs, it is checked here.
+Input: number_of_queries
+"""
+
+
+def benchmark_orders(number_of_queries):
+    import a_star_module as a
+
+    queries = []
+    for _ in range(number_of_queries):
+        queries.append(((uniform(46.7300, 46.8000), uniform(23.5000, 23.7100)),
+                        (uniform(46.7300, 46.8000), uniform(23.5000, 23.7100))))
+
+    expected = None
+    for order in ("load", "bfs", "hilbert"):
+        a.GRAPH_ORDER = order
+        a.load_snapshot()
+        compiled = a.get_resources()[-1]
+        mean_gap, p90_gap = neighbour_gap(compiled)
+        search_times = []
+        routes = []
+        for start, end in queries:
+            stats = dict()
+            routes.append(a.a_star(start, end, 0, [], stats))
+            search_times.append(stats.get("search_time", 0))
+        if expected is None:
+            expected = routes
+        search_times.sort()
+        print(f"{order:>8}: neighbour gap mean {mean_gap:.0f} p90 {p90_gap:.0f}, "
+              f"search median {search_times[len(search_times) // 2] * 1000:.2f} ms, "
+              f"total {sum(search_times):.3f} s, same routes {routes == expected}")
+
+
+if __name__ == "__main__":
+    start_time = time.perf_counter()
+    benchmark_orders(50)
+    print(f"Benchmark took {time.perf_counter() - start_time:.1f}s")
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import shapely
+from shapely.strtree import STRtree
+
+MATCH_CACHE = "../resources/layer_cache/jam_matches.json"
+# Jam lines not seen for this many seconds are dropped from the cache
+MATCH_RETENTION = 7 * 24 * 60 * 60
+# Decimals of the coordinates kept when a jam line is hashed, waze sends 6
+COORDINATE_DECIMALS = 6
+
+"""
+Jam to edge map matching
+Waze reports the same jam lines again and again, so the edges a line matches are kept on disk by a hash of the line.
+A refresh only does geometry work for lines it did not see before, the others just get their new level.
+The cache belongs to one edge set and one threshold, it is emptied when either changes.
+"""
+
+"""
+Hash of a jam line, the same for both directions of the line
+Input: - x, y: coordinates of the line in EPSG 4326
+Output: - hex digest
+"""
+
+
+def line_hash(x, y):
+    coords = np.round(np.column_stack((x, y)) * 10 ** COORDINATE_DECIMALS).astype(np.int64)
+    forward = coords.tobytes()
+    backward = coords[::-1].tobytes()
+    return hashlib.sha1(min(forward, backward)).hexdigest()
+
+
+"""
+Edges matched by jam lines, same rule as calculate_traffic_score:
+the bounding box of the edge buffered by threshold touches the bounding box of the line.
+Input: - jam_lines: array of lines in metres
+       - edges: array of edge geometries in metres
+       - threshold: buffer around the edges in metres
+Output: - for every line: list of edge positions, list of overlap fractions
+          (share of the edge length within threshold of the line)
+"""
+
+
+def match_lines(jam_lines, edges, threshold):
+    bounds = shapely.bounds(jam_lines)
+    # edge bbox grown by threshold always holds the bbox of the buffer, so this is a superset of the matches
+    boxes = shapely.box(bounds[:, 0] - threshold, bounds[:, 1] - threshold,
+                        bounds[:, 2] + threshold, bounds[:, 3] + threshold)
+    line_ids, edge_ids = STRtree(edges).query(boxes)
+
+    buffer_bounds = shapely.bounds(shapely.buffer(edges[edge_ids], threshold, quad_segs=16))
+    line_bounds = bounds[line_ids]
+    touching = ((buffer_bounds[:, 0] <= line_bounds[:, 2]) & (buffer_bounds[:, 2] >= line_bounds[:, 0]) &
+                (buffer_bounds[:, 1] <= line_bounds[:, 3]) & (buffer_bounds[:, 3] >= line_bounds[:, 1]))
+    line_ids = line_ids[touching]
+    edge_ids = edge_ids[touching]
+
+    near_line = shapely.buffer(jam_lines, threshold, quad_segs=16)
+    overlap_length = shapely.length(shapely.intersection(edges[edge_ids], near_line[line_ids]))
+    edge_length = shapely.length(edges[edge_ids])
+    overlaps = np.divide(overlap_length, edge_length, out=np.zeros(len(edge_ids)), where=edge_length > 0)
+
+    matches = [([], []) for _ in range(len(jam_lines))]
+    for line, edge, overlap in zip(line_ids.tolist(), edge_ids.tolist(), overlaps.tolist()):
+        matches[line][0].append(edge)
+        matches[line][1].append(overlap)
+    return matches
+
+
+def _read_cache(edge_set, threshold):
+    if os.path.exists(MATCH_CACHE):
+        with open(MATCH_CACHE, "r") as file:
+            cache = json.load(file)
+        if cache["edges"] == edge_set and cache["threshold"] == threshold:
+            return cache
+    return {"edges": edge_set, "threshold": threshold, "matches": dict()}
+
+
+def _write_cache(cache):
+    os.makedirs(os.path.dirname(MATCH_CACHE), exist_ok=True)
+    temporary_path = MATCH_CACHE + ".tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(cache, file)
+    os.replace(temporary_path, MATCH_CACHE)
+
+
+"""
+Matches every jam to the edges, from the cache when the line was seen before
+Input: - x, y: coordinates of the jam points in EPSG 4326, one jam after the other
+       - jam_of_point: index of the jam of every point
+       - project: function from x, y arrays in EPSG 4326 to x, y in the metres of the edges
+       - edges: array of edge geometries in metres
+       - edge_set: hash of the edges, the cache is thrown away when it changes
+       - threshold: buffer around the edges in metres
+Output: - jam_ids, edge_ids, overlaps: one entry per matched (jam, edge) pair
+"""
+
+
+def matched_pairs(x, y, jam_of_point, project, edges, edge_set, threshold):
+    cache = _read_cache(edge_set, threshold)
+    now = time.time()
+
+    starts = np.searchsorted(jam_of_point, np.arange(jam_of_point.max() + 1 if len(jam_of_point) else 0))
+    ends = np.append(starts[1:], len(jam_of_point))
+    keys = [line_hash(x[start:end], y[start:end]) for start, end in zip(starts, ends)]
+
+    # a line repeated in the jams (or in the snapshots of a history rebuild) is matched once
+    first_jam = dict()
+    for jam, key in enumerate(keys):
+        if key not in cache["matches"]:
+            first_jam.setdefault(key, jam)
+    missing = list(first_jam.values())
+    if missing:
+        points = np.concatenate([np.arange(starts[jam], ends[jam]) for jam in missing])
+        line_of_point = np.repeat(np.arange(len(missing)), ends[missing] - starts[missing])
+        x_m, y_m = project(x[points], y[points])
+        missing_lines = shapely.linestrings(x_m, y_m, indices=line_of_point)
+        for jam, (edge_list, overlap_list) in zip(missing, match_lines(missing_lines, edges, threshold)):
+            cache["matches"][keys[jam]] = {"edges": edge_list, "overlaps": overlap_list}
+    print(f"Jams matched: {len(keys)} jams, {len(missing)} new lines")
+
+    jam_ids = []
+    edge_ids = []
+    overlaps = []
+    for jam, key in enumerate(keys):
+        match = cache["matches"][key]
+        match["seen"] = now
+        jam_ids.extend([jam] * len(match["edges"]))
+        edge_ids.extend(match["edges"])
+        overlaps.extend(match["overlaps"])
+
+    cache["matches"] = {key: match for key, match in cache["matches"].items()
+                        if now - match["seen"] < MATCH_RETENTION}
+    _write_cache(cache)
+    return np.array(jam_ids, dtype=np.int64), np.array(edge_ids, dtype=np.int64), np.array(overlaps)
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import shapely
+
+LAYER_CACHE_DIRECTORY = "../resources/layer_cache/"
+
+# path: (size, mtime, content hash), so an unchanged file is not read again
+_file_hashes = dict()
+
+"""
+Hash of the content of a file
+Input: - path of the file
+Output: - hex digest, "missing" if the file does not exist
+"""
+
+
+def file_hash(path):
+    if not os.path.exists(path):
+        return "missing"
+    stat = os.stat(path)
+    known = _file_hashes.get(path)
+    if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+        return known[2]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    _file_hashes[path] = (stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+    return digest.hexdigest()
+
+
+"""
+Hash of the edge set, the index and the geometry of every edge
+Input: - index: (u,v,key) of every edge
+       - edges: array of edge geometries
+Output: - hex digest
+"""
+
+
+def edges_hash(index, edges):
+    digest = hashlib.sha256()
+    digest.update(np.asarray(list(index), dtype=np.int64).tobytes())
+    for wkb in shapely.to_wkb(edges):
+        digest.update(wkb)
+    return digest.hexdigest()
+
+
+"""
+Key of a computed column
+Input: - column: name of the layer
+       - input_files: paths the layer reads
+       - edge_set: edges_hash of the graph
+       - parameters: thresholds, radii... as a json serializable dictionary
+Output: - hex digest
+"""
+
+
+def layer_key(column, input_files, edge_set, parameters):
+    description = {
+        "column": column,
+        "inputs": {path: file_hash(path) for path in input_files},
+        "edges": edge_set,
+        "parameters": parameters,
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def _paths(column):
+    base_path = os.path.join(LAYER_CACHE_DIRECTORY, column)
+    return base_path + ".npy", base_path + ".json"
+
+
+"""
+Description of the cached column
+Output: - dictionary with key, edges and computed_at, None if the column was never cached
+"""
+
+
+def cached_entry(column):
+    scores_path, meta_path = _paths(column)
+    if not os.path.exists(scores_path) or not os.path.exists(meta_path):
+        return None
+    with open(meta_path, "r") as file:
+        return json.load(file)
+
+
+"""
+Is the cached column good enough to use
+Only a column computed with the same key on the same edges can be used, a changed input is always recomputed.
+A column with a ttl is recomputed once it is older than the ttl, even with the same key.
+Input: - column, key, edge_set
+       - ttl: seconds or None, None means the column is used as long as the key does not change
+Output: True, False
+"""
+
+
+def is_fresh(column, key, edge_set, ttl=None):
+    entry = cached_entry(column)
+    if entry is None or entry["edges"] != edge_set or entry["key"] != key:
+        return False
+    return ttl is None or time.time() - entry["computed_at"] < ttl
+
+
+"""
+Reads a cached column
+Output: - score array
+"""
+
+
+def load_layer(column):
+    scores_path, _ = _paths(column)
+    return np.load(scores_path)
+
+
+"""
+Saves a computed column with its key and the edges it was computed on
+"""
+
+
+def save_layer(column, key, edge_set, scores):
+    os.makedirs(LAYER_CACHE_DIRECTORY, exist_ok=True)
+    scores_path, meta_path = _paths(column)
+
+    # written next to the old files and swapped, a crash never leaves a half written column
+    with open(scores_path + ".tmp", "wb") as file:
+        np.save(file, np.asarray(scores))
+    with open(meta_path + ".tmp", "w") as file:
+        json.dump({"key": key, "edges": edge_set, "computed_at": time.time()}, file)
+    os.replace(scores_path + ".tmp", scores_path)
+    os.replace(meta_path + ".tmp", meta_path)
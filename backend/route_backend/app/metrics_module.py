@@ -0,0 +1,191 @@
+import os
+import threading as th
+import time
+
+_lock = th.Lock()
+_histograms = dict()
+_gauges = dict()
+_counters = dict()
+
+# Buckets in seconds for the timing histograms
+TIME_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+# Buckets for the counting histograms (nodes expanded, heap pushes, path points)
+COUNT_BUCKETS = [10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000, 500000]
+
+"""
+Every histogram which is exported.
+key: metric name
+values: help text, buckets, name of the field in the query stats
+"""
+QUERY_HISTOGRAMS = {
+    "routing_snap_seconds": ("Time spent snapping start and finish onto the graph", TIME_BUCKETS, "snap_time"),
+    "routing_search_seconds": ("Time spent in the A* search loop", TIME_BUCKETS, "search_time"),
+    "routing_reconstruction_seconds": ("Time spent rebuilding the path from came_from", TIME_BUCKETS,
+                                       "reconstruction_time"),
+    "routing_serialization_seconds": ("Time spent turning the path into json", TIME_BUCKETS,
+                                      "serialization_time"),
+    "routing_query_seconds": ("Total time of a route query", TIME_BUCKETS, "total_time"),
+    "routing_nodes_expanded": ("Nodes popped from the open set per query", COUNT_BUCKETS, "nodes_expanded"),
+    "routing_heap_pushes": ("Pushes into the open set per query", COUNT_BUCKETS, "heap_pushes"),
+    "routing_path_points": ("Points in the returned path", COUNT_BUCKETS, "path_length"),
+}
+
+"""
+Histogram with cumulative buckets, same as the prometheus one.
+"""
+
+
+class Histogram:
+    def __init__(self, help_text, buckets):
+        self.help_text = help_text
+        self.buckets = list(buckets)
+        self.counts = [0 for _ in self.buckets]
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] = self.counts[i] + 1
+        self.total = self.total + value
+        self.count = self.count + 1
+
+
+def _get_histogram(name, help_text, buckets):
+    if name not in _histograms:
+        _histograms[name] = Histogram(help_text, buckets)
+    return _histograms[name]
+
+
+"""
+Sets a gauge to a value
+Input: - name of the gauge
+       - help text shown in /metrics
+       - value
+"""
+
+
+def set_gauge(name, help_text, value):
+    with _lock:
+        _gauges[name] = (help_text, value)
+
+
+"""
+Increments a counter
+Input: - labels: dictionary label name: value, every set of labels is counted apart
+"""
+
+
+def inc_counter(name, help_text, amount=1, labels=None):
+    key = (name, tuple(sorted(labels.items())) if labels else ())
+    with _lock:
+        previous = _counters.get(key, (help_text, 0))[1]
+        _counters[key] = (help_text, previous + amount)
+
+
+"""
+Feeds the stats of one query into the histograms.
+The queries are counted by status: ok, no_path or error, the errors also by exception.
+Input: stats - dictionary filled by a_star, status and error set by the api
+"""
+
+
+def observe_query(stats):
+    with _lock:
+        for name, (help_text, buckets, field) in QUERY_HISTOGRAMS.items():
+            if stats.get(field) is not None:
+                _get_histogram(name, help_text, buckets).observe(stats[field])
+
+    status = stats.get("status", "ok")
+    inc_counter("routing_queries_total", "Route queries answered", labels={"status": status})
+    if status == "error":
+        inc_counter("routing_query_errors_total", "Route queries which raised", labels={"error": stats.get("error")})
+    if stats.get("cache_hit"):
+        inc_counter("routing_cache_hits_total", "Route queries served from the loaded snapshot")
+
+
+"""
+Resident memory of the process in bytes, None if it can not be read.
+"""
+
+
+def resident_memory():
+    try:
+        with open("/proc/self/statm", "r") as file:
+            pages = int(file.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # ru_maxrss is the peak, in kilobytes on linux, good enough as a fallback
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return None
+
+
+"""
+Updates the gauges which describe the loaded routing snapshot.
+Input: - version: increasing number of the snapshot
+       - loaded_at: unix time when the snapshot was loaded, None if not loaded
+       - refresh_duration: seconds the last refresh took, None if none finished
+"""
+
+
+def update_snapshot_gauges(version, loaded_at, refresh_duration):
+    set_gauge("routing_snapshot_version", "Version of the routing snapshot in memory", version)
+    if loaded_at is not None:
+        set_gauge("routing_snapshot_age_seconds", "Seconds since the routing snapshot was loaded",
+                  time.time() - loaded_at)
+    if refresh_duration is not None:
+        set_gauge("routing_last_refresh_duration_seconds", "Duration of the last data refresh",
+                  refresh_duration)
+    memory = resident_memory()
+    if memory is not None:
+        set_gauge("process_resident_memory_bytes", "Resident memory size in bytes", memory)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+"""
+Prometheus text exposition of everything collected.
+Output: - string in text/plain; version=0.0.4 format
+"""
+
+
+def render_metrics():
+    lines = []
+    with _lock:
+        previous_name = None
+        for (name, labels), (help_text, value) in sorted(_counters.items()):
+            if name != previous_name:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} counter")
+                previous_name = name
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        for name, (help_text, value) in sorted(_gauges.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {_format_value(value)}")
+
+        for name, histogram in sorted(_histograms.items()):
+            lines.append(f"# HELP {name} {histogram.help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append(f'{name}_bucket{{le="{_format_value(bound)}"}} {count}')
+            lines.append(f'{name}_bucket{{le="+Inf"}} {histogram.count}')
+            lines.append(f"{name}_sum {_format_value(histogram.total)}")
+            lines.append(f"{name}_count {histogram.count}")
+
+    return "\n".join(lines) + "\n"
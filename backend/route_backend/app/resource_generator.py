@@ -2,17 +2,63 @@ import osmnx as ox
 from shapely.geometry import Point, LineString
 from os.path import exists
 from shapely.strtree import STRtree
-import ast
 import os
 import pandas as pd
 import geopandas as gpd
-from shapely.wkt import loads
+import numpy as np
+import shapely
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+import layer_cache_module as lc
+import weights_store_module as ws
+from raster_coverage_module import raster_area_ratio
+from aqi_grid_module import idw_edge_scores
+from zone_tiles_module import zone_pieces, SIMPLIFY_TOLERANCE, TILE_SIZE
+from traffic_module import latest_jam_arrays, latest_jams_path
+from jam_matching_module import matched_pairs
+from traffic_history_module import update_history
+from pyproj import Transformer
 
 full_graph = None
 nodes_full = None
 edges_full = None
-epsg_c = None
-epsg_m = None
+epsg_c = 4326
+epsg_m = 32634
+# (edges_hash, edge geometries in epsg_m) of the last graph the layers ran on
+_metric_edges = None
+# How many processes compute the layers, 1 runs them one after the other in this process
+LAYER_WORKERS = int(os.environ.get("WALKSAFE_LAYER_WORKERS", "0")) or os.cpu_count() or 1
+
+TREES_FILE = "../resources/Trees_only_data.gpkg"
+URBAN_FILE = "../resources/Urban_only_data.gpkg"
+WATER_FILE = "../resources/final_water_data.csv"
+AQI_FILES = ["../resources/aqi_data", "../resources/coordinates_for_aqi.csv"]
+
+# Parameters of the layers in metres, they are part of the cache key
+AQI_RADIUS = 500
+# idw: mean of the interpolated aqi surface along the edge, radius: mean of the samples within AQI_RADIUS
+AQI_MODE = os.environ.get("WALKSAFE_AQI_MODE", "idw")
+# Side of a cell of the aqi surface, idw power and metres between the points sampled along an edge
+AQI_GRID_RESOLUTION = 50
+AQI_IDW_POWER = 2
+AQI_SAMPLE_SPACING = 25
+WATER_THRESHOLDS = [25, 150, 300]
+# Segments per quarter circle of the well buffers, the share of a threshold an arc can fall short of it
+# and the slack in metres for rounding around the bounding boxes
+WATER_BUFFER_SEGMENTS = 16
+WATER_BOX_SHELL = 0.01
+WATER_BOX_MARGIN = 1e-3
+URBAN_THRESHOLD = 50
+# vector: exact polygon intersections, raster: cell counts on a grid, see raster_coverage_module for the error
+URBAN_MODE = os.environ.get("WALKSAFE_URBAN_MODE", "vector")
+# Side of a raster cell in metres
+URBAN_RASTER_RESOLUTION = float(os.environ.get("WALKSAFE_URBAN_RASTER_RESOLUTION", "5"))
+# Clip, simplify and cut the tree and urban zones before the layers use them
+PREPARE_ZONES = True
+TRAFFIC_THRESHOLD = 5
+# Weight every jam by the share of the edge it runs along instead of counting them the same
+TRAFFIC_OVERLAP_WEIGHTED = False
 
 """
 Is it saved or not
@@ -29,27 +75,104 @@ def saved_data(name):
 Saving dataframe weight for future use
 """
 def save_df_weights():
-    filename = "../resources/weights_data.csv"
-    df_weights_projected.to_csv(filename)
+    ws.write_weights(df_weights_projected)
 
 
 """
-Launches all the resources interpreters
+Projects edge geometries into another crs, the input array is not touched
+"""
+def project_edges(edges,epsg_from,epsg_to):
+    return gpd.GeoSeries(edges,crs=epsg_from).to_crs(epsg=epsg_to).to_numpy()
+
+"""
+Edge geometries in metres, projected once per graph version
+Input: - edges: array of edge geometries in epsg_c
+       - edge_set: edges_hash of the graph
+Output: - array of edge geometries in epsg_m
+"""
+def metric_edges(edges,edge_set):
+    global _metric_edges
+    if _metric_edges is None or _metric_edges[0] != edge_set:
+        _metric_edges = (edge_set, project_edges(edges,epsg_c,epsg_m))
+    return _metric_edges[1]
+
+"""
+Computes one layer and times it, this is what runs inside the worker processes
+Input: - column: name of the layer in LAYERS
+       - edges: array of edge geometries in epsg_m
+Output: - column, score array, wall time in seconds
+"""
+def run_layer(column,edges):
+    start_time = time.perf_counter()
+    scores = LAYERS[column][1](edges)
+    return column, scores, time.perf_counter() - start_time
+
+"""
+Computes the layers, in a process pool when there is more than one
+Every layer only reads the edges and returns its column, so the order they finish in does not matter.
+Input: - columns: names of the layers
+       - edges: array of edge geometries in epsg_m
+       - workers: number of processes
+Output: - dictionary column: (score array, wall time)
+"""
+def run_layers(columns,edges,workers=None):
+    workers = LAYER_WORKERS if workers is None else workers
+    results = dict()
+    if workers <= 1 or len(columns) <= 1:
+        for column in columns:
+            _, scores, seconds = run_layer(column,edges)
+            results[column] = (scores, seconds)
+        return results
+
+    # spawn, the refresh runs next to the server threads and forking those is not safe
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(workers,len(columns)),mp_context=context) as pool:
+        futures = [pool.submit(run_layer,column,edges) for column in columns]
+        for future in futures:
+            column, scores, seconds = future.result()
+            results[column] = (scores, seconds)
+    return results
+
 """
-def data_setup(settings):
-    if settings["tree_vs_urban_score"]:
-        urban_vs_green_cover()
-    if settings["tree_cover_score"]:
-        tree_cover()
-    if settings["water_score"]:
-        water_sources_evaluation()
-    if settings["aqi"]:
-        calculate_aqi_score()
+Launches all the resources interpreters
+A layer is read from the layer cache when its inputs, the edges and its parameters did not change,
+and it is younger than its ttl when it has one. Only the other layers are computed.
+Output: - True if a layer was computed or the weights were never saved
+"""
+def data_setup(settings,workers=None):
+    columns = [column for column, (setting, *_) in LAYERS.items() if settings[setting]]
+    edges = df_weights_projected.geometry.to_numpy()
+    edge_set = lc.edges_hash(df_weights_projected.index,edges)
+
+    start_time = time.perf_counter()
+    keys = dict()
+    stale = []
+    for column in columns:
+        _, _, inputs, parameters, ttl = LAYERS[column]
+        keys[column] = lc.layer_key(column,inputs(),edge_set,parameters)
+        if not lc.is_fresh(column,keys[column],edge_set,ttl):
+            stale.append(column)
+
+    edges_m = metric_edges(edges,edge_set)
+    results = run_layers(stale,edges_m,workers)
+    for column in columns:
+        if column in results:
+            scores, seconds = results[column]
+            lc.save_layer(column,keys[column],edge_set,scores)
+            print(f"{column} took {seconds:.2f}s")
+        else:
+            scores = lc.load_layer(column)
+            print(f"{column} read from the cache")
+        df_weights_projected[column] = scores
+    print(f"Layers took {time.perf_counter() - start_time:.2f}s")
     if settings["traffic"]:
-        calculate_traffic_values()
-    if settings["save"]:
+        traffic_history(edges_m,df_weights_projected.index)
+
+    # the weights are only written again when a column changed
+    computed = bool(results) or not ws.weights_saved()
+    if settings["save"] and computed:
         save_df_weights()
-    return
+    return computed
 
 """
 Clear parallel which are weaker in score, if you need them back it can be worked around later.
@@ -73,9 +196,10 @@ def initialization(settings):
     full_graph = ox.load_graphml(filepath="../resources/graph/full_graph.graphml")
     nodes_full, edges_full = ox.graph_to_gdfs(full_graph)
     initialize_df_weights()
-    data_setup(settings)
+    computed = data_setup(settings)
 
     clear_parallels()
+    return computed
 
 
 """
@@ -84,17 +208,13 @@ Initializing weight dataframe
 def initialize_df_weights():
     global  df_weights_projected
 
-    if not saved_data("weights_data"):
+    if not ws.weights_saved():
             
         df_weights = pd.DataFrame()
         df_weights = edges_full[["length","geometry"]]
         df_weights_projected = gpd.GeoDataFrame(df_weights,geometry="geometry")
     else: 
-        df_weights = pd.read_csv("../resources/weights_data.csv")
-        df_weights["geometry"] = df_weights["geometry"].apply(loads)
-        df_weights_projected = gpd.GeoDataFrame(df_weights,geometry="geometry")
-        df_weights_projected.set_crs(epsg=epsg_c,inplace=True)
-        df_weights_projected.set_index(["u","v","key"],inplace=True)
+        df_weights_projected = ws.read_weights()
 
 
 
@@ -175,47 +295,51 @@ def extract_aqi_data_from_tables():
 
 """
 AQI_SCORE = average of the aqi points close to the edge in a 500 m parameter 
+Input: - edges: array of edge geometries in metres
+       - aqi_values: aqi_uni of every point, in the order of the index
+       - aqi_index: STRtree of the aqi points
+Output: - array with the score of every edge, 0 if no point is close
 """
-def calculate_influence(edge,extract_aqi_data,aqi_index):
+def calculate_influence(edges,aqi_values,aqi_index):
 
-    influence_radius = 500
-    buffer_aqi_points = edge.buffer(influence_radius)
-    possible_close_aqi_points = aqi_index.query(buffer_aqi_points)
-    
-    aqi_score = 0
-    for aqi_point in possible_close_aqi_points:
-        aqi_score = aqi_score + extract_aqi_data.loc[aqi_point]["aqi_uni"]
+    influence_radius = AQI_RADIUS
+    buffers_aqi_points = shapely.buffer(edges,influence_radius,quad_segs=16)
+    edge_ids, aqi_ids = aqi_index.query(buffers_aqi_points)
 
-    if len(possible_close_aqi_points) ==0:
-        return 0
-    
-    return aqi_score/len(possible_close_aqi_points)
+    aqi_score = np.bincount(edge_ids,weights=aqi_values[aqi_ids],minlength=len(edges))
+    aqi_count = np.bincount(edge_ids,minlength=len(edges))
+
+    return np.divide(aqi_score,aqi_count,out=np.zeros(len(edges)),where=aqi_count > 0)
 
 """
 AQI data imported and turned into score
+In idw mode the samples are interpolated on a grid and every edge gets the mean along it, so no edge is left at 0.
+Input: - edges: array of edge geometries in epsg_m
+Output: - AQI_score of every edge
 """
-def calculate_aqi_score():
+def calculate_aqi_score(edges):
 
     df_extract_aqi_data,list_health = extract_aqi_data_from_tables()
-    df_extract_aqi_data['geometry'] = df_extract_aqi_data.apply(lambda row: Point(row['x'], row['y']), axis=1)
+    df_extract_aqi_data['geometry'] = shapely.points(df_extract_aqi_data['x'], df_extract_aqi_data['y'])
     gdf_extract_aqi_data = gpd.GeoDataFrame(df_extract_aqi_data, geometry='geometry')
     gdf_extract_aqi_data.set_crs(epsg=epsg_c,inplace=True)
     gdf_extract_aqi_data.reset_index(drop=True, inplace=True)
-    gdf_extract_aqi_data['id'] = gdf_extract_aqi_data.index 
-    gdf_extract_aqi_data.set_index('id', inplace=True)
 
     #set crs
     gdf_extract_aqi_data.to_crs(epsg=epsg_m, inplace=True)
-    df_weights_projected.to_crs(epsg=epsg_m, inplace=True)
+
+    if AQI_MODE == "idw":
+        points = gdf_extract_aqi_data.geometry.to_numpy()
+        return idw_edge_scores(edges, shapely.get_x(points), shapely.get_y(points),
+                               gdf_extract_aqi_data["aqi_uni"].to_numpy(), AQI_GRID_RESOLUTION, AQI_IDW_POWER,
+                               AQI_SAMPLE_SPACING)
 
     #create a geo indexed tree
     aqi_index = STRtree(gdf_extract_aqi_data.geometry.values)
 
-    df_weights_projected["AQI_score"] = df_weights_projected.geometry.apply(
-        lambda edge: calculate_influence(edge,gdf_extract_aqi_data,aqi_index)
+    return calculate_influence(
+        edges,gdf_extract_aqi_data["aqi_uni"].to_numpy(),aqi_index
     )
-    
-    df_weights_projected.to_crs(epsg=epsg_c, inplace=True)
 
 
 
@@ -223,110 +347,139 @@ def calculate_aqi_score():
 Score calculation function:
 This works with a indexed data, which can be used as area affect
 So we define a couple of thresholds, which interests us and evaluate them.
-input: edge - which is buffered
-       thresholds - gives the area effect of something
+A well falls in a band when it lies in the bounding box of the edge buffered by the threshold,
+the same test the tree query of the buffers did, so the scores match the per threshold buffers.
+input: edges - array of edges
+       thresholds - gives the area effect of something, increasing
        well_index - is a geometrically indexed tree, which helps with computation
-output: points - gives how many points does this score, closer the item to edge the higher point it gets.
-"""
-def calculate_score_with_index(edge, thresholds, well_index):
-    # Buffer the edge and query nearby wells
-
-    wells_got = []
-    wells_visited = set()
-    for threshold in thresholds:
-
-        
-        level = []
-        edge_buffer = edge.buffer(threshold)
-        nearby_wells = well_index.query(edge_buffer)
-        for i in nearby_wells:
-
-            if i not in wells_visited:
-                level.append(i)
-                wells_visited.add(i)
-        wells_got.append(level)
-
-    points = 0   
-    points = len(wells_got[0]) * 5 + len(wells_got[1]) * 3 + len(wells_got[2]) * 1
-    return points
+output: points - gives how many points does every edge score, closer the item to edge the higher point it gets.
+        A well only counts in the first threshold it shows up in.
+"""
+def calculate_score_with_index(edges, thresholds, well_index):
+    level_points = np.array([5, 3, 1, 0])
+    thresholds = np.asarray(thresholds, dtype=float)
+
+    # every (edge, well) pair in the bounding box of the edge grown by the widest band, one query
+    bounds = shapely.bounds(edges)
+    reach = thresholds[-1] + WATER_BOX_MARGIN
+    edge_ids, well_ids = well_index.query(
+        shapely.box(bounds[:, 0] - reach, bounds[:, 1] - reach, bounds[:, 2] + reach, bounds[:, 3] + reach))
+
+    # how far the well is out of the bounding box of the edge, per axis the larger one
+    x = shapely.get_x(well_index.geometries[well_ids])
+    y = shapely.get_y(well_index.geometries[well_ids])
+    pair_bounds = bounds[edge_ids]
+    out_x = np.maximum(np.maximum(pair_bounds[:, 0] - x, x - pair_bounds[:, 2]), 0)
+    out_y = np.maximum(np.maximum(pair_bounds[:, 1] - y, y - pair_bounds[:, 3]), 0)
+    out = np.maximum(out_x, out_y)
+
+    # band 0 up to the first threshold included, band 1 up to the second...
+    levels = np.digitize(out, thresholds, right=True)
+
+    # the arcs of a buffer only reach the threshold at their vertices, so next to a threshold
+    # the band comes from the bounding box of the real buffer, as before
+    near = np.any((out[:, None] > thresholds * (1 - WATER_BOX_SHELL))
+                  & (out[:, None] <= thresholds + WATER_BOX_MARGIN), axis=1)
+    if near.any():
+        near_edges = edges[edge_ids[near]]
+        near_x = x[near]
+        near_y = y[near]
+        inside = np.zeros((len(near_x), len(thresholds)), dtype=bool)
+        for level, threshold in enumerate(thresholds):
+            box = shapely.bounds(shapely.buffer(near_edges, threshold, quad_segs=WATER_BUFFER_SEGMENTS))
+            inside[:, level] = ((box[:, 0] <= near_x) & (near_x <= box[:, 2])
+                                & (box[:, 1] <= near_y) & (near_y <= box[:, 3]))
+        levels[near] = np.where(inside.any(axis=1), inside.argmax(axis=1), len(thresholds))
+
+    points = np.bincount(edge_ids, weights=level_points[levels], minlength=len(edges))
+    return points.astype(np.int64)
 
 """
 Water sources data extrapolation to the edges.
-SCORE: 3 distance fo the point is closer than 25m
-       2 distance for the point is closer than 150m
-       1 distance for the point is closer than 300m
+SCORE: sum over the wells of
+       5 the point is in the bounding box of the edge buffered by 25m
+       3 the point is in the bounding box of the edge buffered by 150m
+       1 the point is in the bounding box of the edge buffered by 300m
        0 else
+Input: - edges: array of edge geometries in epsg_m
+Output: - water_score of every edge
 """
-def water_sources_evaluation():
+def water_sources_evaluation(edges):
     
     # Build a spatial index for well
-    water_data = pd.read_csv("../resources/final_water_data.csv")
+    water_data = pd.read_csv(WATER_FILE)
     
-    water_data['geometry'] = water_data.apply(lambda row: Point(row['xcoord'], row['ycoord']), axis=1)
+    water_data['geometry'] = shapely.points(water_data['xcoord'], water_data['ycoord'])
     water_data_df = gpd.GeoDataFrame(water_data,geometry="geometry")
     water_data_df.set_crs(epsg=4326, inplace=True)
     water_data_df.to_crs(epsg=32634 ,inplace=True)
-    df_weights_projected.to_crs(epsg=32634,inplace=True)
 
     # Build a spatial index for wells
     well_index = STRtree(water_data_df.geometry.values)
     
     #print(well_index)
-    threshold = [25,150,300]
-    df_weights_projected['water_score'] = df_weights_projected.geometry.apply(
-        lambda edge: calculate_score_with_index(edge, threshold, well_index))
-   
-   # df_weights_projected['water_score'] = min_max_normalize(df_weights_projected['water_score'])
-    df_weights_projected.to_crs(epsg=4326,inplace=True)
-
-"""
-dictionary: Tree covers
-key: id
-values: geometry
-"""
-def create_id_geometry_tree(tree_data):
-    dictionary = dict()
-    for key, value in tree_data.iterrows():
-        dictionary[key] = value.geometry
-    return dictionary
-
+    return calculate_score_with_index(edges, WATER_THRESHOLDS, well_index)
 
 """
-Calculates the percentage an edge is covered by the trees
-input: - edges : the graph
+Calculates the percentage every edge is covered by the trees
+input: - edges : array of edge geometries in metres
        - green_zone_index : indexed tree representation of the tree covers for faster run time
-       - dictionary_id_geometry_trees : to convert id into geometry
+       - tree_geometries : to convert id into geometry
 """
-def calculate_intersection(edge,green_zone_index,dictionary_id_geometry_trees):
-   
-    candidate_covers = green_zone_index.query(edge)
-    intersecting_length = 0
-    for geom_id in candidate_covers:
-        if edge.intersects(dictionary_id_geometry_trees[geom_id]) :
-            intersecting_length = intersecting_length + edge.intersection(dictionary_id_geometry_trees[geom_id]).length
+def calculate_intersection(edges,green_zone_index,tree_geometries):
+
+    edge_ids, geom_ids = green_zone_index.query(edges, predicate="intersects")
+    intersecting = shapely.length(shapely.intersection(edges[edge_ids], tree_geometries[geom_ids]))
+    intersecting_length = np.bincount(edge_ids, weights=intersecting, minlength=len(edges))
 
-    total_length = edge.length       
+    total_length = shapely.length(edges)
     intersection_percentage = (intersecting_length / total_length) * 100
 
     return intersection_percentage
    
 """
-Tree cover calculations on the edge
+Tree or urban zones in epsg_m
+With PREPARE_ZONES they are clipped to the edges and the largest buffer around them, simplified and cut in pieces,
+the pieces are cached in zone_tiles_module.
+Input: - path of the zone file
+       - edges: array of edge geometries in epsg_m
+Output: - array of polygons
 """
-def tree_cover():
-    input_file = "../resources/Trees_only_data.gpkg"
-    data = gpd.read_file(input_file)
-    if df_weights_projected.crs != 4326:
-        df_weights_projected.to_crs(epsg=4326,inplace=True)
+def load_zones(path,edges):
+    if PREPARE_ZONES:
+        xmin, ymin, xmax, ymax = shapely.total_bounds(edges)
+        margin = URBAN_THRESHOLD
+        return zone_pieces(path,epsg_m,(xmin - margin, ymin - margin, xmax + margin, ymax + margin))
+
+    data = gpd.read_file(path)
+    data.to_crs(epsg=epsg_m ,inplace=True)
+    return data.geometry.to_numpy()
 
+"""
+Tree cover calculations on the edge
+Input: - edges: array of edge geometries in epsg_m
+Output: - tree_cover_score of every edge
+"""
+def tree_cover(edges):
     #Build a spatial index for the trees
-    green_zones_indexed = STRtree(data.geometry.values)
+    tree_geometries = load_zones(TREES_FILE,edges)
+    green_zones_indexed = STRtree(tree_geometries)
+
+    return calculate_intersection(edges,green_zones_indexed,tree_geometries)
+
+"""
+Area covered by the zones inside every buffer
+Input: - buffers: array of polygons
+       - zones_indexed: STRtree of the zones
+       - zone_geometries: geometries of the zones in the order of the tree
+Output: - array with the covered area of every buffer
+"""
+def covered_area(buffers,zones_indexed,zone_geometries):
+    # bounding box candidates only, an intersects predicate costs as much as the intersection on the big polygons
+    buffer_ids, zone_ids = zones_indexed.query(buffers)
+    areas = shapely.area(shapely.intersection(buffers[buffer_ids], zone_geometries[zone_ids]))
+    return np.bincount(buffer_ids, weights=areas, minlength=len(buffers))
 
-    dictionary_id_geometry_trees = create_id_geometry_tree(data)
-    df_weights_projected["tree_cover_score"] = df_weights_projected.geometry.apply(
-        lambda edge: calculate_intersection(edge,green_zones_indexed,dictionary_id_geometry_trees)
-    )
-    
 """
 Area ration. 
 Input: - Edges
@@ -337,22 +490,13 @@ Output:
 Classification:
     = green_ratio - urban_ration
 """
-def calculate_area_ratio(edge,threshold,green_zones_indexed,urban_zones_indexed,dictionary_id_geometry_trees,dictionary_id_geometry_urban) :
-    edge_buffer = edge.buffer(threshold)
+def calculate_area_ratio(edges,threshold,green_zones_indexed,urban_zones_indexed,tree_geometries,urban_geometries) :
+    edge_buffers = shapely.buffer(edges, threshold, quad_segs=16)
+    edge_buffer_area = shapely.area(edge_buffers)
 
-    green_indexes = green_zones_indexed.query(edge_buffer)
-    urban_indexes = urban_zones_indexed.query(edge_buffer)
-  
-    edge_buffer_area = edge_buffer.area
+    green_area = covered_area(edge_buffers,green_zones_indexed,tree_geometries)
+    urban_area = covered_area(edge_buffers,urban_zones_indexed,urban_geometries)
 
-    green_area = 0
-    for geom_id in green_indexes:
-        green_area = green_area + edge_buffer.intersection(dictionary_id_geometry_trees[geom_id]).area
-    
-    urban_area = 0
-    for geom_id in urban_indexes:
-        urban_area = urban_area + edge_buffer.intersection(dictionary_id_geometry_urban[geom_id]).area
-    
     green_ratio = (green_area/edge_buffer_area)*100
     urban_ratio = (urban_area/edge_buffer_area)*100
 
@@ -360,35 +504,23 @@ def calculate_area_ratio(edge,threshold,green_zones_indexed,urban_zones_indexed,
 
 """
 In the zone that the edge goes through what percentage is urban vs trees
+Input: - edges: array of edge geometries in epsg_m
+Output: - tree_vs_urban_score of every edge
 """
-def urban_vs_green_cover():
-
-    
-    input_file = "../resources/Trees_only_data.gpkg"
-    data_trees = gpd.read_file(input_file)
-    data_trees.to_crs(epsg=32634 ,inplace=True)
-    df_weights_projected.to_crs(epsg=32634,inplace=True)
-
-    input_file = "../resources/Urban_only_data.gpkg"
-    data_urban = gpd.read_file(input_file)
-    data_urban.to_crs(epsg=32634 ,inplace=True)
-
+def urban_vs_green_cover(edges):
+    tree_geometries = load_zones(TREES_FILE,edges)
+    urban_geometries = load_zones(URBAN_FILE,edges)
 
     #Build a spatial index for the trees
-    green_zones_indexed = STRtree(data_trees.geometry.values)
-    urban_zones_indexed = STRtree(data_urban.geometry.values)
-
-    dictionary_id_geometry_trees = create_id_geometry_tree(data_trees)
-    dictionary_id_geometry_urban = create_id_geometry_tree(data_urban)
+    if URBAN_MODE == "raster":
+        return raster_area_ratio(edges,URBAN_THRESHOLD,tree_geometries,urban_geometries,URBAN_RASTER_RESOLUTION)
 
-    threshold = 50
+    green_zones_indexed = STRtree(tree_geometries)
+    urban_zones_indexed = STRtree(urban_geometries)
 
-    df_weights_projected["tree_vs_urban_score"] = df_weights_projected.geometry.apply(
-        lambda edge: calculate_area_ratio(edge,threshold,green_zones_indexed,urban_zones_indexed,dictionary_id_geometry_trees,dictionary_id_geometry_urban)
+    return calculate_area_ratio(
+        edges,URBAN_THRESHOLD,green_zones_indexed,urban_zones_indexed,tree_geometries,urban_geometries
     )
-    
-    
-    df_weights_projected.to_crs(epsg=4326,inplace=True)
 
 """
 Checks if its close or intersects the line
@@ -406,70 +538,94 @@ def check_intersection_or_closeness(line1, line2, threshold):
 
 """
 calculate score for values smaller the better
+Input: - number_of_edges
+       - edge_ids: edge of every matched (jam, edge) pair
+       - pair_levels: level of the jam of every pair
+       - weights: weight of every pair
+Output: - weighted mean level of the jams close to every edge, 0 if there is none
 """
-def calculate_traffic_score(edge,traffic_index_tree,taffic_gdf,threshold=5):
-    
-    edge_buffered = edge.buffer(threshold)
+def calculate_traffic_score(number_of_edges,edge_ids,pair_levels,weights):
 
-    traffic_indexes = traffic_index_tree.query(edge_buffered)
+    value_of_traffic = np.bincount(edge_ids, weights=pair_levels * weights, minlength=number_of_edges)
+    count_of_traffic = np.bincount(edge_ids, weights=weights, minlength=number_of_edges)
 
-    value_of_traffic = 0
-    for i in traffic_indexes:
-        value_of_traffic = value_of_traffic + taffic_gdf["level"][i]
-    
-    if len(traffic_indexes) > 0:
-        return value_of_traffic/len(traffic_indexes)
-    return 0
+    return np.divide(value_of_traffic, count_of_traffic, out=np.zeros(number_of_edges), where=count_of_traffic > 0)
 
 """
 Calculates traffic score to roads.
-"""
-def calculate_traffic_values():
-    directory = "../resources/table_data/"
-
-    csv_files = [f for f in os.listdir(directory) if f.endswith('.csv') and f.startswith('jams')]
-    csv_files.sort(key=lambda x: os.path.getmtime(os.path.join(directory,x)),reverse=True)
-    latest_csv = csv_files[0]
-    latest_csv_path = os.path.join(directory,latest_csv)
-
-    traffic_df = pd.read_csv(latest_csv_path)
-    geometries = traffic_df["geometry"]
-    list_linestring = []
-    for geometry_data in geometries:
-        geo_data = ast.literal_eval(geometry_data)
-        coords = []
-       
-        coords = [(point['x'],point['y']) for point in geo_data]
-        list_linestring.append(LineString(coords))
-    
-    traffic_df["geometry"] = list_linestring
-  
-
-    traffic_gdf = gpd.GeoDataFrame(traffic_df,geometry="geometry")
-    traffic_gdf.set_crs(epsg=epsg_c, inplace=True)
-    traffic_gdf.to_crs(epsg=epsg_m, inplace=True)
-    df_weights_projected.to_crs(epsg=epsg_m,inplace=True)
-    
-    
-    traffic_zones_indexed = STRtree(traffic_gdf.geometry.values)
-    df_weights_projected["traffic"] = df_weights_projected.geometry.apply(
-        lambda edge: calculate_traffic_score(edge,traffic_zones_indexed,traffic_gdf)
-    )
-
-    df_weights_projected.to_crs(epsg=epsg_c,inplace=True)
+The jams of the newest traffic snapshot are read as coordinate arrays,
+the edges of every jam line come from the map matching cache, only new lines are projected and matched.
+Input: - edges: array of edge geometries in epsg_m
+Output: - traffic score of every edge
+"""
+def calculate_traffic_values(edges):
+    x, y, jam_of_point, levels = latest_jam_arrays()
+    transformer = Transformer.from_crs(epsg_c, epsg_m, always_xy=True)
+    edge_set = lc.edges_hash(range(len(edges)),edges)
+
+    jam_ids, edge_ids, overlaps = matched_pairs(x, y, jam_of_point, transformer.transform, edges, edge_set,
+                                                TRAFFIC_THRESHOLD)
+    weights = overlaps if TRAFFIC_OVERLAP_WEIGHTED else np.ones(len(jam_ids))
+    return calculate_traffic_score(len(edges),edge_ids,levels[jam_ids],weights)
+
+"""
+Adds the new traffic snapshots to the weekday and hour history the router switches between
+Input: - edges: array of edge geometries in epsg_m
+       - index: u, v, key of the edges
+"""
+def traffic_history(edges,index):
+    transformer = Transformer.from_crs(epsg_c, epsg_m, always_xy=True)
+    edge_set = lc.edges_hash(range(len(edges)),edges)
+    update_history(edges, edge_set, index, transformer.transform, TRAFFIC_THRESHOLD, TRAFFIC_OVERLAP_WEIGHTED)
+
+"""
+How the zones are prepared, part of the cache key of the layers using them
+"""
+def zone_settings():
+    if not PREPARE_ZONES:
+        return None
+    return {"tolerance": SIMPLIFY_TOLERANCE, "tile_size": TILE_SIZE}
+
+"""
+Every score layer
+key: column in df_weights_projected
+values: - key in the settings
+        - function from the edge geometries in epsg_m to the column
+        - function giving the files the layer reads
+        - parameters of the layer
+        - ttl in seconds, how long a column is reused while its inputs do not change, None for no limit
+"""
+LAYERS = {
+    "tree_vs_urban_score": ("tree_vs_urban_score", urban_vs_green_cover, lambda: [TREES_FILE, URBAN_FILE],
+                            {"threshold": URBAN_THRESHOLD, "mode": URBAN_MODE,
+                             "resolution": URBAN_RASTER_RESOLUTION if URBAN_MODE == "raster" else None,
+                             "zones": zone_settings()}, None),
+    "tree_cover_score": ("tree_cover_score", tree_cover, lambda: [TREES_FILE],
+                         {"epsg": epsg_m, "zones": zone_settings()}, None),
+    "water_score": ("water_score", water_sources_evaluation, lambda: [WATER_FILE],
+                    {"thresholds": WATER_THRESHOLDS, "method": "buffer_box"}, None),
+    "AQI_score": ("aqi", calculate_aqi_score, lambda: AQI_FILES,
+                  {"mode": AQI_MODE, "radius": AQI_RADIUS} if AQI_MODE == "radius" else
+                  {"mode": AQI_MODE, "resolution": AQI_GRID_RESOLUTION, "power": AQI_IDW_POWER,
+                   "spacing": AQI_SAMPLE_SPACING}, 60 * 60),
+    "traffic": ("traffic", calculate_traffic_values, lambda: [latest_jams_path()],
+                {"threshold": TRAFFIC_THRESHOLD, "overlap_weighted": TRAFFIC_OVERLAP_WEIGHTED}, 30 * 60),
+}
     
 """
 Refreshes all the resources.
+Every layer is asked for, the layer cache only recomputes the ones whose inputs changed or whose ttl ran out.
+Output: - True if a layer was computed again
 """
 def refresh_resource_generator():
     settings = dict() 
-    settings["tree_vs_urban_score"] = False
-    settings["tree_cover_score"] = False
-    settings["water_score"] = False
-    settings["aqi"] = False
+    settings["tree_vs_urban_score"] = True
+    settings["tree_cover_score"] = True
+    settings["water_score"] = True
+    settings["aqi"] = True
     settings["traffic"] = True
     settings["save"] = True
-    initialization(settings)
+    return initialization(settings)
 
 
 
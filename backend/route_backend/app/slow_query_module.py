@@ -0,0 +1,249 @@
+import argparse
+import cProfile
+import json
+import os
+import sys
+import threading as th
+import time
+from collections import Counter
+
+# Queries slower than this many seconds are captured
+SLOW_QUERY_THRESHOLD = float(os.environ.get("WALKSAFE_SLOW_QUERY_SECONDS", "2.0"))
+# none, cprofile or sample
+PROFILE_MODE = os.environ.get("WALKSAFE_PROFILE_MODE", "none")
+# Every how many seconds the sampling profiler looks at the stack
+SAMPLE_INTERVAL = 0.005
+# How many captures are kept on disk, older ones are overwritten
+RING_CAPACITY = 50
+RING_DIRECTORY = "../resources/slow_queries/"
+
+_ring_lock = th.Lock()
+
+"""
+Sampling profiler, a background thread looks at the stack of the profiled thread
+and counts the collapsed stacks (flamegraph "folded" format).
+"""
+
+
+class StackSampler:
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = th.Event()
+        self._thread = th.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common()) + "\n"
+
+
+"""
+Context manager around one query, profiles it according to the mode.
+Input: mode - none, cprofile or sample
+"""
+
+
+class QueryProfiler:
+    def __init__(self, mode=None):
+        self.mode = PROFILE_MODE if mode is None else mode
+        self.profile = None
+        self.sampler = None
+
+    def __enter__(self):
+        if self.mode == "cprofile":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif self.mode == "sample":
+            self.sampler = StackSampler(th.get_ident())
+            self.sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profile is not None:
+            self.profile.disable()
+        if self.sampler is not None:
+            self.sampler.stop()
+        return False
+
+    """
+    Writes the collected profile next to the capture
+    Output: - file name of the profile, None if nothing was profiled
+    """
+
+    def save(self, base_path):
+        if self.profile is not None:
+            filename = base_path + ".prof"
+            self.profile.dump_stats(filename)
+            return os.path.basename(filename)
+        if self.sampler is not None:
+            filename = base_path + ".folded"
+            with open(filename, "w") as file:
+                file.write(self.sampler.folded())
+            return os.path.basename(filename)
+        return None
+
+
+def _read_ring_index():
+    index_path = os.path.join(RING_DIRECTORY, "index.json")
+    if not os.path.exists(index_path):
+        return {"next": 0, "written": 0}
+    with open(index_path, "r") as file:
+        return json.load(file)
+
+
+def _write_ring_index(index):
+    index_path = os.path.join(RING_DIRECTORY, "index.json")
+    temporary_path = index_path + ".tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(index, file)
+    os.replace(temporary_path, index_path)
+
+
+"""
+Saves a slow query into the next slot of the ring buffer.
+Input: - payload: start, finish, tags of the request
+       - stats: dictionary filled by a_star
+       - data_version: describes the data the query ran on
+       - profiler: QueryProfiler used for the query or None
+Output: - path of the capture
+"""
+
+
+def capture_query(payload, stats, data_version, profiler=None):
+    with _ring_lock:
+        os.makedirs(RING_DIRECTORY, exist_ok=True)
+        index = _read_ring_index()
+        slot = index["next"]
+        base_path = os.path.join(RING_DIRECTORY, f"slot_{slot:03d}")
+
+        # Remove whatever was in the slot before
+        for extension in (".json", ".prof", ".folded"):
+            if os.path.exists(base_path + extension):
+                os.remove(base_path + extension)
+
+        profile_file = profiler.save(base_path) if profiler is not None else None
+        capture = {
+            "sequence": index["written"],
+            "captured_at": time.time(),
+            "start": payload.get("start"),
+            "finish": payload.get("finish"),
+            "tags": payload.get("tags"),
+            "data_version": data_version,
+            "stats": stats,
+            "profile": profile_file,
+        }
+        with open(base_path + ".json", "w") as file:
+            json.dump(capture, file, indent=4)
+
+        _write_ring_index({"next": (slot + 1) % RING_CAPACITY, "written": index["written"] + 1})
+    return base_path + ".json"
+
+
+"""
+Captures the query if it was slower than the threshold or if it raised.
+Output: - path of the capture or None
+"""
+
+
+def capture_if_slow(payload, stats, data_version, profiler=None):
+    if stats.get("status") == "error":
+        print(f"Failed route query captured: {stats.get('error')}")
+    elif stats.get("total_time", 0) < SLOW_QUERY_THRESHOLD:
+        return None
+    else:
+        print(f"Slow route query {stats.get('total_time'):.3f}s captured")
+    return capture_query(payload, stats, data_version, profiler)
+
+
+"""
+Every capture in the ring buffer, oldest first.
+"""
+
+
+def load_captures():
+    if not os.path.exists(RING_DIRECTORY):
+        return []
+    captures = []
+    for filename in os.listdir(RING_DIRECTORY):
+        if filename.startswith("slot_") and filename.endswith(".json"):
+            with open(os.path.join(RING_DIRECTORY, filename), "r") as file:
+                captures.append(json.load(file))
+    captures.sort(key=lambda capture: capture["sequence"])
+    return captures
+
+
+"""
+Runs the captured queries again on the snapshot on disk and compares the timings.
+Input: - captures: list of captures
+       - profile_mode: none, cprofile or sample, profiles are written next to the ring buffer
+Output: - list of (capture, replay stats)
+"""
+
+
+def replay_captures(captures, profile_mode="none"):
+    import a_star_module as a
+
+    results = []
+    for capture in captures:
+        start = capture["start"]
+        finish = capture["finish"]
+        stats = dict()
+        with QueryProfiler(profile_mode) as profiler:
+            a.a_star((start["latitude"], start["longitude"]), (finish["latitude"], finish["longitude"]), 1,
+                     capture["tags"], stats)
+        profiler.save(os.path.join(RING_DIRECTORY, f"replay_{capture['sequence']}"))
+        results.append((capture, stats))
+    return results
+
+
+def print_replay(results):
+    print(f"{'seq':>6} {'captured s':>11} {'replay s':>9} {'expanded':>9} {'replayed':>9}  data version")
+    for capture, stats in results:
+        captured = capture["stats"]
+        print(f"{capture['sequence']:>6} {captured.get('total_time', 0):>11.3f} {stats.get('total_time', 0):>9.3f} "
+              f"{captured.get('nodes_expanded', 0):>9} {stats.get('nodes_expanded', 0):>9}  "
+              f"{capture['data_version']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Slow route query captures")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="list the captured queries")
+    replay = subparsers.add_parser("replay", help="replay the captured queries against the snapshot on disk")
+    replay.add_argument("--sequence", type=int, nargs="*", help="only replay these captures")
+    replay.add_argument("--profile", choices=["none", "cprofile", "sample"], default="none")
+    arguments = parser.parse_args()
+
+    captures = load_captures()
+    if arguments.command == "list":
+        for capture in captures:
+            print(capture["sequence"], time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime(capture["captured_at"])),
+                  f"{capture['stats'].get('total_time', 0):.3f}s", capture["start"], capture["finish"],
+                  capture["tags"], capture["profile"])
+        return
+
+    if arguments.sequence:
+        captures = [capture for capture in captures if capture["sequence"] in arguments.sequence]
+    print_replay(replay_captures(captures, arguments.profile))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+import json
+import os
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+import numpy as np
+import pandas as pd
+import traffic_store_module as ts
+from traffic_module import last_fetch_time
+from jam_matching_module import matched_pairs
+from graph_compaction_module import chain_between
+
+HISTORY_FILE = "../resources/layer_cache/traffic_history.npz"
+# 7 weekdays x 24 hours
+BUCKETS = 7 * 24
+# A level is stored as level * LEVEL_SCALE in the uint8 matrix, level 5 is 250
+LEVEL_SCALE = 50
+MAX_LEVEL = 5
+# Local time the buckets follow
+TIMEZONE = os.environ.get("WALKSAFE_TIMEZONE", "Europe/Bucharest")
+# Seconds after the last answer of waze the live jams are used instead of the history
+LIVE_MAX_AGE = 45 * 60
+
+"""
+Traffic by time of day
+Every fetch of the traffic store is scored like the live traffic layer and added to the bucket of its weekday and hour.
+The mean level of every edge in every bucket is kept as a uint8 matrix (edges x 168) next to the layer cache.
+New fetches are added to the sums as they come, the sums start over when the edges or the settings change.
+The router turns the matrix into the traffic column of every bucket once and picks the current one per query,
+so the costs follow the time of day without fetching or matching anything at request time.
+"""
+
+"""
+Bucket of a moment
+Input: - unix_time
+Output: - weekday * 24 + hour in TIMEZONE, monday 0h is 0
+"""
+
+
+def bucket_of(unix_time):
+    moment = datetime.fromtimestamp(unix_time, ZoneInfo(TIMEZONE))
+    return moment.weekday() * 24 + moment.hour
+
+
+"""
+Traffic score of every edge in every snapshot, the same mean level as calculate_traffic_score
+All the snapshots go through the jam matching at once, a line seen in many snapshots is matched once.
+Input: - entries: index entries of the traffic store
+       - project: function from x, y arrays in EPSG 4326 to x, y in the metres of the edges
+       - edges: array of edge geometries in metres
+       - edge_set: hash of the edges, the one the live traffic layer uses for the match cache
+       - threshold: buffer around the edges in metres
+       - overlap_weighted: weight the jams by the share of the edge they cover
+Output: - snapshot_ids, edge_ids, scores: one entry per (snapshot, edge) with a jam
+"""
+
+
+def snapshot_scores(entries, project, edges, edge_set, threshold, overlap_weighted):
+    xs, ys, jams, levels, snapshot_of_jam = [], [], [], [], []
+    jam_count = 0
+    for number, entry in enumerate(entries):
+        x, y, jam_of_point, jam_levels = ts.line_arrays(ts.read_snapshot(entry, "jams"))
+        xs.append(x)
+        ys.append(y)
+        jams.append(jam_of_point + jam_count)
+        levels.append(jam_levels)
+        snapshot_of_jam.append(np.full(len(jam_levels), number, dtype=np.int64))
+        jam_count += len(jam_levels)
+
+    levels = np.concatenate(levels)
+    snapshot_of_jam = np.concatenate(snapshot_of_jam)
+    jam_ids, edge_ids, overlaps = matched_pairs(np.concatenate(xs), np.concatenate(ys), np.concatenate(jams),
+                                                project, edges, edge_set, threshold)
+    weights = overlaps if overlap_weighted else np.ones(len(jam_ids))
+
+    keys = snapshot_of_jam[jam_ids] * len(edges) + edge_ids
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    value = np.bincount(inverse, weights=levels[jam_ids] * weights, minlength=len(unique_keys))
+    count = np.bincount(inverse, weights=weights, minlength=len(unique_keys))
+    scores = np.divide(value, count, out=np.zeros(len(unique_keys)), where=count > 0)
+    return unique_keys // len(edges), unique_keys % len(edges), scores
+
+
+def _read_history(names=None):
+    if not os.path.exists(HISTORY_FILE):
+        return None
+    with np.load(HISTORY_FILE) as history:
+        return {name: history[name] for name in (history.files if names is None else names)}
+
+
+def _write_history(history):
+    os.makedirs(os.path.dirname(HISTORY_FILE), exist_ok=True)
+    temporary_path = HISTORY_FILE + ".tmp"
+    with open(temporary_path, "wb") as file:
+        np.savez(file, **history)
+    os.replace(temporary_path, HISTORY_FILE)
+
+
+"""
+Fetches of the store since a moment
+A snapshot is seen by the fetch that stored it and by the later fetches that confirmed the same jams.
+Input: - last_time: unix time of the last fetch already counted
+Output: - entries with a fetch after last_time, the times of those fetches for every entry
+"""
+
+
+def fetches_since(last_time):
+    entries, times = [], []
+    for entry in ts.snapshots_between(-np.inf, np.inf):
+        entry_times = [fetch_time for fetch_time in [entry["time"]] + entry.get("confirmed", []) if fetch_time > last_time]
+        if entry_times:
+            entries.append(entry)
+            times.append(entry_times)
+    return entries, times
+
+
+"""
+Adds the fetches made since the last update to the history
+Every fetch counts in the bucket of its weekday and hour, the fetches that found the jams unchanged included,
+so an hour where the traffic holds still is not under counted.
+Input: - edges: array of edge geometries in metres
+       - edge_set: hash of the edges, the one the live traffic layer uses for the match cache
+       - index: u, v, key of the edges, the router finds its rows with it
+       - project, threshold, overlap_weighted: like the live traffic layer
+"""
+
+
+def update_history(edges, edge_set, index, project, threshold, overlap_weighted):
+    settings = json.dumps({"edges": edge_set, "threshold": threshold, "overlap_weighted": overlap_weighted,
+                           "timezone": TIMEZONE, "scale": LEVEL_SCALE}, sort_keys=True)
+    history = _read_history()
+    if history is None or str(history["settings"]) != settings:
+        sums = np.zeros((len(edges), BUCKETS), dtype=np.float32)
+        counts = np.zeros(BUCKETS, dtype=np.int64)
+        last_time = -np.inf
+    else:
+        sums, counts, last_time = history["sums"], history["counts"], float(history["last_time"])
+
+    entries, times = fetches_since(last_time)
+    if not entries:
+        return
+    start_time = time.perf_counter()
+    snapshot_ids, edge_ids, scores = snapshot_scores(entries, project, edges, edge_set, threshold, overlap_weighted)
+    # the pairs come sorted by snapshot, an edge is at most once in a snapshot
+    starts = np.searchsorted(snapshot_ids, np.arange(len(entries)))
+    ends = np.searchsorted(snapshot_ids, np.arange(len(entries)), side="right")
+    for number, entry_times in enumerate(times):
+        for fetch_time in entry_times:
+            bucket = bucket_of(fetch_time)
+            sums[edge_ids[starts[number]:ends[number]], bucket] += scores[starts[number]:ends[number]]
+            counts[bucket] += 1
+
+    means = np.divide(sums, counts, out=np.zeros(sums.shape, dtype=np.float32), where=counts > 0)
+    levels = np.clip(np.round(means * LEVEL_SCALE), 0, 255).astype(np.uint8)
+    u, v, key = (np.asarray(index.get_level_values(level), dtype=np.int64) for level in range(3))
+    _write_history({"levels": levels, "sums": sums, "counts": counts,
+                    "last_time": max(max(entry_times) for entry_times in times),
+                    "settings": settings, "u": u, "v": v, "key": key})
+    print(f"Traffic history: {sum(len(entry_times) for entry_times in times)} fetches of {len(entries)} snapshots "
+          f"added, {int((counts > 0).sum())} of {BUCKETS} buckets filled in {time.perf_counter() - start_time:.2f}s")
+
+
+"""
+Rows of the compiled edges in the uncontracted edges, a merged edge sums its segments like merge_chain does
+Input: - edge_rows: row in gdf_compiled of every compiled edge
+       - gdf_compiled: edges the graph was compiled from, indexed by u,v
+       - gdf_before: edges before the degree-2 contraction, indexed by u,v
+       - dict_chain_nodes
+Output: - compiled_ids, before_ids: one entry per (compiled edge, uncontracted edge)
+"""
+
+
+def compiled_sources(edge_rows, gdf_compiled, gdf_before, dict_chain_nodes):
+    row_of_pair = {pair: row for row, pair in enumerate(gdf_before.index)}
+    compiled_ids, before_ids = [], []
+    for compiled_id, (u, v) in enumerate(gdf_compiled.index[edge_rows]):
+        nodes = [u] + chain_between(u, v, dict_chain_nodes) + [v]
+        rows = [row_of_pair.get((a, b), row_of_pair.get((b, a))) for a, b in zip(nodes[:-1], nodes[1:])]
+        compiled_ids.extend([compiled_id] * len(rows))
+        before_ids.extend(rows)
+    return np.array(compiled_ids, dtype=np.int64), np.array(before_ids, dtype=np.int64)
+
+
+"""
+Segments from the start of the merged edge to every node removed by the contraction
+Input: - compiled: CompiledGraph with chain_of filled
+       - gdf_before: edges before the degree-2 contraction, indexed by u,v
+Output: - prefix_row_of: removed node id: row of its prefix
+        - prefix_ids, before_ids: one entry per (prefix, uncontracted edge)
+"""
+
+
+def prefix_sources(compiled, gdf_before):
+    row_of_pair = {pair: row for row, pair in enumerate(gdf_before.index)}
+    prefix_row_of = dict()
+    prefix_ids, before_ids = [], []
+    for node_id, (_, u_index, v_index, removed, position, _) in compiled.chain_of.items():
+        nodes = [compiled.node_ids_list[u_index]] + removed[:position + 1]
+        prefix_row_of[node_id] = len(prefix_row_of)
+        for a, b in zip(nodes[:-1], nodes[1:]):
+            prefix_ids.append(prefix_row_of[node_id])
+            before_ids.append(row_of_pair.get((a, b), row_of_pair.get((b, a))))
+    return prefix_row_of, np.array(prefix_ids, dtype=np.int64), np.array(before_ids, dtype=np.int64)
+
+
+"""
+Traffic of the compiled edges by weekday and hour
+columns holds the traffic column of every bucket (compiled edges x 168, fortran order so a bucket is a contiguous
+column), live_column the one of the live jams. prefixes and live_prefix hold the same for the part of a merged
+edge between its start and a removed node, so a query starting or ending there splits the edge with its own traffic.
+All of them are built once when the history is attached, a query only picks the ones of its moment,
+nothing is stored on the shared graph.
+"""
+
+
+class TrafficHistory:
+    def __init__(self, columns, live_column, prefixes, live_prefix, prefix_row_of, fetched_at=last_fetch_time):
+        self.columns = columns
+        self.live_column = live_column
+        self.prefixes = prefixes
+        self.live_prefix = live_prefix
+        self.prefix_row_of = prefix_row_of
+        self.fetched_at = fetched_at
+
+    """
+    Traffic of a moment
+    The live jams replace the history of every edge while waze answered less than LIVE_MAX_AGE ago.
+    Input: now - unix time
+    Output: - traffic of every compiled edge, traffic of every prefix (rows in prefix_row_of), bucket
+    """
+
+    def select(self, now):
+        bucket = bucket_of(now)
+        fetched = self.fetched_at()
+        if fetched is not None and now - fetched < LIVE_MAX_AGE:
+            return self.live_column, self.live_prefix, bucket
+        return self.columns[:, bucket], self.prefixes[:, bucket], bucket
+
+
+"""
+Attaches the traffic history to the compiled graph, after chain_of was filled
+The history is normalized with the min and max of the live levels, like normalize() does with the live column,
+and summed over the merged edges and the prefixes, the columns of the 168 buckets are built here once.
+An edge missing from the history, or a bucket no fetch fell in, keeps the static traffic of the edge.
+Input: - compiled: CompiledGraph
+       - gdf_before: edges before the degree-2 contraction, indexed by u,v, with the key column
+       - live_levels: traffic of gdf_before before the normalization
+       - gdf_compiled: edges the graph was compiled from
+       - dict_chain_nodes
+"""
+
+
+def attach_history(compiled, gdf_before, live_levels, gdf_compiled, dict_chain_nodes):
+    history = _read_history(["levels", "counts", "u", "v", "key"])
+    if history is None:
+        return
+
+    history_index = pd.MultiIndex.from_arrays([history["u"], history["v"], history["key"]])
+    before_index = pd.MultiIndex.from_arrays([gdf_before.index.get_level_values(0),
+                                              gdf_before.index.get_level_values(1), gdf_before["key"]])
+    positions = history_index.get_indexer(before_index)
+    found = positions >= 0
+    filled = history["counts"] > 0
+
+    live_levels = np.asarray(live_levels, dtype=np.float32)
+    levels = np.repeat(live_levels[:, None], BUCKETS, axis=1)
+    levels[np.ix_(found, filled)] = history["levels"][positions[found]][:, filled] / np.float32(LEVEL_SCALE)
+
+    low, high = float(live_levels.min()), float(live_levels.max())
+    scale = 100 / (high - low) if high > low else 100 / MAX_LEVEL
+    compiled_ids, before_ids = compiled_sources(compiled.edge_rows, gdf_compiled, gdf_before, dict_chain_nodes)
+    compiled_count = len(compiled.edge_rows)
+
+    normalized = np.maximum((levels - low) * scale, 0)
+    live_normalized = np.maximum((live_levels - low) * scale, 0)
+    columns = np.zeros((compiled_count, BUCKETS), dtype=np.float32, order="F")
+    np.add.at(columns, compiled_ids, normalized[before_ids])
+    live_column = np.bincount(compiled_ids, weights=live_normalized[before_ids], minlength=compiled_count)
+
+    prefix_row_of, prefix_ids, prefix_before_ids = prefix_sources(compiled, gdf_before)
+    prefixes = np.zeros((len(prefix_row_of), BUCKETS), dtype=np.float32, order="F")
+    np.add.at(prefixes, prefix_ids, normalized[prefix_before_ids])
+    live_prefix = np.bincount(prefix_ids, weights=live_normalized[prefix_before_ids], minlength=len(prefix_row_of))
+    compiled.set_traffic_history(TrafficHistory(columns, live_column, prefixes, live_prefix, prefix_row_of))
+    print(f"Traffic history attached: {int(found.sum())} of {len(gdf_before)} edges, "
+          f"{int(filled.sum())} of {BUCKETS} buckets, {(columns.nbytes + prefixes.nbytes) / 1e6:.1f} MB")
@@ -1,59 +1,172 @@
 import requests
+import hashlib
 import json
 import os
 import time
 import csv
 import geopandas as gpd
+import numpy as np
+from random import uniform
 from shapely.geometry import LineString, Point
-
-json_data = None
+from shapely.strtree import STRtree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import traffic_store_module as ts
+from feed_parser_module import read_feed
+
+# jam and alert columns of the feed in use
+feed_columns = None
 filepath = None
+TRAFFIC_FEED = "../resources/traffic_data.json"
+TRAFFIC_URL = os.environ.get(
+    "WALKSAFE_TRAFFIC_URL",
+    "https://www.waze.com/row-partnerhub-api/partners/11315398994/waze-feeds/d15f3f75-64f0-4455-8bdd-a9b1fc1d1d44?format=1")
+# ETag, Last-Modified and the hash of the jams of the last feed that went into the store
+FEED_STATE = "../resources/traffic_feed_state.json"
+# Seconds to connect and to wait for the feed, retries of failed requests with a growing pause
+REQUEST_TIMEOUT = float(os.environ.get("WALKSAFE_TRAFFIC_TIMEOUT", "10"))
+REQUEST_RETRIES = 3
+# The feed file is read instead of asking waze while it is younger than this
+FEED_MAX_AGE = 30 * 60
+_session = None
+# unix time of the last answer from waze, a 304 included, read from FEED_STATE the first time
+_last_fetch = None
+# Also dump every refresh as jams_/alerts_ shapefiles, for looking at them in a GIS
+EXPORT_SHAPEFILES = os.environ.get("WALKSAFE_EXPORT_SHAPEFILES", "0") == "1"
+
+"""
+Session reused by every request, keeps the connection to waze open and retries the failed requests
+"""
+
+
+def session():
+    global _session
+    if _session is None:
+        retry = Retry(total=REQUEST_RETRIES, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=("GET",))
+        _session = requests.Session()
+        _session.mount("https://", HTTPAdapter(max_retries=retry))
+        _session.mount("http://", HTTPAdapter(max_retries=retry))
+    return _session
+
+
+def _read_state():
+    if not os.path.exists(FEED_STATE):
+        return dict()
+    with open(FEED_STATE, "r") as file:
+        return json.load(file)
+
+
+def _write_state(state):
+    temporary_path = FEED_STATE + ".tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(state, file)
+    os.replace(temporary_path, FEED_STATE)
+
+
+def _record_fetch(state):
+    global _last_fetch
+    _last_fetch = time.time()
+    state["fetched"] = _last_fetch
+    _write_state(state)
+
+
+"""
+When waze last answered, the live jams stay current while it keeps confirming them
+Output: - unix time, None if it never answered
+"""
+
+
+def last_fetch_time():
+    global _last_fetch
+    if _last_fetch is None:
+        _last_fetch = _read_state().get("fetched")
+    return _last_fetch
+
+
+"""
+Hash of the jams of a feed, independent of their order
+Only the fields kept in the traffic store count, so a feed with new timestamps but the same jams is unchanged.
+Input: - jams: jam columns
+Output: - hex digest
+"""
+
+
+def jams_hash(jams):
+    starts = np.searchsorted(jams["jam_of_point"], np.arange(len(jams["level"]))).tolist()
+    ends = np.searchsorted(jams["jam_of_point"], np.arange(len(jams["level"])), side="right").tolist()
+    rows = sorted(np.concatenate((jams["x"][start:end], jams["y"][start:end],
+                                  [jams["level"][jam], jams["length"][jam], jams["roadtype"][jam]])).tobytes()
+                  for jam, (start, end) in enumerate(zip(starts, ends)))
+    digest = hashlib.sha256()
+    for row in rows:
+        digest.update(len(row).to_bytes(8, "little"))
+        digest.update(row)
+    return digest.hexdigest()
+
 
 """
 Sending requests to waze and getting traffic data
-Output: - data json
+The request is conditional on the ETag and Last-Modified of the last answer.
+The answer is streamed to the feed file and parsed from there, it is never held in memory whole.
+Input: - url of the feed
+Output: - jam columns, alert columns; None if the feed did not change or the request failed
 """
 
 
-def get_data():
-    global json_data
-    url = "https://www.waze.com/row-partnerhub-api/partners/11315398994/waze-feeds/d15f3f75-64f0-4455-8bdd-a9b1fc1d1d44?format=1"
+def get_data(url=None):
+    global feed_columns
+    url = TRAFFIC_URL if url is None else url
+    # without the saved feed a 304 would leave nothing to read
+    state = _read_state() if filepath is not None and os.path.exists(filepath) else dict()
+    headers = dict()
+    if state.get("etag"):
+        headers["If-None-Match"] = state["etag"]
+    if state.get("last_modified"):
+        headers["If-Modified-Since"] = state["last_modified"]
 
+    temporary_path = filepath + ".tmp"
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        json_data = response.json()
-        return json_data
-    except requests.exceptions.RequestException as e:
+        with session().get(url, headers=headers, timeout=REQUEST_TIMEOUT, stream=True) as response:
+            if response.status_code == 304:
+                print("Traffic feed not modified.")
+                _record_fetch(state)
+                return None
+            response.raise_for_status()
+            with open(temporary_path, "wb") as file:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    file.write(chunk)
+        columns = read_feed(temporary_path)
+    except (requests.exceptions.RequestException, ValueError) as e:
         print(f"Error fetching data; {e} ")
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
         return None
 
+    os.replace(temporary_path, filepath)
+    state["etag"] = response.headers.get("ETag")
+    state["last_modified"] = response.headers.get("Last-Modified")
+    _record_fetch(state)
+    feed_columns = columns
+    return feed_columns
+
 
 """
-creates a request if 30 minutes elapsed
+creates a request if 30 minutes elapsed, otherwise reads the saved feed
+Output: - True if a new feed was downloaded
 """
 
 
 def create_requests_for_traffic():
-    global json_data
-
-    if os.path.exists(filepath):
+    if not os.path.exists(filepath) or time.time() - os.path.getmtime(filepath) >= FEED_MAX_AGE:
         print("Request went out for traffic data.")
-        data = get_data()
-        data_to_file()
-    else:
+        if get_data() is not None:
+            return True
+
+    if feed_columns is None and os.path.exists(filepath):
         print("Loaded from file traffic data.")
         data_from_file()
-
-
-"""
-Data output to a file.
-"""
-
-
-def data_to_file():
-    with open(filepath, "w") as file:
-        json.dump(json_data, file)
+    return False
 
 
 """
@@ -62,9 +175,8 @@ Data input from a file.
 
 
 def data_from_file():
-    global json_data
-    with open(filepath, "r") as file:
-        json_data = json.load(file)
+    global feed_columns
+    feed_columns = read_feed(filepath)
 
 
 """
@@ -74,21 +186,18 @@ https://support.google.com/waze/partners/answer/13458165?sjid=440554581699751985
     -level of jam
     -length
     -roadtype
-INPUT: - jams dictionary
+INPUT: - jam columns
 OUTPUT: - list of important data
 """
 
 
 def extracting_jams(jams):
     table_data = []
-    row = []
-    for values in jams:
-        row.append(values["line"])
-        row.append(values["level"])
-        row.append(values["length"])
-        row.append(values["roadType"])
-        table_data.append(row)
-        row = []
+    starts = np.searchsorted(jams["jam_of_point"], np.arange(len(jams["level"]))).tolist()
+    ends = np.searchsorted(jams["jam_of_point"], np.arange(len(jams["level"])), side="right").tolist()
+    for jam, (start, end) in enumerate(zip(starts, ends)):
+        line = [{"x": x, "y": y} for x, y in zip(jams["x"][start:end].tolist(), jams["y"][start:end].tolist())]
+        table_data.append([line, int(jams["level"][jam]), float(jams["length"][jam]), int(jams["roadtype"][jam])])
 
     return table_data
 
@@ -100,34 +209,69 @@ https://support.google.com/waze/partners/answer/13458165?sjid=440554581699751985
     -type
     -reliability 0-10
     -confidence 0-10
-INPUT: - alerts dictionary
+INPUT: - alert columns
 OUTPUT: - list of important alert data
 """
 
 
 def extracting_alerts(alerts):
     table_data = []
-    row = []
-    for values in alerts:
-        row.append(values["location"])
-        row.append(values["type"])
-        row.append(values["confidence"])
-        row.append(values["reliability"])
-        table_data.append(row)
-        row = []
+    for x, y, alert_type, confidence, reliability in zip(alerts["x"].tolist(), alerts["y"].tolist(),
+                                                         alerts["type"].tolist(), alerts["confidence"].tolist(),
+                                                         alerts["reliability"].tolist()):
+        table_data.append([{"x": x, "y": y}, alert_type, confidence, reliability])
     return table_data
 
 
 """
-Transforming the json data into a table
+Jams of the saved feed as flat arrays, without building a table or any geometry
+Jams with less than two points are left out, they are not lines.
+Input: - path of the saved feed
+Output: - x, y: coordinates of the points of every jam one after the other
+        - jam_of_point: index of the jam every point belongs to
+        - levels: level of every jam
+"""
+
+
+def read_jam_arrays(path=TRAFFIC_FEED):
+    jams, _ = read_feed(path)
+    return ts.line_arrays(jams)
+
+
+"""
+Jams of the newest snapshot in the traffic store, the saved feed if the store is empty
+Output: - x, y, jam_of_point, levels like read_jam_arrays
+"""
+
+
+def latest_jam_arrays():
+    entry = ts.latest_snapshot()
+    if entry is None:
+        return read_jam_arrays(TRAFFIC_FEED)
+    return ts.line_arrays(ts.read_snapshot(entry, "jams"))
+
+
+"""
+File the newest jams are read from
+"""
+
+
+def latest_jams_path():
+    entry = ts.latest_snapshot()
+    if entry is None:
+        return TRAFFIC_FEED
+    return ts.snapshot_path(entry, "jams")
+
+
+"""
+Transforming the feed columns into a table
 Output: -table_data_jams,
         -table_data_alerts
 """
 
 
 def transform_data():
-    jams = json_data["jams"]
-    alerts = json_data["alerts"]
+    jams, alerts = feed_columns
 
     table_data_jams = extracting_jams(jams)
     table_data_alerts = extracting_alerts(alerts)
@@ -160,6 +304,32 @@ def is_line_in_existing(new_line, existing_lines):
     return False
 
 
+"""
+Lines kept when every line is dropped if it equals or intersects a line kept before it
+Same result as calling is_line_in_existing line by line, the intersecting pairs come from one STRtree self join.
+Input: - list of LineStrings in feed order
+Output: - list of booleans, True if the line is kept
+"""
+
+
+def kept_lines(lines):
+    # the feed can be empty, the tree can not be queried with no lines
+    if not lines:
+        return []
+    line_ids, other_ids = STRtree(lines).query(lines, predicate="intersects")
+    # a line only competes with the lines before it
+    earlier = other_ids < line_ids
+    line_ids = line_ids[earlier]
+    other_ids = other_ids[earlier].tolist()
+    starts = np.searchsorted(line_ids, np.arange(len(lines))).tolist()
+    ends = np.searchsorted(line_ids, np.arange(len(lines)), side="right").tolist()
+
+    kept = [False] * len(lines)
+    for i in range(len(lines)):
+        kept[i] = not any(kept[other] for other in other_ids[starts[i]:ends[i]])
+    return kept
+
+
 """
 Writes out a table type data into shp
 INPUT: - filename
@@ -177,18 +347,15 @@ def write_data_to_jams_shp(filename, data):
         4: 'purple',
         5: 'red',
     }
-    for line in data:
-        coords = line[0]
+    line_strings = [LineString([(point['x'], point['y']) for point in line[0]]) for line in data]
+    for line, line_String, kept in zip(data, line_strings, kept_lines(line_strings)):
         level = line[1]
         length = line[2]
         roadtype = line[3]
 
-        line_coords = [(point['x'], point['y']) for point in coords]
-        line_String = LineString(line_coords)
-
         color = color_map[level]
 
-        if not is_line_in_existing(line_String, lines):
+        if kept:
             lines.append({
                 'geometry': line_String,
                 'color': color,
@@ -229,41 +396,90 @@ def write_data_to_alerts_shp(filename, data):
 
 
 """
-Saves the fresh data
+Saves the fresh data into the traffic store, the shapefiles only with EXPORT_SHAPEFILES
 """
 
 
-def save_jams_and_alerts(table_data_alerts, table_data_jams):
-    timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
-    header = ["geometry", "level", "length", "roadtype"]
-    write_data_to_file_csv(f"../resources/table_data/jams_{timestamp}.csv", table_data_jams, header)
+def save_jams_and_alerts():
+    ts.append_snapshot(*feed_columns)
 
-    header = ["geometry", "type", "reliabilit", "confidence"]
-    write_data_to_file_csv(f"../resources/table_data/alerts_{timestamp}.csv", table_data_alerts, header)
+    if EXPORT_SHAPEFILES:
+        table_data_jams, table_data_alerts = transform_data()
+        timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
+        write_data_to_jams_shp(f"../resources/shapefiles/jams_{timestamp}.shp", table_data_jams)
+        write_data_to_alerts_shp(f"../resources/shapefiles/alerts_{timestamp}.shp", table_data_alerts)
 
-    write_data_to_jams_shp(f"../resources/shapefiles/jams_{timestamp}.shp", table_data_jams)
-    write_data_to_alerts_shp(f"../resources/shapefiles/alerts_{timestamp}.shp", table_data_alerts)
+
+"""
+Compares the line by line deduplication with kept_lines on random jams
+Input: number_of_jams
+"""
+
+
+def benchmark_deduplication(number_of_jams):
+    lines = []
+    for _ in range(number_of_jams):
+        x = uniform(23.5000, 23.7100)
+        y = uniform(46.7300, 46.8000)
+        points = [(x, y)]
+        for _ in range(5):
+            x = x + uniform(-0.002, 0.002)
+            y = y + uniform(-0.002, 0.002)
+            points.append((x, y))
+        lines.append(LineString(points))
+
+    start_time = time.perf_counter()
+    existing = []
+    expected = []
+    for line in lines:
+        keep = not is_line_in_existing(line, existing)
+        if keep:
+            existing.append({"geometry": line})
+        expected.append(keep)
+    pairwise_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    kept = kept_lines(lines)
+    indexed_time = time.perf_counter() - start_time
+
+    print(f"{number_of_jams} jams, {sum(kept)} kept: pairwise {pairwise_time:.3f}s, "
+          f"indexed {indexed_time:.3f}s, same result {kept == expected}")
 
 
 """
 Refreshes data.
+Output: - True if the jams changed and a snapshot was added to the store, False if the traffic layer can be kept
 """
 
 
 def refresh_traffic():
     global filepath
-    filepath = "../resources/traffic_data.json"
+    filepath = TRAFFIC_FEED
+    fetched_before = last_fetch_time()
     create_requests_for_traffic()
-    table_data_jams, table_data_alerts = transform_data()
-    save_jams_and_alerts(table_data_alerts, table_data_jams)
+    if feed_columns is None:
+        print("No traffic data.")
+        return False
+
+    state = _read_state()
+    key = jams_hash(feed_columns[0])
+    if key == state.get("jams") and ts.latest_snapshot() is not None:
+        # waze answered with the jams already stored, the hour it answered in still counts them
+        if last_fetch_time() != fetched_before:
+            ts.confirm_latest(last_fetch_time())
+        print("Traffic jams did not change.")
+        return False
+
+    save_jams_and_alerts()
+    state["jams"] = key
+    _write_state(state)
+    return True
 
 
 def main():
-    create_requests_for_traffic()
-    table_data_jams, table_data_alerts = transform_data()
-    save_jams_and_alerts(table_data_alerts, table_data_jams)
+    refresh_traffic()
 
 
 if __name__ == "__main__":
-    filepath = "../resources/traffic_data.json"
+    filepath = TRAFFIC_FEED
     main()
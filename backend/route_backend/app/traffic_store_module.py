@@ -0,0 +1,209 @@
+import bisect
+import json
+import os
+import shutil
+import time
+import numpy as np
+
+TRAFFIC_STORE = "../resources/traffic_store/"
+# Days of snapshots kept, older day partitions are deleted
+RETENTION_DAYS = int(os.environ.get("WALKSAFE_TRAFFIC_RETENTION_DAYS", "30"))
+
+"""
+Traffic history
+Every refresh appends one snapshot, the jams and the alerts as numpy columns (one npz file each)
+in a partition per day: date=YYYY-MM-DD/jams_HH-MM-SS.npz.
+index.json lists the snapshots in time order for range scans, latest.json points at the newest one.
+A fetch that finds the same jams as the newest snapshot only adds its time to the confirmed list of that snapshot.
+Jam lines are stored flat: x, y of every point and jam_of_point, the index of the jam in the snapshot.
+"""
+
+"""
+Jams of the feed as columns
+Input: - jams: list of jam dictionaries from the waze feed
+Output: - dictionary column name: numpy array
+"""
+
+
+def jam_columns(jams):
+    points = [point for jam in jams for point in jam["line"]]
+    counts = np.fromiter((len(jam["line"]) for jam in jams), dtype=np.int64, count=len(jams))
+    return {
+        "x": np.fromiter((point["x"] for point in points), dtype=np.float64, count=len(points)),
+        "y": np.fromiter((point["y"] for point in points), dtype=np.float64, count=len(points)),
+        "jam_of_point": np.repeat(np.arange(len(jams)), counts),
+        "level": np.fromiter((jam["level"] for jam in jams), dtype=np.int64, count=len(jams)),
+        "length": np.fromiter((jam.get("length", 0) for jam in jams), dtype=np.float64, count=len(jams)),
+        "roadtype": np.fromiter((jam.get("roadType", -1) for jam in jams), dtype=np.int64, count=len(jams)),
+    }
+
+
+"""
+Alerts of the feed as columns
+Input: - alerts: list of alert dictionaries from the waze feed
+Output: - dictionary column name: numpy array
+"""
+
+
+def alert_columns(alerts):
+    return {
+        "x": np.fromiter((alert["location"]["x"] for alert in alerts), dtype=np.float64, count=len(alerts)),
+        "y": np.fromiter((alert["location"]["y"] for alert in alerts), dtype=np.float64, count=len(alerts)),
+        "type": np.array([alert["type"] for alert in alerts], dtype=str),
+        "reliability": np.fromiter((alert["reliability"] for alert in alerts), dtype=np.int64, count=len(alerts)),
+        "confidence": np.fromiter((alert["confidence"] for alert in alerts), dtype=np.int64, count=len(alerts)),
+    }
+
+
+"""
+Jam lines with at least two points, the others are not lines
+Input: - columns from jam_columns or read_snapshot
+Output: - x, y, jam_of_point (renumbered from 0), levels
+"""
+
+
+def line_arrays(columns):
+    counts = np.bincount(columns["jam_of_point"], minlength=len(columns["level"]))
+    lines = counts >= 2
+    points = lines[columns["jam_of_point"]]
+    renumbered = np.cumsum(lines) - 1
+    return (columns["x"][points], columns["y"][points], renumbered[columns["jam_of_point"][points]],
+            columns["level"][lines])
+
+
+def _read_json(name, default):
+    path = os.path.join(TRAFFIC_STORE, name)
+    if not os.path.exists(path):
+        return default
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def _write_json(name, value):
+    path = os.path.join(TRAFFIC_STORE, name)
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(value, file)
+    os.replace(temporary_path, path)
+
+
+def _write_columns(path, columns):
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as file:
+        np.savez(file, **columns)
+    os.replace(temporary_path, path)
+
+
+"""
+Appends a snapshot of the feed
+Input: - jams, alerts: columns from jam_columns and alert_columns (or the streaming reader of feed_parser_module)
+       - snapshot_time: unix time of the snapshot, now if None
+Output: - index entry of the snapshot
+"""
+
+
+def append_snapshot(jams, alerts, snapshot_time=None):
+    snapshot_time = time.time() if snapshot_time is None else snapshot_time
+    partition = time.strftime("date=%Y-%m-%d", time.gmtime(snapshot_time))
+    name = time.strftime("%H-%M-%S", time.gmtime(snapshot_time))
+    os.makedirs(os.path.join(TRAFFIC_STORE, partition), exist_ok=True)
+
+    entry = {
+        "time": snapshot_time,
+        "jams": f"{partition}/jams_{name}.npz",
+        "alerts": f"{partition}/alerts_{name}.npz",
+    }
+    _write_columns(os.path.join(TRAFFIC_STORE, entry["jams"]), jams)
+    _write_columns(os.path.join(TRAFFIC_STORE, entry["alerts"]), alerts)
+
+    index = _read_json("index.json", [])
+    index.append(entry)
+    index.sort(key=lambda snapshot: snapshot["time"])
+    _write_json("index.json", index)
+    if entry is index[-1]:
+        _write_json("latest.json", entry)
+
+    apply_retention(snapshot_time)
+    return entry
+
+
+"""
+Records a fetch that saw the jams of the newest snapshot, nothing new is written
+Input: - fetch_time: unix time of the fetch
+"""
+
+
+def confirm_latest(fetch_time):
+    index = _read_json("index.json", [])
+    if not index:
+        return
+    index[-1].setdefault("confirmed", []).append(fetch_time)
+    _write_json("index.json", index)
+    _write_json("latest.json", index[-1])
+
+
+"""
+Deletes the day partitions older than the retention
+Input: - now: unix time
+"""
+
+
+def apply_retention(now=None, retention_days=RETENTION_DAYS):
+    now = time.time() if now is None else now
+    oldest_kept = time.strftime("date=%Y-%m-%d", time.gmtime(now - retention_days * 24 * 60 * 60))
+
+    index = _read_json("index.json", [])
+    kept = [entry for entry in index if entry["jams"].split("/")[0] >= oldest_kept]
+    if len(kept) != len(index):
+        _write_json("index.json", kept)
+
+    for partition in os.listdir(TRAFFIC_STORE):
+        if partition.startswith("date=") and partition < oldest_kept:
+            shutil.rmtree(os.path.join(TRAFFIC_STORE, partition))
+
+
+"""
+Newest snapshot
+Output: - index entry, None if the store is empty
+"""
+
+
+def latest_snapshot():
+    return _read_json("latest.json", None)
+
+
+"""
+Snapshots taken in [start, end)
+Input: - start, end: unix times
+Output: - list of index entries in time order
+"""
+
+
+def snapshots_between(start, end):
+    index = _read_json("index.json", [])
+    times = [entry["time"] for entry in index]
+    return index[bisect.bisect_left(times, start):bisect.bisect_left(times, end)]
+
+
+"""
+Path of a file of a snapshot
+Input: - entry: index entry
+       - kind: jams or alerts
+"""
+
+
+def snapshot_path(entry, kind="jams"):
+    return os.path.join(TRAFFIC_STORE, entry[kind])
+
+
+"""
+Reads the columns of a snapshot
+Input: - entry: index entry
+       - kind: jams or alerts
+Output: - dictionary column name: numpy array
+"""
+
+
+def read_snapshot(entry, kind="jams"):
+    with np.load(snapshot_path(entry, kind)) as columns:
+        return {name: columns[name] for name in columns.files}
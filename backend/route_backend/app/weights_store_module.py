@@ -0,0 +1,100 @@
+import os
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+try:
+    import pyarrow.parquet as pq
+    ARROW_AVAILABLE = True
+except ImportError:
+    ARROW_AVAILABLE = False
+
+WEIGHTS_PARQUET = "../resources/weights_data.parquet"
+WEIGHTS_CSV = "../resources/weights_data.csv"
+INDEX_COLUMNS = ["u", "v", "key"]
+SCORE_COLUMNS = ['tree_vs_urban_score', 'tree_cover_score', 'water_score', 'AQI_score', 'traffic']
+EPSG = 4326
+
+"""
+Edge weights table on disk
+GeoParquet (WKB geometry, (u,v,key) kept as the index, float32 scores) when pyarrow is installed,
+the old csv with WKT geometry otherwise.
+"""
+
+"""
+File the weights are read from
+Output: - path, None if nothing was saved yet
+"""
+
+
+def weights_path():
+    if ARROW_AVAILABLE and os.path.exists(WEIGHTS_PARQUET):
+        return WEIGHTS_PARQUET
+    if os.path.exists(WEIGHTS_CSV):
+        return WEIGHTS_CSV
+    return None
+
+
+"""
+Is it saved or not
+Output: True, False
+"""
+
+
+def weights_saved():
+    return weights_path() is not None
+
+
+"""
+Saves the weights dataframe
+Input: - df indexed by u,v,key with length, geometry and the scores
+"""
+
+
+def write_weights(df):
+    if not ARROW_AVAILABLE:
+        df.to_csv(WEIGHTS_CSV)
+        return WEIGHTS_CSV
+
+    scores = [column for column in SCORE_COLUMNS if column in df.columns]
+    stored = df.astype({column: "float32" for column in scores})
+    # uncompressed, so a memory mapped read does not have to decompress the pages
+    # written next to the old file and swapped, the router never reads a half written table
+    temporary_path = WEIGHTS_PARQUET + ".tmp"
+    stored.to_parquet(temporary_path, index=True, compression=None)
+    os.replace(temporary_path, WEIGHTS_PARQUET)
+    return WEIGHTS_PARQUET
+
+
+"""
+Reads the weights dataframe
+Input: - columns: columns to read, None for all of them
+       - geometry: False skips decoding the geometry
+Output: - dataframe indexed by u,v,key, a GeoDataFrame in EPSG 4326 when the geometry is read
+"""
+
+
+def read_weights(columns=None, geometry=True):
+    path = weights_path()
+    if path is None:
+        return None
+
+    if path == WEIGHTS_PARQUET:
+        wanted = None if columns is None else list(columns)
+        if not geometry:
+            if wanted is None:
+                wanted = [name for name in pq.read_schema(path).names
+                          if name not in INDEX_COLUMNS and name != "geometry"]
+            return pd.read_parquet(path, columns=wanted, memory_map=True)
+        if wanted is not None and "geometry" not in wanted:
+            wanted.append("geometry")
+        return gpd.read_parquet(path, columns=wanted, memory_map=True)
+
+    usecols = None if columns is None else INDEX_COLUMNS + [name for name in columns if name != "geometry"] + (
+        ["geometry"] if geometry else [])
+    df = pd.read_csv(path, usecols=usecols)
+    df.set_index(INDEX_COLUMNS, inplace=True)
+    if not geometry:
+        return df.drop(columns="geometry", errors="ignore")
+    df["geometry"] = shapely.from_wkt(df["geometry"].to_numpy())
+    return gpd.GeoDataFrame(df, geometry="geometry", crs=EPSG)
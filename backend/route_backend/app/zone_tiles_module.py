@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import shapely
+import geopandas as gpd
+from shapely.strtree import STRtree
+from layer_cache_module import file_hash
+
+ZONE_CACHE_DIRECTORY = "../resources/zone_cache/"
+# Metres the outline may move when it is simplified
+SIMPLIFY_TOLERANCE = 0.5
+# Side of the grid squares the zones are cut into, in metres
+TILE_SIZE = 200
+
+"""
+Tree and urban zones prepared for the layers
+The zones are clipped to the area of the graph, simplified and cut into a grid of small pieces,
+so the STRtree only returns the few pieces next to an edge and every intersection is with a small polygon.
+The pieces are cached on disk next to a hash of the source file and the settings.
+"""
+
+"""
+Clips, simplifies and cuts the zones
+Input: - geometries: array of polygons in metres
+       - bounds: xmin, ymin, xmax, ymax to keep
+       - tolerance, tile_size in metres
+Output: - array of polygons
+"""
+
+
+def subdivide_zones(geometries, bounds, tolerance=SIMPLIFY_TOLERANCE, tile_size=TILE_SIZE):
+    xmin, ymin, xmax, ymax = bounds
+    geometries = shapely.make_valid(shapely.clip_by_rect(geometries, xmin, ymin, xmax, ymax))
+    geometries = shapely.simplify(geometries, tolerance, preserve_topology=True)
+    geometries = geometries[~shapely.is_empty(geometries)]
+
+    xs = np.arange(xmin, xmax, tile_size)
+    ys = np.arange(ymin, ymax, tile_size)
+    grid_x, grid_y = np.meshgrid(xs, ys)
+    tiles = shapely.box(grid_x.ravel(), grid_y.ravel(), grid_x.ravel() + tile_size, grid_y.ravel() + tile_size)
+
+    tile_ids, zone_ids = STRtree(geometries).query(tiles)
+    pieces = shapely.intersection(geometries[zone_ids], tiles[tile_ids])
+    # the intersection of touching shapes can leave lines and points, only the polygons cover anything
+    pieces = shapely.get_parts(pieces)
+    pieces = pieces[shapely.get_type_id(pieces) == shapely.GeometryType.POLYGON]
+    return pieces[shapely.area(pieces) > 0]
+
+
+def _cache_path(path, epsg, bounds, tolerance, tile_size):
+    description = {
+        "source": file_hash(path),
+        "epsg": epsg,
+        "bounds": [round(value, 1) for value in bounds],
+        "tolerance": tolerance,
+        "tile_size": tile_size,
+    }
+    key = hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(ZONE_CACHE_DIRECTORY, f"{name}_{key}.gpkg")
+
+
+"""
+Zones of a file ready for the layers, read from the cache when it was prepared before
+Input: - path of the zone file
+       - epsg: metric crs of the edges
+       - bounds: xmin, ymin, xmax, ymax of the area the layers look at, in epsg
+Output: - array of polygons in epsg
+"""
+
+
+def zone_pieces(path, epsg, bounds, tolerance=SIMPLIFY_TOLERANCE, tile_size=TILE_SIZE):
+    cache_path = _cache_path(path, epsg, bounds, tolerance, tile_size)
+    if os.path.exists(cache_path):
+        return gpd.read_file(cache_path).geometry.to_numpy()
+
+    start_time = time.perf_counter()
+    zones = gpd.read_file(path)
+    zones.to_crs(epsg=epsg, inplace=True)
+    pieces = subdivide_zones(zones.geometry.to_numpy(), bounds, tolerance, tile_size)
+    print(f"{os.path.basename(path)}: {len(zones)} zones with {shapely.get_num_coordinates(zones.geometry.to_numpy()).sum()} "
+          f"points cut into {len(pieces)} pieces with {shapely.get_num_coordinates(pieces).sum()} points "
+          f"in {time.perf_counter() - start_time:.2f}s")
+
+    os.makedirs(ZONE_CACHE_DIRECTORY, exist_ok=True)
+    # the layers run in separate processes and can prepare the same zones at once, each writes its own file
+    temporary_path = cache_path[:-len(".gpkg")] + f".{os.getpid()}.tmp.gpkg"
+    gpd.GeoDataFrame(geometry=pieces, crs=epsg).to_file(temporary_path, driver="GPKG")
+    os.replace(temporary_path, cache_path)
+    return pieces
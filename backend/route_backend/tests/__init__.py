@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The app modules import each other by their flat names, as when they run from the app directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
@@ -0,0 +1,137 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import pandas as pd
+
+import AQIapi
+
+POINTS = [(46.73 + 0.01 * i, 23.5 + 0.02 * i) for i in range(8)]
+
+"""
+Stands in for the air quality api: answers with a reading that depends on the latitude,
+fails a number of requests with 503 first and always fails the points in unreachable
+"""
+
+
+class AqiHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        location = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["location"]
+        point = (round(location["latitude"], 6), round(location["longitude"], 6))
+        with server.lock:
+            server.requests.append((time.monotonic(), point))
+            server.credentials.append((self.path, self.headers.get("X-Goog-Api-Key")))
+            failing = server.failures > 0 or point in server.unreachable
+            if server.failures > 0:
+                server.failures -= 1
+        if failing:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = json.dumps({"indexes": [{"code": "uaqi", "aqi": int(location["latitude"] * 100) % 100}]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AqiCollectorTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        app_directory = os.path.join(directory.name, "app")
+        os.makedirs(app_directory)
+        os.makedirs(os.path.join(directory.name, "resources"))
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(app_directory)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), AqiHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.credentials = []
+        self.server.failures = 0
+        self.server.unreachable = set()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        for name, value in [("AQI_URL", f"http://127.0.0.1:{self.server.server_port}/lookup"),
+                            ("AQI_KEY", "test-key")]:
+            patch = mock.patch.object(AQIapi, name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.data = pd.DataFrame(POINTS)
+
+    def asked_points(self):
+        return [point for _, point in self.server.requests]
+
+    def test_failed_requests_are_retried(self):
+        self.server.failures = 3
+
+        self.assertTrue(AQIapi.running_on_data(self.data))
+
+        self.assertEqual(len(self.server.requests), len(POINTS) + 3)
+        with open(AQIapi.AQI_DATA) as file:
+            responses = json.load(file)
+        self.assertEqual([AQIapi.universal_aqi(response) for response in responses],
+                         [int(lat * 100) % 100 for lat, _ in POINTS])
+        self.assertEqual(len(pd.read_csv(AQIapi.AQI_COORDINATES)), len(POINTS))
+
+    def test_requests_keep_to_the_rate(self):
+        rate = 20
+        AQIapi.fetch_points(POINTS, workers=4, rate=rate)
+
+        starts = sorted(start for start, _ in self.server.requests)
+        self.assertEqual(len(starts), len(POINTS))
+        # the limiter spaces the starts, the threads only add delay on top
+        self.assertGreaterEqual(starts[-1] - starts[0], (len(POINTS) - 1) / rate * 0.9)
+
+    def test_key_is_sent_in_a_header(self):
+        AQIapi.fetch_points(POINTS[:2], workers=1, rate=100)
+
+        self.assertEqual(self.server.credentials, [("/lookup", "test-key")] * 2)
+
+    def test_checkpoint_expires_with_the_readings(self):
+        self.assertEqual(AQIapi.CHECKPOINT_MAX_AGE, AQIapi.AQI_MAX_AGE)
+        AQIapi.fetch_points(POINTS[:2], workers=1, rate=100)
+        stale = time.time() - AQIapi.AQI_MAX_AGE - 1
+        os.utime(AQIapi._checkpoint_path(*POINTS[0]), (stale, stale))
+
+        self.server.requests = []
+        AQIapi.fetch_points(POINTS[:2], workers=1, rate=100)
+
+        self.assertEqual(self.asked_points(), [(round(POINTS[0][0], 6), round(POINTS[0][1], 6))])
+
+    def test_interrupted_collection_resumes_from_the_checkpoint(self):
+        unreachable = {(round(lat, 6), round(lon, 6)) for lat, lon in POINTS[5:]}
+        self.server.unreachable = set(unreachable)
+
+        with mock.patch.object(AQIapi, "REQUEST_RETRIES", 0):
+            self.assertFalse(AQIapi.running_on_data(self.data))
+        # nothing is saved until every point answered, the answers wait in the checkpoint
+        self.assertFalse(os.path.exists(AQIapi.AQI_DATA))
+        self.assertEqual(len(os.listdir(AQIapi.CHECKPOINT_DIRECTORY)), 5)
+
+        self.server.unreachable = set()
+        self.server.requests = []
+        self.assertTrue(AQIapi.running_on_data(self.data))
+
+        self.assertEqual(set(self.asked_points()), unreachable)
+        self.assertEqual(len(self.asked_points()), len(unreachable))
+        self.assertTrue(os.path.exists(AQIapi.AQI_DATA))
+        self.assertFalse(os.path.exists(AQIapi.CHECKPOINT_DIRECTORY))
+
+
+if __name__ == "__main__":
+    unittest.main()
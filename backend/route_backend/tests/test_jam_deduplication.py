@@ -0,0 +1,57 @@
+import unittest
+
+import numpy as np
+from shapely.geometry import LineString
+
+import traffic_module as tm
+
+"""
+Lines kept by the line by line loop kept_lines replaced
+"""
+
+
+def kept_by_loop(lines):
+    existing = []
+    kept = []
+    for line in lines:
+        keep = not tm.is_line_in_existing(line, existing)
+        if keep:
+            existing.append({"geometry": line})
+        kept.append(keep)
+    return kept
+
+
+class JamDeduplicationTest(unittest.TestCase):
+    def random_lines(self, count, seed):
+        generator = np.random.default_rng(seed)
+        lines = []
+        for _ in range(count):
+            start = generator.uniform([23.50, 46.73], [23.71, 46.80])
+            steps = generator.uniform(-0.002, 0.002, (5, 2))
+            lines.append(LineString(np.vstack([start, start + np.cumsum(steps, axis=0)])))
+        # the feed repeats jams, some exactly and some reversed
+        for index in generator.choice(count, count // 10, replace=False).tolist():
+            lines.append(lines[index])
+            lines.append(LineString(list(lines[index].coords)[::-1]))
+        return [lines[index] for index in generator.permutation(len(lines)).tolist()]
+
+    def test_same_lines_as_the_loop(self):
+        for seed in range(5):
+            lines = self.random_lines(600, seed)
+            kept = tm.kept_lines(lines)
+            self.assertEqual(kept, kept_by_loop(lines))
+            self.assertLess(sum(kept), len(lines))
+
+    def test_first_of_the_duplicates_is_kept(self):
+        line = LineString([(23.60, 46.75), (23.61, 46.76)])
+        crossing = LineString([(23.60, 46.76), (23.61, 46.75)])
+        apart = LineString([(23.70, 46.75), (23.71, 46.76)])
+
+        self.assertEqual(tm.kept_lines([line, line, crossing, apart]), [True, False, False, True])
+
+    def test_empty_feed(self):
+        self.assertEqual(tm.kept_lines([]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+import resource_generator as rg
+
+LAYER_COLUMNS = ["tree_vs_urban_score", "tree_cover_score", "water_score"]
+
+
+class LayerWorkersTest(unittest.TestCase):
+    def setUp(self):
+        # the layers read ../resources from the working directory, the spawned workers start in the same one
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        app_directory = os.path.join(directory.name, "app")
+        resources = os.path.join(directory.name, "resources")
+        os.makedirs(app_directory)
+        os.makedirs(resources)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(app_directory)
+
+        generator = np.random.default_rng(32)
+        x0, y0 = 430000, 4920000
+        starts = generator.uniform(0, 2000, (300, 2))
+        ends = starts + generator.uniform(-150, 150, (300, 2))
+        self.edges = shapely.linestrings(np.stack([starts, ends], axis=1) + [x0, y0])
+
+        for name in ["Trees_only_data", "Urban_only_data"]:
+            centres = shapely.points(generator.uniform(0, 2000, (40, 2)) + [x0, y0])
+            zones = shapely.buffer(centres, generator.uniform(20, 250, 40))
+            gpd.GeoDataFrame(geometry=zones, crs=rg.epsg_m).to_crs(epsg=4326).to_file(
+                os.path.join(resources, f"{name}.gpkg"), driver="GPKG")
+
+        wells = gpd.GeoSeries(shapely.points(generator.uniform(0, 2000, (60, 2)) + [x0, y0]), crs=rg.epsg_m)
+        wells = wells.to_crs(epsg=4326)
+        pd.DataFrame({"xcoord": wells.x, "ycoord": wells.y}).to_csv(os.path.join(resources, "final_water_data.csv"),
+                                                                     index=False)
+
+    def test_pool_matches_serial(self):
+        pooled = rg.run_layers(LAYER_COLUMNS, self.edges, workers=3)
+        serial = rg.run_layers(LAYER_COLUMNS, self.edges, workers=1)
+
+        self.assertEqual(set(pooled), set(LAYER_COLUMNS))
+        for column in LAYER_COLUMNS:
+            self.assertEqual(len(serial[column][0]), len(self.edges))
+            self.assertTrue(np.any(serial[column][0] != 0), column)
+            np.testing.assert_array_equal(pooled[column][0], serial[column][0], err_msg=column)
+
+
+if __name__ == "__main__":
+    unittest.main()
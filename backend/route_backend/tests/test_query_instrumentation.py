@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from fastapi.testclient import TestClient
+
+import a_star_module as a
+import api_code
+import metrics_module as m
+import slow_query_module as s
+
+PAYLOAD = {"start": {"latitude": 46.77, "longitude": 23.59}, "finish": {"latitude": 46.76, "longitude": 23.6},
+           "tags": []}
+
+
+class QueryInstrumentationTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # the lifespan is not run, no snapshot is loaded, a_star is replaced in every test
+        api_code.snapshot_ready_event.set()
+        patches = [mock.patch.object(m, "_counters", dict()), mock.patch.object(m, "_histograms", dict()),
+                   mock.patch.object(s, "RING_DIRECTORY", os.path.join(directory.name, "slow_queries") + "/"),
+                   mock.patch.object(a, "snapshot_info", return_value={"snapshot_version": 1})]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.client = TestClient(api_code.app)
+
+    def test_failed_query_is_counted_timed_and_captured(self):
+        with mock.patch.object(a, "a_star", side_effect=KeyError("goal")):
+            response = self.client.post("/routes/", json=PAYLOAD)
+
+        self.assertEqual(response.status_code, 500)
+        metrics = m.render_metrics()
+        self.assertIn('routing_queries_total{status="error"} 1.0', metrics)
+        self.assertIn('routing_query_errors_total{error="KeyError"} 1.0', metrics)
+        self.assertIn("routing_query_seconds_count 1", metrics)
+        captures = s.load_captures()
+        self.assertEqual(len(captures), 1)
+        self.assertEqual(captures[0]["stats"]["status"], "error")
+        self.assertEqual(captures[0]["stats"]["error"], "KeyError")
+
+    def test_answered_queries_are_counted_by_status(self):
+        def a_star(start, finish, type_of_return, tags, stats):
+            stats["total_time"] = 0.01
+            return {"routes": []} if start[0] > 0 else None
+
+        with mock.patch.object(a, "a_star", side_effect=a_star):
+            self.client.post("/routes/", json=PAYLOAD)
+            self.client.post("/routes/", json=dict(PAYLOAD, start={"latitude": -1, "longitude": 23.59}))
+
+        metrics = m.render_metrics()
+        self.assertEqual(metrics.count("# TYPE routing_queries_total counter"), 1)
+        self.assertIn('routing_queries_total{status="ok"} 1.0', metrics)
+        self.assertIn('routing_queries_total{status="no_path"} 1.0', metrics)
+        self.assertNotIn("routing_query_errors_total", metrics)
+        # fast queries which answered are not captured
+        self.assertEqual(s.load_captures(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
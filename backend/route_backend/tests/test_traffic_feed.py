@@ -0,0 +1,134 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import traffic_module as tm
+import traffic_store_module as ts
+
+
+def feed(jams, published):
+    return {"startTimeMillis": published, "jams": jams,
+            "alerts": [{"location": {"x": 23.6, "y": 46.77}, "type": "HAZARD", "reliability": 5, "confidence": 1}]}
+
+
+def jam(x, level):
+    return {"line": [{"x": x, "y": 46.77}, {"x": x + 0.001, "y": 46.771}], "level": level, "length": 120,
+            "roadType": 2, "pubMillis": 0}
+
+
+JAMS = [jam(23.60, 3), jam(23.61, 4)]
+
+"""
+Stands in for waze: answers with the feed and its ETag, 304 when the client already has that ETag
+"""
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if server.failures > 0:
+            server.failures -= 1
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.headers.get("If-None-Match") == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps(server.feed).encode()
+        self.send_response(200)
+        self.send_header("ETag", server.etag)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TrafficFeedTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        app_directory = os.path.join(directory.name, "app")
+        os.makedirs(app_directory)
+        os.makedirs(os.path.join(directory.name, "resources"))
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(app_directory)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FeedHandler)
+        self.server.requests = []
+        self.server.failures = 0
+        self.server.etag = '"1"'
+        self.server.feed = feed(JAMS, 1)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        # every refresh asks the stub, the saved feed is never young enough to be reused
+        patches = [mock.patch.object(tm, "TRAFFIC_URL", f"http://127.0.0.1:{self.server.server_port}/feed"),
+                   mock.patch.object(tm, "FEED_MAX_AGE", 0), mock.patch.object(tm, "feed_columns", None),
+                   mock.patch.object(tm, "_session", None), mock.patch.object(tm, "_last_fetch", None)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def snapshot_count(self):
+        return len(ts.snapshots_between(0, float("inf")))
+
+    def test_not_modified_feed_is_skipped(self):
+        self.assertTrue(tm.refresh_traffic())
+        self.assertNotIn("If-None-Match", self.server.requests[0])
+
+        self.assertFalse(tm.refresh_traffic())
+        self.assertEqual(self.server.requests[1]["If-None-Match"], '"1"')
+        self.assertEqual(self.snapshot_count(), 1)
+        # waze confirmed the stored jams, the fetch counts for the history and keeps the live jams fresh
+        self.assertEqual(ts.latest_snapshot()["confirmed"], [tm.last_fetch_time()])
+        self.assertGreater(tm.last_fetch_time(), ts.latest_snapshot()["time"])
+
+    def test_unchanged_jams_are_skipped(self):
+        self.assertTrue(tm.refresh_traffic())
+
+        # a new ETag and timestamp, the same jams in another order
+        self.server.etag = '"2"'
+        self.server.feed = feed(JAMS[::-1], 2)
+        self.assertFalse(tm.refresh_traffic())
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.snapshot_count(), 1)
+        self.assertEqual(len(ts.latest_snapshot()["confirmed"]), 1)
+
+        self.server.etag = '"3"'
+        self.server.feed = feed(JAMS + [jam(23.62, 5)], 3)
+        self.assertTrue(tm.refresh_traffic())
+        self.assertEqual(self.snapshot_count(), 2)
+
+    def test_failed_requests_are_retried(self):
+        self.server.failures = 2
+
+        self.assertTrue(tm.refresh_traffic())
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_unreachable_feed_keeps_the_saved_one(self):
+        self.assertTrue(tm.refresh_traffic())
+        fetched = tm.last_fetch_time()
+        self.server.failures = tm.REQUEST_RETRIES + 1
+
+        with mock.patch.object(tm, "feed_columns", None):
+            self.assertFalse(tm.refresh_traffic())
+            self.assertIsNotNone(tm.feed_columns)
+        self.assertEqual(self.snapshot_count(), 1)
+        # no answer, the live jams age and nothing is confirmed
+        self.assertEqual(tm.last_fetch_time(), fetched)
+        self.assertNotIn("confirmed", ts.latest_snapshot())
+
+
+if __name__ == "__main__":
+    unittest.main()
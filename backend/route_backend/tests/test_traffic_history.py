@@ -0,0 +1,213 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+from zoneinfo import ZoneInfo
+
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import LineString
+
+import a_star_module as a
+import traffic_history_module as th
+import traffic_module as tm
+import traffic_store_module as ts
+from graph_compaction_module import contract_degree_two, chain_positions
+from graph_compiler_module import compile_graph, TRAFFIC, VALUE_COLUMNS
+
+# 0 - 1 = north (2) = 4 - 5
+#       = south (3) =
+NODES = {0: (45.0, 24.999), 1: (45.0, 25.0), 2: (45.001, 25.0005), 3: (44.999, 25.0005), 4: (45.0, 25.001),
+         5: (45.0, 25.002)}
+EDGES = [(0, 1, 1.0), (1, 2, 2.0), (2, 4, 2.0), (1, 3, 3.0), (3, 4, 3.0), (4, 5, 0.0)]
+NORTH = (NODES[2][1], NODES[2][0])
+SOUTH = (NODES[3][1], NODES[3][0])
+
+
+def moment(day, hour):
+    return datetime(2026, 10, 19 + day, hour, 30, tzinfo=ZoneInfo(th.TIMEZONE)).timestamp()
+
+
+class TrafficHistoryTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # traffic only counts with a weight, waze never answered unless a test says so
+        patches = [mock.patch.object(th, "HISTORY_FILE", os.path.join(directory.name, "traffic_history.npz")),
+                   mock.patch.object(ts, "TRAFFIC_STORE", os.path.join(directory.name, "traffic_store") + "/"),
+                   mock.patch.object(a, "TRAFFIC_WEIGHT", 0.1),
+                   mock.patch.object(tm, "_last_fetch", None),
+                   mock.patch.object(tm, "FEED_STATE", os.path.join(directory.name, "traffic_feed_state.json"))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.gdf = gpd.GeoDataFrame({
+            "u": [u for u, _, _ in EDGES],
+            "v": [v for _, v, _ in EDGES],
+            "key": 0,
+            "length": [80.0] * len(EDGES),
+            "traffic": [traffic for _, _, traffic in EDGES],
+            "tree_vs_urban_score": 0.5,
+            "tree_cover_score": 0.5,
+            "water_score": 0.5,
+            "AQI_score": 50.0,
+            "geometry": [LineString([NODES[u][::-1], NODES[v][::-1]]) for u, v, _ in EDGES],
+        }, crs=4326).set_index(["u", "v"])
+        self.dict_neighbours = {node: [] for node in NODES}
+        for u, v, _ in EDGES:
+            self.dict_neighbours[u].append(v)
+            self.dict_neighbours[v].append(u)
+
+    """
+    Writes a history where the north edges are jammed at 3h and the south ones are slow,
+    the south ones are jammed at 15h, nothing else is filled. The last edge is jammed at 3h, it is on both ways.
+    """
+
+    def write_history(self):
+        levels = np.zeros((len(EDGES), th.BUCKETS), dtype=np.uint8)
+        counts = np.zeros(th.BUCKETS, dtype=np.int64)
+        night, day = th.bucket_of(moment(0, 3)), th.bucket_of(moment(0, 15))
+        levels[[1, 2], night] = 5 * th.LEVEL_SCALE
+        levels[[3, 4], night] = 1 * th.LEVEL_SCALE
+        levels[5, night] = 5 * th.LEVEL_SCALE
+        levels[[3, 4], day] = 5 * th.LEVEL_SCALE
+        counts[[night, day]] = 4
+        th._write_history({"levels": levels, "counts": counts, "u": self.gdf.index.get_level_values(0).to_numpy(),
+                           "v": self.gdf.index.get_level_values(1).to_numpy(), "key": self.gdf["key"].to_numpy()})
+
+    """
+    Builds the router snapshot of the graph the way initialization does, without the contraction
+    """
+
+    def install_snapshot(self):
+        live_levels = self.gdf["traffic"].to_numpy(dtype=float, copy=True)
+        gdf_reset = a.normalize(self.gdf.copy())
+        dict_id_yx = dict(NODES)
+        dict_yx_id = {yx: node for node, yx in NODES.items()}
+        compiled = compile_graph(gdf_reset, self.dict_neighbours, dict_id_yx)
+        th.attach_history(compiled, gdf_reset, live_levels, gdf_reset, dict())
+        a._install_snapshot((4326, None, None, None, None, gdf_reset, dict_yx_id, dict_id_yx, self.dict_neighbours,
+                             dict(), compiled))
+        return compiled
+
+    def route_at(self, unix_time):
+        stats = dict()
+        with mock.patch.object(a.time, "time", return_value=unix_time):
+            path, cost = a.a_star((45.0001, 24.9995), (45.0001, 25.0015), False, [], stats)
+        self.assertEqual(stats["traffic_bucket"], th.bucket_of(unix_time))
+        return path, cost
+
+    def test_same_query_follows_the_hour(self):
+        self.write_history()
+        compiled = self.install_snapshot()
+        static_values = compiled.edge_values.copy()
+
+        night_path, night_cost = self.route_at(moment(0, 3))
+        day_path, day_cost = self.route_at(moment(0, 15))
+
+        self.assertIn(SOUTH, night_path)
+        self.assertNotIn(NORTH, night_path)
+        self.assertIn(NORTH, day_path)
+        self.assertNotIn(SOUTH, day_path)
+        self.assertNotAlmostEqual(night_cost, day_cost)
+        # the query got its own column, the shared graph is left as it was
+        np.testing.assert_array_equal(compiled.edge_values, static_values)
+
+    def test_empty_bucket_keeps_the_static_traffic(self):
+        self.write_history()
+        compiled = self.install_snapshot()
+
+        column, _, bucket = compiled.select_traffic(moment(2, 9))
+
+        self.assertEqual(bucket, th.bucket_of(moment(2, 9)))
+        np.testing.assert_allclose(column, compiled.edge_values[:, TRAFFIC])
+        self.assertIn(NORTH, self.route_at(moment(2, 9))[0])
+
+    def test_bucket_columns_are_built_once(self):
+        self.write_history()
+        compiled = self.install_snapshot()
+
+        history = compiled.traffic_history
+        self.assertEqual(history.columns.shape, (len(compiled.edge_rows), th.BUCKETS))
+        self.assertTrue(history.columns.flags.f_contiguous)
+        # a query gets a view of the column of its bucket, nothing is computed per query
+        column, _, _ = compiled.select_traffic(moment(0, 3))
+        self.assertTrue(np.shares_memory(column, history.columns))
+
+    def test_fresh_live_jams_replace_the_history(self):
+        self.write_history()
+        compiled = self.install_snapshot()
+        now = moment(0, 3)
+        tm._last_fetch = now - 30 * 60
+
+        # every edge takes its live level, the ones without a live jam included
+        column, _, _ = compiled.select_traffic(now)
+        np.testing.assert_allclose(column, compiled.edge_values[:, TRAFFIC])
+        self.assertEqual(column[compiled.edge_rows.tolist().index(5)], 0)
+        self.assertIn(NORTH, self.route_at(now)[0])
+        # waze did not answer for LIVE_MAX_AGE, the history is used again
+        self.assertIn(SOUTH, self.route_at(now + 20 * 60)[0])
+
+    def test_confirmed_fetches_count_in_their_hour(self):
+        jams = ts.jam_columns([])
+        alerts = ts.alert_columns([])
+        ts.append_snapshot(jams, alerts, moment(0, 3))
+        ts.confirm_latest(moment(0, 4))
+        ts.confirm_latest(moment(0, 5))
+
+        entries, times = th.fetches_since(-np.inf)
+        self.assertEqual(len(entries), 1)
+        self.assertEqual([th.bucket_of(fetch_time) for fetch_time in times[0]], [3, 4, 5])
+        entries, times = th.fetches_since(moment(0, 4))
+        self.assertEqual(times, [[moment(0, 5)]])
+        self.assertEqual(ts.latest_snapshot()["confirmed"], [moment(0, 4), moment(0, 5)])
+
+
+    def test_merged_edge_is_split_with_the_traffic_of_the_query(self):
+        # 0 - 1 - 2 - 3, the contraction leaves one edge from 0 to 3 with 1 and 2 removed
+        nodes = {node: (45.0, 25.0 + 0.001 * node) for node in range(4)}
+        gdf = gpd.GeoDataFrame({
+            "u": [0, 1, 2], "v": [1, 2, 3], "key": 0, "length": 80.0, "traffic": [0.0, 2.0, 4.0],
+            "tree_vs_urban_score": 0.5, "tree_cover_score": 0.5, "water_score": 0.5, "AQI_score": 50.0,
+            "geometry": [LineString([nodes[u][::-1], nodes[u + 1][::-1]]) for u in range(3)],
+        }, crs=4326).set_index(["u", "v"])
+        dict_neighbours = {0: [1], 1: [0, 2], 2: [1, 3], 3: [2]}
+        levels = np.zeros((3, th.BUCKETS), dtype=np.uint8)
+        counts = np.zeros(th.BUCKETS, dtype=np.int64)
+        night = th.bucket_of(moment(0, 3))
+        # the first segment is jammed at night, the other two are free
+        levels[0, night] = 5 * th.LEVEL_SCALE
+        counts[night] = 1
+        th._write_history({"levels": levels, "counts": counts, "u": np.array([0, 1, 2]), "v": np.array([1, 2, 3]),
+                           "key": np.zeros(3, dtype=np.int64)})
+
+        live_levels = gdf["traffic"].to_numpy(dtype=float, copy=True)
+        gdf_before = a.normalize(gdf.copy())
+        gdf_compacted, neighbours_compacted, dict_chain_nodes = contract_degree_two(gdf_before, dict_neighbours, nodes)
+        compiled = compile_graph(gdf_compacted, neighbours_compacted, nodes)
+        compiled.chain_of = chain_positions(compiled, gdf_before, dict_chain_nodes, VALUE_COLUMNS)
+        th.attach_history(compiled, gdf_before, live_levels, gdf_compacted, dict_chain_nodes)
+
+        w = a.set_tags([], gdf_before)
+        column, prefix, _ = compiled.select_traffic(moment(0, 3))
+        edge_cost = compiled.edge_costs(w, column)
+        (end, to_start, _), _ = a.chain_entries(1, compiled, edge_cost, w, column, prefix)
+
+        # the jam of the first segment is normalized like the live levels, 0..4 gives 25 per level
+        segments = gdf_before[VALUE_COLUMNS].to_numpy(dtype=np.float64, copy=True)
+        segments[:, TRAFFIC] = [125, 0, 0]
+        segment_costs = segments @ np.array(w[:len(VALUE_COLUMNS)])
+        edge = compiled.chain_of[1][0]
+        self.assertEqual(compiled.node_ids_list[end], 0)
+        self.assertAlmostEqual(edge_cost[edge], segment_costs.sum())
+        self.assertAlmostEqual(to_start, segment_costs[0])
+        # with the static traffic the first segment is the free one, the start would get a smaller share
+        static_cost = compiled.edge_costs(w)
+        self.assertLess(a.chain_entries(1, compiled, static_cost, w)[0][1] / static_cost[edge],
+                        to_start / edge_cost[edge])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+import numpy as np
+import shapely
+from shapely import STRtree
+
+import resource_generator as rg
+
+
+def buffered_score(edge, thresholds, well_index):
+    # the per edge loop the scores have to match, a well counts in the first buffer it shows up in
+    level_points = [5, 3, 1]
+    visited = set()
+    points = 0
+    for level, threshold in enumerate(thresholds):
+        for well in well_index.query(shapely.buffer(edge, threshold, quad_segs=rg.WATER_BUFFER_SEGMENTS)):
+            if well not in visited:
+                visited.add(well)
+                points += level_points[level]
+    return points
+
+
+class WaterScoreTest(unittest.TestCase):
+    def assert_same_scores(self, edges, wells):
+        well_index = STRtree(wells)
+        expected = [buffered_score(edge, rg.WATER_THRESHOLDS, well_index) for edge in edges]
+        np.testing.assert_array_equal(rg.calculate_score_with_index(edges, rg.WATER_THRESHOLDS, well_index),
+                                      expected)
+
+    def test_random_edges_match_the_buffers(self):
+        generator = np.random.default_rng(38)
+        x0, y0 = 430000, 4920000
+        starts = generator.uniform(0, 3000, (400, 2))
+        ends = starts + generator.uniform(-400, 400, (400, 2))
+        middles = (starts + ends) / 2 + generator.uniform(-60, 60, (400, 2))
+        edges = shapely.linestrings(np.stack([starts, middles, ends], axis=1) + [x0, y0])
+        wells = shapely.points(generator.uniform(-300, 3300, (300, 2)) + [x0, y0])
+
+        self.assert_same_scores(edges, wells)
+
+    def test_wells_on_the_thresholds(self):
+        # a flat edge reaches every threshold exactly above it, a slanted one only in the corners of its box
+        flat = shapely.linestrings([[0, 0], [100, 0]])
+        slanted = shapely.linestrings([[1000, 0], [1400, 400]])
+        wells = []
+        for threshold in rg.WATER_THRESHOLDS:
+            for offset in [threshold - 1e-6, threshold, threshold + 1e-6]:
+                wells.append([50, offset])
+                wells.append([1400 + offset * 0.999, -offset * 0.999])
+                wells.append([1000 - offset, 400 + offset])
+
+        self.assert_same_scores(np.array([flat, slanted]), shapely.points(wells))
+
+
+if __name__ == "__main__":
+    unittest.main()